@@ -0,0 +1,428 @@
+# benchmark.py
+#
+# REPRODUCIBLE DASHBOARD BENCHMARK (NO LIVE GITHUB)
+#
+# What it does:
+# 1. GENERATES a synthetic db/<Country>/<City>.sqlite fleet with the real `domains` schema.
+# 2. SERVES it through a local stand-in for the GitHub endpoints cloud_admin.py uses
+#    (contents, git trees / blobs / commits / refs), with injectable latency and rate limits.
+# 3. REPORTS wall time, throughput and per-phase peak memory for the scan, manage and update / bulk paths.
+#
+# USAGE:
+# python benchmark.py --countries 15 --cities 10 --rows 2000 --latency-ms 40
+# python benchmark.py --max-workers 8,20,64 --json bench_output.txt
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote, parse_qs
+
+# Same schema the scrapers write (see any db/*/*.sqlite)
+SCHEMA = """
+CREATE TABLE domains (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    domain TEXT NOT NULL UNIQUE,
+    niche TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    progress INTEGER DEFAULT 0,
+    attempts INTEGER DEFAULT 0,
+    last_result TEXT,
+    last_attempt_at INTEGER,
+    next_retry_at INTEGER,
+    updated_at INTEGER
+);
+CREATE INDEX idx_status ON domains(status);
+"""
+
+NICHES = ["Dental Clinic", "Chiropractor", "Cardiology Center", "Physiotherapy", "Veterinary Clinic",
+          "Plumber", "Electrician", "Law Firm", "Accountant", "Upholstery Cleaning"]
+TLDS = ["com", "net", "org", "dk", "ch", "ee", "fi"]
+
+# ---------------------------------------------------------
+# SYNTHETIC FLEET
+# ---------------------------------------------------------
+def generate_city(path, rows, rng, now):
+    """One city DB: mostly pending, some success / failed, a realistic spread of update times."""
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    data = []
+    for i in range(rows):
+        status = rng.choices(["pending", "success", "failed"], weights=[80, 5, 15])[0]
+        attempts = 0 if status == "pending" else rng.randint(1, 6)
+        last_attempt = now - rng.randint(0, 7 * 86400) if attempts else None
+        next_retry = last_attempt + rng.randint(600, 86400) if status == "failed" else None
+        updated = now - int(rng.expovariate(1 / 43200))
+        data.append((f"site{i}-{rng.getrandbits(32):08x}.{rng.choice(TLDS)}", rng.choice(NICHES), status,
+                     100 if status == "success" else 0, attempts, status if attempts else None,
+                     last_attempt, next_retry, updated))
+    conn.executemany("""INSERT INTO domains (domain, niche, status, progress, attempts, last_result,
+                        last_attempt_at, next_retry_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", data)
+    conn.commit()
+    conn.close()
+
+def generate_fleet(root, countries, cities, rows, seed=1):
+    """db/<Country>/<City>.sqlite fleet; row counts vary +-50% around `rows` like the real one."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    for c in range(countries):
+        folder = os.path.join(root, f"Country{c:02d}")
+        os.makedirs(folder, exist_ok=True)
+        for k in range(cities):
+            generate_city(os.path.join(folder, f"City{k:03d}.sqlite"), max(1, int(rows * rng.uniform(0.5, 1.5))), rng, now)
+
+# ---------------------------------------------------------
+# FAKE GITHUB API
+# ---------------------------------------------------------
+def blob_sha(content):
+    h = hashlib.sha1(f"blob {len(content)}\0".encode())
+    h.update(content)
+    return h.hexdigest()
+
+class FakeGitHub:
+    """
+    In-process HTTP stand-in for the GitHub REST endpoints cloud_admin.py calls,
+    backed by a fleet directory. Every request sleeps `latency` seconds; at most
+    `rate_limit` non-304 requests are answered per `rate_window` seconds, after
+    that 403 with X-RateLimit-Remaining: 0 (like the real API). Statuses put
+    in `faults` are answered first, one per request (e.g. 502 to test retries).
+    With `truncated` set, tree calls return a partial tree flagged truncated.
+    """
+
+    def __init__(self, root, latency=0.0, rate_limit=None, rate_window=60):
+        self.root = root
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = threading.RLock()  # Also taken by _send() while _dispatch() holds it
+        self.blobs, self.trees, self.commits = {}, {}, {}
+        self.stats = {"requests": 0, "not_modified": 0, "rate_limited": 0, "bytes_out": 0}
+        self.faults = []
+        self.truncated = False
+        self.routes = Counter()  # "GET git/trees" -> requests, for tests
+        self._window_start, self._used = time.time(), 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    # --- repository state -------------------------------------------------
+    def entries(self):
+        out = []
+        for c in sorted(os.listdir(self.root)):
+            out.append({"path": f"db/{c}", "type": "tree", "sha": hashlib.sha1(c.encode()).hexdigest()})
+            for n in sorted(os.listdir(os.path.join(self.root, c))):
+                with open(os.path.join(self.root, c, n), "rb") as f: content = f.read()
+                sha = blob_sha(content)
+                self.blobs[sha] = content
+                out.append({"path": f"db/{c}/{n}", "type": "blob", "sha": sha, "size": len(content)})
+        return out
+
+    def head(self):
+        return hashlib.sha1(json.dumps(self.entries()).encode()).hexdigest()
+
+    def count(self, key, n=1):
+        # Handlers run on server threads; += on a shared dict is not atomic
+        with self.lock: self.stats[key] += n
+
+    def _rate(self):
+        """(allowed, remaining, reset) for one more billable request."""
+        if self.rate_limit is None: return True, 5000, int(time.time()) + 3600
+        with self.lock:
+            now = time.time()
+            if now - self._window_start >= self.rate_window:
+                self._window_start, self._used = now, 0
+            reset = int(self._window_start + self.rate_window)
+            if self._used >= self.rate_limit: return False, 0, reset
+            self._used += 1
+            return True, self.rate_limit - self._used, reset
+
+    # --- request handling -------------------------------------------------
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def _send(self, code, body=None, raw=None, etag=None, rate=None):
+                payload = raw if raw is not None else (json.dumps(body).encode() if body is not None else b"")
+                if etag and self.headers.get("If-None-Match") == etag:
+                    code, payload = 304, b""
+                    fake.count("not_modified")
+                self.send_response(code)
+                if rate:
+                    self.send_header("X-RateLimit-Remaining", str(rate[1]))
+                    self.send_header("X-RateLimit-Reset", str(rate[2]))
+                if etag: self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                fake.count("bytes_out", len(payload))
+
+            def _body(self):
+                return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+            def _route(self, method):
+                time.sleep(fake.latency)
+                fake.count("requests")
+                with fake.lock: fault = fake.faults.pop(0) if fake.faults else None
+                if fault:
+                    if method in ("POST", "PUT", "PATCH"): self._body()
+                    return self._send(fault, {"message": "Injected fault"})
+                rate = fake._rate()
+                if not rate[0]:
+                    fake.count("rate_limited")
+                    return self._send(403, {"message": "API rate limit exceeded"}, rate=rate)
+
+                u = urlparse(self.path)
+                path = unquote(u.path)
+                body = self._body() if method in ("POST", "PUT", "PATCH") else None
+                with fake.lock:
+                    return self._dispatch(method, path, parse_qs(u.query), body, rate)
+
+            def _dispatch(self, method, path, query, body, rate):
+                _, _, owner, repo, rest = path.split("/", 4)
+                fake.routes[f"{method} {'/'.join(rest.split('/')[:2])}"] += 1
+                if method == "GET" and rest.startswith("git/ref/heads/"):
+                    head = fake.head()
+                    return self._send(200, {"object": {"sha": head}}, etag=f'"{head}"', rate=rate)
+                if method == "GET" and rest.startswith("git/trees/"):
+                    entries = fake.entries()
+                    if fake.truncated: entries = entries[:1]
+                    return self._send(200, {"sha": rest.rsplit("/", 1)[1], "tree": entries, "truncated": fake.truncated}, rate=rate)
+                if method == "GET" and rest.startswith("git/blobs/"):
+                    content = fake.blobs.get(rest.rsplit("/", 1)[1])
+                    if content is None: return self._send(404, {"message": "Not Found"}, rate=rate)
+                    return self._send(200, raw=content, rate=rate)
+                if method == "GET" and rest.startswith("git/commits/"):
+                    return self._send(200, {"sha": rest.rsplit("/", 1)[1], "tree": {"sha": "base"}}, rate=rate)
+                if method == "POST" and rest == "git/blobs":
+                    content = base64.b64decode(body["content"])
+                    sha = blob_sha(content)
+                    fake.blobs[sha] = content
+                    return self._send(201, {"sha": sha}, rate=rate)
+                if method == "POST" and rest == "git/trees":
+                    sha = hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+                    fake.trees[sha] = body["tree"]
+                    return self._send(201, {"sha": sha}, rate=rate)
+                if method == "POST" and rest == "git/commits":
+                    sha = hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+                    fake.commits[sha] = body
+                    return self._send(201, {"sha": sha}, rate=rate)
+                if method == "PATCH" and rest.startswith("git/refs/heads/"):
+                    commit = fake.commits.get(body["sha"])
+                    if not commit: return self._send(422, {"message": "Object does not exist"}, rate=rate)
+                    if commit["parents"][0] != fake.head(): return self._send(422, {"message": "Update is not a fast forward"}, rate=rate)
+                    for e in fake.trees[commit["tree"]]:
+                        data = e["content"].encode() if "content" in e else fake.blobs[e["sha"]]
+                        with open(os.path.join(fake.root, e["path"][3:]), "wb") as f: f.write(data)
+                    return self._send(200, {"object": {"sha": body["sha"]}}, rate=rate)
+                if rest.startswith("contents/"):
+                    return self._contents(method, rest[len("contents/"):], body, rate)
+                return self._send(404, {"message": "Not Found"}, rate=rate)
+
+            def _contents(self, method, rel, body, rate):
+                local = os.path.join(fake.root, rel[3:]) if rel != "db" else fake.root
+                if method == "GET" and os.path.isdir(local):
+                    items = []
+                    for n in sorted(os.listdir(local)):
+                        p = os.path.join(local, n)
+                        if os.path.isdir(p):
+                            items.append({"name": n, "type": "dir", "path": f"{rel}/{n}"})
+                        else:
+                            with open(p, "rb") as f: content = f.read()
+                            sha = blob_sha(content)
+                            fake.blobs[sha] = content
+                            items.append({"name": n, "type": "file", "path": f"{rel}/{n}", "sha": sha, "size": len(content),
+                                          "download_url": f"{fake.url}/repos/o/r/git/blobs/{sha}"})
+                    etag = '"' + hashlib.sha1(json.dumps(items).encode()).hexdigest() + '"'
+                    return self._send(200, items, etag=etag, rate=rate)
+                if not os.path.isfile(local): return self._send(404, {"message": "Not Found"}, rate=rate)
+                with open(local, "rb") as f: content = f.read()
+                if method == "GET":
+                    return self._send(200, {"name": os.path.basename(local), "sha": blob_sha(content), "size": len(content),
+                                            "content": base64.b64encode(content).decode()}, rate=rate)
+                if method == "PUT":
+                    if body["sha"] != blob_sha(content): return self._send(409, {"message": "sha mismatch"}, rate=rate)
+                    new = base64.b64decode(body["content"])
+                    with open(local, "wb") as f: f.write(new)
+                    return self._send(200, {"content": {"sha": blob_sha(new)}}, rate=rate)
+                return self._send(405, {"message": "Method Not Allowed"}, rate=rate)
+
+            def do_GET(self): self._route("GET")
+            def do_POST(self): self._route("POST")
+            def do_PUT(self): self._route("PUT")
+            def do_PATCH(self): self._route("PATCH")
+
+        return Handler
+
+# ---------------------------------------------------------
+# MEASUREMENT
+# ---------------------------------------------------------
+def reset_peak():
+    """Start a fresh peak for the next phase: the kernel RSS high-water mark on Linux, tracemalloc elsewhere."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")  # Resets VmHWM
+        return "rss"
+    except OSError:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        return "traced"
+
+def peak_mb(mode):
+    if mode == "rss":
+        with open("/proc/self/status") as f:
+            return round(int(re.search(r"VmHWM:\s+(\d+)", f.read()).group(1)) / 1024, 1)
+    peak = tracemalloc.get_traced_memory()[1]  # Python allocations only (no SQLite page cache)
+    tracemalloc.stop()
+    return round(peak / (1024 * 1024), 1)
+
+def measure(name, fn, items=None, fake=None):
+    before = dict(fake.stats) if fake else {}
+    mode = reset_peak()
+    started = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - started
+    row = {"phase": name, "wall_s": round(wall, 3), "peak_mb": peak_mb(mode)}
+    if items: row["items_per_s"] = round(items / wall, 1)
+    if fake:
+        row["requests"] = fake.stats["requests"] - before["requests"]
+        row["mb_out"] = round((fake.stats["bytes_out"] - before["bytes_out"]) / 1e6, 2)
+        row["rate_limited"] = fake.stats["rate_limited"] - before["rate_limited"]
+    return row
+
+def print_table(rows):
+    cols = ["phase", "wall_s", "items_per_s", "requests", "mb_out", "rate_limited", "peak_mb"]
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in rows)) for c in cols}
+    print("  ".join(c.ljust(widths[c]) for c in cols))
+    for r in rows:
+        print("  ".join(str(r.get(c, "")).ljust(widths[c]) for c in cols))
+
+# ---------------------------------------------------------
+# SCENARIO
+# ---------------------------------------------------------
+def run(args):
+    work = tempfile.mkdtemp(prefix="nexus_bench_")
+    fleet = os.path.join(work, "fleet")
+    print(f"Generating {args.countries} x {args.cities} cities, ~{args.rows} rows each in {fleet} ...")
+    generate_fleet(fleet, args.countries, args.cities, args.rows, args.seed)
+    n_files = args.countries * args.cities
+
+    fake = FakeGitHub(fleet, args.latency_ms / 1000, args.rate_limit, args.rate_window).start()
+
+    # cloud_admin reads config.json from the working directory at import time
+    with open(os.path.join(work, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "GITHUB": {"USER": "o", "REPO": "r", "BRANCH": "main", "PAT": "bench", "API_URL": fake.url},
+            "CACHE": {"ROOT": os.path.join(work, "cache"), "MAX_MB": args.cache_mb},
+            "WRITES": {"WINDOW_SECONDS": 0.2},
+        }, f)
+    os.chdir(work)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import cloud_admin as ca
+
+    # Only the paths being measured should touch the fake server
+    ca.ANALYTICS.trigger = lambda: None
+    client = ca.app.test_client()
+    results = []
+
+    for workers in args.max_workers:
+        ca.SCAN_MAX_WORKERS = workers
+        ca.BLOB_CACHE.max_bytes = 0
+        ca.BLOB_CACHE.evict()  # Cold run: nothing cached
+        ca.BLOB_CACHE.max_bytes = args.cache_mb * 1024 * 1024
+        ca.STORAGE.invalidate_listing()
+        results.append(measure(f"scan cold (max {workers})", lambda: ca.get_global_analytics(), n_files, fake))
+
+    ca.STORAGE.invalidate_listing()
+    state = {}
+    results.append(measure("scan warm (cache)", lambda: state.update(r=ca.get_global_analytics()), n_files, fake))
+    per_file = state["r"][3]
+    results.append(measure("scan unchanged SHAs", lambda: ca.get_global_analytics(per_file), n_files, fake))
+
+    country, city = "Country00", "City000.sqlite"
+    results.append(measure("manage_db first page", lambda: client.get(f"/manage/{country}/{city}"), 1, fake))
+    results.append(measure("manage_db cached page", lambda: client.get(f"/manage/{country}/{city}?sort=last_attempt"), 1, fake))
+
+    def clicks():
+        tickets = [ca.WRITES.submit({(country, city): [("UPDATE domains SET status=?, updated_at=? WHERE id=?",
+                                                        ("success", int(time.time()), i))]}, f"bench #{i}")
+                   for i in range(1, args.clicks + 1)]
+        for t in tickets: t.wait(120)
+    results.append(measure(f"update x{args.clicks} (coalesced)", clicks, args.clicks, fake))
+
+    def bulk_country():
+        files = [(country, f["name"]) for f in ca.get_files_in_country(country)]
+        ca.WRITES.submit({k: [ca.bulk_edit("failed", "pending")] for k in files}, "bench bulk").wait(300)
+    results.append(measure("bulk reset (country)", bulk_country, args.cities, fake))
+
+    def bulk_global():
+        files = [(f["country_name"], f["name"]) for f in ca.STORAGE.list_all()]
+        ca.WRITES.submit({k: [ca.bulk_edit("pending", "failed")] for k in files}, "bench bulk").wait(600)
+    results.append(measure("bulk fail (global)", bulk_global, n_files, fake))
+
+    def cold_scan():
+        ca.BLOB_CACHE.max_bytes = 0
+        ca.BLOB_CACHE.evict()
+        ca.BLOB_CACHE.max_bytes = args.cache_mb * 1024 * 1024
+        ca.STORAGE.invalidate_listing()
+        ca.get_global_analytics()
+    results.append(measure("compact + snapshots", lambda: ca.compact_fleet(), n_files, fake))
+    results.append(measure("scan cold (summaries)", cold_scan, n_files, fake))
+    from_meta, ca.stats_from_meta = ca.stats_from_meta, lambda meta, f: None  # Force the download path
+    results.append(measure("scan cold (snapshots)", cold_scan, n_files, fake))
+    ca.stats_from_meta = from_meta
+
+    per_file = ca.get_global_analytics()[3]
+    results.append(measure("history backfill (24h)", lambda: ca.HISTORY.record(per_file, time.time()), n_files, fake))
+    results.append(measure("history record", lambda: ca.HISTORY.record(per_file, time.time() + 60), n_files, fake))
+    results.append(measure("history 7d + sparklines", lambda: (ca.HISTORY.series(7), ca.HISTORY.sparklines(country)), 1, fake))
+
+    fake.stop()
+    print()
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark cloud_admin.py against a synthetic fleet and a fake GitHub API.")
+    p.add_argument("--countries", type=int, default=15)
+    p.add_argument("--cities", type=int, default=9, help="cities per country")
+    p.add_argument("--rows", type=int, default=1000, help="average rows per city")
+    p.add_argument("--latency-ms", type=float, default=30, help="added to every fake API request")
+    p.add_argument("--rate-limit", type=int, default=None, help="requests per --rate-window (default: unlimited)")
+    p.add_argument("--rate-window", type=int, default=60)
+    p.add_argument("--max-workers", type=lambda s: [int(x) for x in s.split(",")], default=[20], help="comma list to sweep")
+    p.add_argument("--clicks", type=int, default=10, help="single-row updates in the coalescing test")
+    p.add_argument("--cache-mb", type=int, default=512)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="also write results as JSON to this path")
+    p.add_argument("--keep", action="store_true", help="keep the generated fleet and cache")
+    args = p.parse_args()
+    args.json = os.path.abspath(args.json) if args.json else None  # run() changes directory
+    run(args)
+
+if __name__ == "__main__":
+    main()
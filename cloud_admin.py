@@ -7,20 +7,53 @@
 # 2. GLOBAL AGGREGATED STATS (Success, Pending, Failed).
 # 3. MULTI-THREADED SCANNER (For fast Dashboard loading).
 # 4. PREMIUM UI (Charts, Cards, Responsive).
+# 5. PLUGGABLE STORAGE (GitHub API or a local db/ checkout, see STORAGE in config.json).
+# 6. BLOB CACHE (Unchanged DBs are never downloaded twice).
+# 7. BACKGROUND REFRESH (Dashboard served from a snapshot, only changed cities rescanned).
+# 8. WRITE-BEHIND EDITS (Clicks coalesced per file, one commit per batch).
+# 9. DOMAIN SEARCH (One index over every city, duplicates across cities).
+# 10. CROSS-CITY ANALYTICS (Merged store, SQL rollups across every city).
+# 11. JSON API + LIVE STREAM (/api/stats..., /api/stream server-sent events).
+# 12. METRICS (/metrics in Prometheus text format, per-phase scan timings, slow-scan log).
+# 13. CITY SUMMARIES (.meta sidecars answer for unchanged cities, rewritten on every save).
+# 14. COMPACTION + SNAPSHOTS (VACUUM, time indexes, gzip .sqlite.gz downloaded instead of the DB).
+# 15. MULTI-WORKER SERVING (App factory, one worker scans, listing + snapshot shared on disk).
+# 16. HISTORY (Per-city rollups by minute / hour / day, trend charts and sparklines).
 #
 # USAGE:
-# python cloud_admin.py
+# cp config.example.json config.json       (then fill in the repo and PAT, never commit it)
+# python cloud_admin.py                     (development server)
+# gunicorn -w 4 -k gthread --threads 16 "cloud_admin:create_app()"   (threads needed for /api/stream)
+# python cloud_admin.py compact [Country]   (maintenance job, also on the dashboard)
 
 import os
+import sys
+import gzip
+import zlib
+import asyncio
 import sqlite3
 import json
 import time
 import base64
+import random
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
 import tempfile
+import hashlib
+import itertools
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from flask import Flask, request, render_template_string, redirect, url_for, flash
+try:
+    import fcntl  # Cross-process locks for the shared cache (missing on Windows)
+except ImportError:
+    fcntl = None
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from html import escape
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, render_template_string, redirect, url_for, flash, jsonify, Response, stream_with_context
 
 app = Flask(__name__)
 app.secret_key = "ultimate_admin_key_secure"
@@ -28,19 +61,75 @@ app.secret_key = "ultimate_admin_key_secure"
 # ---------------------------------------------------------
 # LOAD CONFIG
 # ---------------------------------------------------------
-if not os.path.exists("config.json"):
-    print("CRITICAL: config.json not found!")
-    exit()
+# NEXUS_CONFIG points a worker at another file. Importing never exits: a
+# missing file is reported by the entry points (create_app / __main__).
+CONFIG_PATH = os.environ.get("NEXUS_CONFIG", "config.json")
 
-with open("config.json", "r", encoding="utf-8") as f:
-    CFG = json.load(f)
-    GH_USER = CFG["GITHUB"]["USER"]
-    GH_REPO = CFG["GITHUB"]["REPO"]
-    GH_BRANCH = CFG["GITHUB"]["BRANCH"]
-    GH_PAT = CFG["GITHUB"]["PAT"]
+def load_config(path):
+    if not os.path.exists(path): return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-API_BASE = f"https://api.github.com/repos/{GH_USER}/{GH_REPO}/contents"
+CFG = load_config(CONFIG_PATH)
+GH_CFG = CFG.get("GITHUB", {})
+GH_USER = GH_CFG.get("USER", "")
+GH_REPO = GH_CFG.get("REPO", "")
+GH_BRANCH = GH_CFG.get("BRANCH", "main")
+GH_PAT = GH_CFG.get("PAT", "")
+
+# STORAGE: {"MODE": "github"} (default) or {"MODE": "local", "ROOT": "db"}
+STORAGE_CFG = CFG.get("STORAGE", {})
+STORAGE_MODE = STORAGE_CFG.get("MODE", "github").lower()
+LOCAL_ROOT = STORAGE_CFG.get("ROOT", "db")
+# Edit downloaded DBs in memory (sqlite3 deserialize, Python 3.11+) instead of via temp files
+IN_MEMORY_DB = STORAGE_CFG.get("IN_MEMORY", True) and hasattr(sqlite3.Connection, "deserialize")
+IN_MEMORY_MAX_MB = STORAGE_CFG.get("IN_MEMORY_MAX_MB", 64)  # Larger DBs are always edited in a temp file
+
+# CACHE: downloaded blobs, keyed by git blob SHA (GitHub mode only)
+CACHE_CFG = CFG.get("CACHE", {})
+CACHE_ROOT = CACHE_CFG.get("ROOT", ".cache")  # Derived data (indexed copies, search index, ...)
+CACHE_DIR = CACHE_CFG.get("DIR", os.path.join(CACHE_ROOT, "blobs"))
+CACHE_MAX_MB = CACHE_CFG.get("MAX_MB", 512)
+SHARED_DIR = os.path.join(CACHE_ROOT, "shared")  # Listing and dashboard state shared by worker processes
+
+# API_URL is only overridden to point at a stand-in server (see benchmark.py)
+REPO_API = f"{GH_CFG.get('API_URL', 'https://api.github.com')}/repos/{GH_USER}/{GH_REPO}"
+API_BASE = f"{REPO_API}/contents"
 HEADERS = {"Authorization": f"token {GH_PAT}", "Accept": "application/vnd.github.v3+json"}
+RAW_HEADERS = {**HEADERS, "Accept": "application/vnd.github.raw"}
+
+# Seconds a tree listing is trusted before the branch head is checked again
+LISTING_TTL = GH_CFG.get("LISTING_TTL", 15)
+
+# SCAN: download concurrency adapts between MIN_WORKERS and MAX_WORKERS, keeping
+# latency under TARGET_LATENCY seconds, MEMORY_MB in flight and the API budget
+# above RATE_LIMIT_FLOOR
+SCAN_CFG = CFG.get("SCAN", {})
+SCAN_MAX_WORKERS = SCAN_CFG.get("MAX_WORKERS", 64)
+SCAN_RATE_LIMIT_FLOOR = SCAN_CFG.get("RATE_LIMIT_FLOOR", 200)
+DOWNLOAD_CHUNK = SCAN_CFG.get("CHUNK_KB", 256) * 1024  # Downloads are streamed to disk in chunks this size
+
+# WRITES: edits are batched for WINDOW_SECONDS, a stale branch head is retried MAX_RETRIES times
+WRITES_CFG = CFG.get("WRITES", {})
+WRITE_MAX_RETRIES = WRITES_CFG.get("MAX_RETRIES", 3)
+WRITE_WORKERS = WRITES_CFG.get("WORKERS", 16)
+WRITE_MEMORY = WRITES_CFG.get("MEMORY_MB", 512) * 1024 * 1024  # Working copies held in memory at once
+
+# DASHBOARD: {"REFRESH_SECONDS": 60} - background snapshot refresh interval
+DASHBOARD_CFG = CFG.get("DASHBOARD", {})
+STREAM_SECONDS = DASHBOARD_CFG.get("STREAM_SECONDS", 5)  # Live stream re-check interval
+QUERY_SECONDS = DASHBOARD_CFG.get("QUERY_SECONDS", 5)    # Time limit for /analytics SQL
+
+# METRICS: cities taking longer than SLOW_SCAN_SECONDS are logged, the last SLOW_LOG_SIZE are kept
+METRICS_CFG = CFG.get("METRICS", {})
+SLOW_SCAN_SECONDS = METRICS_CFG.get("SLOW_SCAN_SECONDS", 5.0)
+SLOW_LOG_SIZE = METRICS_CFG.get("SLOW_LOG_SIZE", 200)
+
+# HISTORY: trend rollups are kept per minute for MINUTE_DAYS (at least 2, the hour / day
+# buckets are summed from it), per hour for HOUR_DAYS, per day for DAY_DAYS
+HISTORY_CFG = CFG.get("HISTORY", {})
+HISTORY_TIERS = ((60, max(2, HISTORY_CFG.get("MINUTE_DAYS", 2))), (3600, HISTORY_CFG.get("HOUR_DAYS", 90)),
+                 (86400, HISTORY_CFG.get("DAY_DAYS", 730)))
 
 # ---------------------------------------------------------
 # UI TEMPLATE (PREMIUM DASHBOARD WITH CHARTS)
@@ -126,198 +215,2436 @@ HTML_TEMPLATE = """
         .bg-success { background: #dcfce7; color: #15803d; }
         .bg-failed { background: #fee2e2; color: #b91c1c; }
 
-        @media (max-width: 992px) {
-            .sidebar { width: 0; padding: 0; overflow: hidden; }
-            .main-content { margin-left: 0; }
-        }
-    </style>
-</head>
-<body>
+        @media (max-width: 992px) {
+            .sidebar { width: 0; padding: 0; overflow: hidden; }
+            .main-content { margin-left: 0; }
+        }
+    </style>
+</head>
+<body>
+
+    <!-- SIDEBAR -->
+    <div class="sidebar">
+        <div class="sidebar-header">
+            <i class="bi bi-hdd-network me-2 text-info"></i> NEXUS DB
+        </div>
+        
+        <div class="nav flex-column">
+            <a href="/" class="nav-link {{ 'active' if page == 'dashboard' }}">
+                <i class="bi bi-speedometer2"></i> Global Dashboard
+            </a>
+            <a href="/search" class="nav-link {{ 'active' if page == 'search' }}">
+                <i class="bi bi-search"></i> Domain Search
+            </a>
+            <a href="/analytics" class="nav-link {{ 'active' if page == 'analytics' }}">
+                <i class="bi bi-bar-chart-line"></i> Analytics
+            </a>
+            <div class="mt-4 mb-2 px-3 text-uppercase text-white-50" style="font-size: 0.7rem; font-weight: 700;">Countries</div>
+            {% for c in countries %}
+            <a href="/country/{{ c }}" class="nav-link {{ 'active' if selected_country == c }}">
+                <i class="bi bi-geo-alt-fill"></i> {{ c }}
+            </a>
+            {% endfor %}
+        </div>
+    </div>
+
+    <!-- MAIN CONTENT -->
+    <div class="main-content">
+        
+        <div class="d-flex justify-content-between align-items-center mb-5">
+            <div>
+                <h2 class="fw-bold m-0 text-dark">{{ title }}</h2>
+                <p class="text-muted m-0">Live GitHub Connection • <span class="text-success fw-bold">● Online</span></p>
+            </div>
+            <a href="/refresh" class="btn btn-primary shadow-sm"><i class="bi bi-arrow-clockwise me-2"></i> Refresh Data</a>
+        </div>
+
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                {% for category, message in messages %}
+                    <div class="alert alert-{{ category }} shadow-sm border-0 rounded-3 mb-4">
+                        <i class="bi bi-info-circle-fill me-2"></i> {{ message }}
+                    </div>
+                {% endfor %}
+            {% endif %}
+        {% endwith %}
+
+        {{ CONTENT | safe }}
+        
+    </div>
+
+    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+</body>
+</html>
+"""
+
+# ---------------------------------------------------------
+# METRICS (PROMETHEUS TEXT FORMAT)
+# ---------------------------------------------------------
+class Metrics:
+    """
+    Thread-safe counters, gauges and histograms, rendered in the Prometheus
+    text format by /metrics. Every series is declared once up front; a
+    sample is identified by its name plus its label values.
+    """
+
+    SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    BYTES = tuple(4 ** k * 1024 for k in range(11))  # 1 KiB .. 1 GiB
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (kind, help, buckets)
+        self._values = {}  # (name, labels) -> value, or [per-bucket counts..., sum, count] for histograms
+
+    def declare(self, name, kind, help, buckets=None):
+        self._meta[name] = (kind, help, buckets)
+
+    @staticmethod
+    def _key(name, labels):
+        # Label values are kept as strings: status=404 and status="Timeout" must sort together in render()
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock: self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._values.setdefault(key, [0] * (len(buckets) + 2))
+            i = bisect_left(buckets, value)  # First bucket with le >= value
+            if i < len(buckets): h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        with self._lock: values = {k: (list(v) if isinstance(v, list) else v) for k, v in self._values.items()}
+        lines = []
+        for name, (kind, help, buckets) in self._meta.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for (n, labels), v in sorted(values.items(), key=lambda kv: kv[0]):
+                if n != name: continue
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {v}")
+                    continue
+                running = 0
+                for le, count in zip(buckets, v):
+                    running += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {running}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {v[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {round(v[-2], 6)}")
+                lines.append(f"{name}_count{self._labels(labels)} {v[-1]}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.declare("nexus_github_requests_total", "counter", "GitHub API requests by method and response status (each retry counts).")
+METRICS.declare("nexus_github_request_seconds", "histogram", "GitHub API request latency.", Metrics.SECONDS)
+METRICS.declare("nexus_github_rate_limit_remaining", "gauge", "X-RateLimit-Remaining from the last GitHub response.")
+METRICS.declare("nexus_github_rate_limit_reset_timestamp", "gauge", "X-RateLimit-Reset from the last GitHub response.")
+METRICS.declare("nexus_blob_cache_total", "counter", "Blob cache lookups during scans and edits, by result.")
+METRICS.declare("nexus_download_bytes", "histogram", "Size of each downloaded DB blob.", Metrics.BYTES)
+METRICS.declare("nexus_scan_phase_seconds", "histogram", "Time per scan phase (listing, download, query, aggregate).", Metrics.SECONDS)
+METRICS.declare("nexus_scan_city_seconds", "histogram", "Download plus query time per city.", Metrics.SECONDS)
+METRICS.declare("nexus_scan_errors_total", "counter", "Failed city scans by category.")
+METRICS.declare("nexus_snapshot_downloads_total", "counter", "Compressed snapshot downloads, by whether they matched the DB (used) or not (rejected).")
+METRICS.declare("nexus_meta_summaries_total", "counter", "Cities answered from a current .meta summary (hit) or scanned (miss).")
+METRICS.declare("nexus_scan_slow_total", "counter", "Cities that took longer than SLOW_SCAN_SECONDS to scan.")
+METRICS.declare("nexus_snapshot_age_seconds", "gauge", "Seconds since the dashboard snapshot was published.")
+METRICS.declare("nexus_snapshot_version", "gauge", "Version of the current dashboard snapshot.")
+METRICS.declare("nexus_refresh_in_progress", "gauge", "1 while the background refresh is running.")
+
+# ---------------------------------------------------------
+# GITHUB CLIENT (POOLED, CONDITIONAL, RETRYING)
+# ---------------------------------------------------------
+class StorageError(Exception):
+    """A DB could not be listed, fetched or pushed; the message is shown per file."""
+
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status  # HTTP status when the failure was a GitHub response
+
+class GitHubClient:
+    """
+    One keep-alive session shared by every thread. GETs are sent with the
+    last ETag seen for that URL, so unchanged listings come back as free 304s.
+    429 / 5xx / rate-limited 403 responses are retried with exponential
+    backoff, honouring Retry-After and X-RateLimit-Reset.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size, max_retries, max_wait=60):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        self._etags = {}  # (url, params) -> response
+        self._etag_lock = threading.Lock()
+
+    def _retry_delay(self, r, attempt):
+        """Seconds to wait before retrying `r`, or None if it should not be retried."""
+        remaining = r.headers.get("X-RateLimit-Remaining")
+        limited = r.status_code == 429 or (r.status_code == 403 and remaining == "0")
+        if r.status_code not in self.RETRY_STATUS and not limited: return None
+
+        if r.headers.get("Retry-After"):
+            return min(float(r.headers["Retry-After"]), self.max_wait)
+        if remaining == "0" and r.headers.get("X-RateLimit-Reset"):
+            return min(max(int(r.headers["X-RateLimit-Reset"]) - time.time(), 1), self.max_wait)
+        return min(2 ** attempt + random.random(), self.max_wait)
+
+    def request(self, method, url, headers=None, conditional=False, **kw):
+        headers = dict(headers or HEADERS)
+        kw.setdefault("timeout", 20)
+        key = (url, json.dumps(kw.get("params"), sort_keys=True))
+        cached = None
+        if conditional:
+            with self._etag_lock: cached = self._etags.get(key)
+            if cached is not None: headers["If-None-Match"] = cached.headers["ETag"]
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                r = self.session.request(method, url, headers=headers, **kw)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                METRICS.inc("nexus_github_requests_total", method=method, status=type(e).__name__)
+                if attempt == self.max_retries: raise
+                time.sleep(min(2 ** attempt + random.random(), self.max_wait))
+                continue
+            finally:
+                METRICS.observe("nexus_github_request_seconds", time.monotonic() - started, method=method)
+            METRICS.inc("nexus_github_requests_total", method=method, status=r.status_code)
+
+            if "X-RateLimit-Remaining" in r.headers:
+                self.rate_limit_remaining = int(r.headers["X-RateLimit-Remaining"])
+                self.rate_limit_reset = int(r.headers.get("X-RateLimit-Reset", 0))
+                METRICS.set("nexus_github_rate_limit_remaining", self.rate_limit_remaining)
+                METRICS.set("nexus_github_rate_limit_reset_timestamp", self.rate_limit_reset)
+
+            delay = self._retry_delay(r, attempt)
+            if delay is None or attempt == self.max_retries: break
+            time.sleep(delay)
+
+        if r.status_code == 304 and cached is not None:
+            return cached
+        if conditional and r.status_code == 200 and r.headers.get("ETag"):
+            r.content  # Read the body now, the cached response outlives the connection
+            with self._etag_lock: self._etags[key] = r
+        return r
+
+    def get(self, url, **kw):
+        return self.request("GET", url, **kw)
+
+    def post(self, url, **kw):
+        return self.request("POST", url, **kw)
+
+    def patch(self, url, **kw):
+        return self.request("PATCH", url, **kw)
+
+# A pool smaller than the busiest thread pool makes urllib3 drop and reopen connections
+GH = GitHubClient(max(GH_CFG.get("POOL_SIZE", 32), SCAN_MAX_WORKERS, WRITE_WORKERS), GH_CFG.get("MAX_RETRIES", 4))
+
+def http_error(r):
+    """Short per-file error label for a failed response."""
+    if r.status_code == 403 and r.headers.get("X-RateLimit-Remaining") == "0":
+        return "HTTP 403 (rate limited)"
+    return f"HTTP {r.status_code}"
+
+# ---------------------------------------------------------
+# BLOB CACHE (CONTENT-ADDRESSED, LRU ON DISK)
+# ---------------------------------------------------------
+class BlobCache:
+    """
+    Persistent cache of downloaded DB files keyed by git blob SHA.
+    A SHA always maps to the same bytes, so entries never go stale; the
+    least recently used ones are evicted once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, sha):
+        return os.path.join(self.root, f"{sha}.sqlite")
+
+    def get(self, sha):
+        if not sha: return None
+        path = self._path(sha)
+        try:
+            os.utime(path)  # mtime doubles as "last used" for LRU
+            return path
+        except OSError:
+            return None
+
+    def put_stream(self, write, sha=None):
+        """
+        Stores whatever write(file) writes, without holding it in memory.
+        With no `sha` the blob is keyed by the git SHA of what was written.
+        Returns (path, sha, bytes written).
+        """
+        # Write then rename, so readers never see a half-written blob
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+                size = f.tell()
+            sha = sha or git_blob_sha_file(tmp_path)
+            path = self._path(sha)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        self.evict()
+        return path, sha, size
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for n in os.listdir(self.root):
+                if not n.endswith(".sqlite"): continue
+                try:
+                    st = os.stat(os.path.join(self.root, n))
+                    entries.append((st.st_mtime, st.st_size, n))
+                except OSError: pass
+
+            total = sum(e[1] for e in entries)
+            for _, size, n in sorted(entries):
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(os.path.join(self.root, n))
+                    total -= size
+                except OSError: pass
+
+BLOB_CACHE = BlobCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
+
+# ---------------------------------------------------------
+# SHARED STATE (ACROSS WORKER PROCESSES)
+# ---------------------------------------------------------
+class ProcessLock:
+    """
+    Exclusive lock shared by the threads of this process and by every other
+    worker (flock on a lock file, released by the OS if the holder dies).
+    Without fcntl only the thread lock is taken and each process works alone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking): return False
+        if fcntl is None: return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            self._thread_lock.release()
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)  # Closing drops the flock
+            self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class SharedState:
+    """
+    A JSON document in SHARED_DIR that every worker process can read.
+    Written to a temp file and renamed, so readers never see half of it and
+    need no lock; `lock` serializes whoever produces it.
+    """
+
+    def __init__(self, name):
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        self.name = name
+        self.path = os.path.join(SHARED_DIR, f"{name}.json")
+        self.lock = ProcessLock(self.path + ".lock")
+        self._seen = None  # File identity at the last load()
+
+    def modified(self):
+        try: return os.stat(self.path).st_mtime
+        except OSError: return 0
+
+    def load(self, if_changed=False):
+        """The document; None if missing, unreadable, or (if_changed) not rewritten since the last load."""
+        try:
+            st = os.stat(self.path)
+            seen = (st.st_ino, st.st_mtime_ns, st.st_size)  # Every save() is a new inode
+            if if_changed and seen == self._seen: return None
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._seen = seen
+            return data
+        except (OSError, ValueError):
+            return None
+
+    def save(self, data):
+        fd, tmp_path = tempfile.mkstemp(dir=SHARED_DIR, suffix=".part")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    def clear(self):
+        try: os.remove(self.path)
+        except OSError: pass
+
+# ---------------------------------------------------------
+# STORAGE BACKENDS (GITHUB API / LOCAL CHECKOUT)
+# ---------------------------------------------------------
+class ByteBudget:
+    """
+    Caps the bytes held by concurrent threads. One holder is always let in,
+    so a file larger than the whole budget still gets through, alone.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self._holders = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def hold(self, size):
+        with self._cond:
+            self._cond.wait_for(lambda: self._holders == 0 or self.in_use + size <= self.max_bytes)
+            self.in_use += size
+            self._holders += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= size
+                self._holders -= 1
+                self._cond.notify_all()
+
+WRITE_BUDGET = ByteBudget(WRITE_MEMORY)
+
+def working_copy_bytes(size):
+    """Memory a working_copy of a `size`-byte DB holds: the file, the live DB and its dump in memory, else ~nothing."""
+    return size * 3 if IN_MEMORY_DB and size <= IN_MEMORY_MAX_MB * 1024 * 1024 else 0
+
+@contextmanager
+def working_copy(path, cache=None):
+    """
+    Writable connection over a private copy of the DB file at `path`, plus a
+    dump(sha=None) that stores the edited DB in `cache` (BLOB_CACHE by default)
+    and returns (cached path, git SHA). Files up to IN_MEMORY_MAX_MB are
+    deserialized straight into memory when SQLite supports it; larger ones
+    are copied to a temp file, so a big city is never held in memory whole.
+    """
+    cache = cache or BLOB_CACHE
+
+    if IN_MEMORY_DB and os.path.getsize(path) <= IN_MEMORY_MAX_MB * 1024 * 1024:
+        with open(path, "rb") as f: content = f.read()
+        # Most city DBs are WAL-format (header bytes 18-19 = 2), which an
+        # in-memory DB refuses. Open them as rollback-journal and put the
+        # original format bytes back on the way out.
+        wal = content[18:20] == b"\x02\x02"
+        conn = sqlite3.connect(":memory:")
+
+        def dump(sha=None):
+            data = conn.serialize()
+            if wal and data: data = data[:18] + b"\x02\x02" + data[20:]
+            return cache.put_stream(lambda f: f.write(data), sha)[:2]
+
+        try:
+            if content:  # A 0-byte file is an empty DB; deserialize(b"") raises MemoryError
+                conn.deserialize(content[:18] + b"\x01\x01" + content[20:] if wal else content)
+            del content
+            yield conn, dump
+        finally:
+            conn.close()
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    shutil.copyfile(path, tmp_path)
+    conn = sqlite3.connect(tmp_path)
+
+    def dump(sha=None):
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # WAL-format DBs keep commits in -wal until now
+        def write(f):
+            with open(tmp_path, "rb") as src: shutil.copyfileobj(src, f, DOWNLOAD_CHUNK)
+        return cache.put_stream(write, sha)[:2]
+
+    try:
+        yield conn, dump
+    finally:
+        conn.close()
+        os.remove(tmp_path)
+
+def apply_edits(conn, edits):
+    """Runs [(sql, params), ...] in one transaction, returns the rows touched."""
+    rows = 0
+    try:
+        for sql, params in edits:
+            rows += max(conn.execute(sql, params).rowcount, 0)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
+
+def format_errors(errors):
+    return "; ".join(f"{c}/{f}: {e}" for (c, f), e in errors.items())
+
+def with_skipped(msg, errors):
+    return f"{msg} (skipped {format_errors(errors)})" if errors else msg
+
+def git_blob_sha_file(path):
+    """Same SHA GitHub reports for a file, so local and remote listings agree; read in chunks."""
+    h = hashlib.sha1(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b""): h.update(chunk)
+    return h.hexdigest()
+
+class Base64Body:
+    """
+    {"encoding": "base64", "content": ...} JSON for a file, encoded chunk by
+    chunk as requests sends it. Has a length (so it is not sent chunked) and
+    can be iterated again when a request is retried.
+    """
+
+    CHUNK = 3 * 64 * 1024  # Multiple of 3, so chunks encode without padding
+
+    def __init__(self, path):
+        self.path = path
+        self.head, self.tail = b'{"encoding": "base64", "content": "', b'"}'
+
+    def __len__(self):
+        return len(self.head) + 4 * ((os.path.getsize(self.path) + 2) // 3) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK), b""): yield base64.b64encode(chunk)
+        yield self.tail
+
+# Read once while still single-threaded: os.umask() can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def replace_keeping_mode(tmp_path, path):
+    """os.replace for files shared with the scrapers: mkstemp files are 0600, keep path's own mode instead."""
+    try: mode = os.stat(path).st_mode & 0o7777
+    except OSError: mode = 0o666 & ~UMASK
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+def meta_name(name):
+    """City.sqlite -> City.meta (works on names and paths)."""
+    return name[:-len(".sqlite")] + ".meta"
+
+SNAPSHOT_SUFFIX = ".gz"  # db/<Country>/<City>.sqlite.gz, published by the compaction job
+
+def is_sidecar(name):
+    return name.endswith(".meta") or name.endswith(".sqlite" + SNAPSHOT_SUFFIX)
+
+def attach_sidecars(files, sidecars):
+    """Points each city at its .meta and .sqlite.gz, sidecars = {path: (blob sha, url, size)}."""
+    for f in files:
+        meta, snapshot = sidecars.get(meta_name(f['path'])), sidecars.get(f['path'] + SNAPSHOT_SUFFIX)
+        if meta: f['meta_sha'], f['meta_url'] = meta[:2]
+        if snapshot: f['snapshot_sha'], f['snapshot_url'], f['snapshot_size'] = snapshot
+    return files
+
+def write_snapshot(src, dst):
+    """gzips the DB at `src` into `dst` (no timestamp, equal DBs give equal blobs); returns the .meta "snapshot" entry minus db_sha."""
+    with open(src, "rb") as f_in, open(dst, "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=6, mtime=0) as f_out:
+            shutil.copyfileobj(f_in, f_out, DOWNLOAD_CHUNK)
+    return {"sha": git_blob_sha_file(dst), "size": os.path.getsize(src), "compressed_size": os.path.getsize(dst)}
+
+def safe_name(name):
+    """Country / file names come straight from the URL - keep them inside db/."""
+    return bool(name) and name not in (".", "..") and "/" not in name and "\\" not in name
+
+class GitHubStorage:
+    """
+    Reads and writes db/<Country>/<City>.sqlite through the GitHub API.
+    Listings come from one recursive tree call per branch head, scans work
+    on cached blobs, edits are pushed back as a commit.
+    """
+    name = "github"
+
+    def __init__(self):
+        self._tree = None          # {"commit": sha, "countries": {name: [file_info]} or None if truncated}
+        self._tree_checked = 0
+        self._tree_lock = threading.Lock()
+        self._shared = SharedState("listing")
+        self._metas = {}           # .meta blob SHA -> parsed sidecar
+
+    def _head_commit(self):
+        r = GH.get(f"{REPO_API}/git/ref/heads/{GH_BRANCH}", conditional=True, timeout=10)
+        if r.status_code != 200: return None
+        return r.json()['object']['sha']
+
+    def _fetch_tree(self, commit):
+        """
+        One recursive git-trees call for the whole repo -> {country: [file_info]},
+        or None if GitHub truncated it (too big for one call).
+        """
+        r = GH.get(f"{REPO_API}/git/trees/{commit}", params={"recursive": 1}, timeout=30)
+        if r.status_code != 200: raise StorageError(f"Tree listing failed: {http_error(r)}", r.status_code)
+        data = r.json()
+        if data.get('truncated'): return None
+
+        countries, sidecars = {}, {}
+        for i in data['tree']:
+            parts = i['path'].split('/')
+            if len(parts) == 2 and parts[0] == 'db' and i['type'] == 'tree':
+                countries.setdefault(parts[1], [])
+            elif len(parts) == 3 and parts[0] == 'db' and i['type'] == 'blob' and parts[2].endswith('.sqlite'):
+                countries.setdefault(parts[1], []).append({
+                    "name": parts[2], "path": i['path'], "sha": i['sha'], "size": i.get('size', 0),
+                    "download_url": f"{REPO_API}/git/blobs/{i['sha']}", "country_name": parts[1]
+                })
+            elif len(parts) == 3 and parts[0] == 'db' and i['type'] == 'blob' and is_sidecar(parts[2]):
+                sidecars[i['path']] = (i['sha'], f"{REPO_API}/git/blobs/{i['sha']}", i.get('size', 0))
+        for files in countries.values(): attach_sidecars(files, sidecars)
+        return countries
+
+    def _listing(self):
+        """{country: [file_info]}, or None if the tree is unavailable (use the directory listings)."""
+        return self._listing_at()[1]
+
+    def _listing_at(self):
+        """
+        (branch head commit, tree listing), cached by head commit. The head is
+        re-checked at most every LISTING_TTL seconds, and the tree is only
+        re-fetched when it moved. A truncated tree is remembered for its commit
+        as None, so callers go straight to the directory listings until the
+        head moves. The listing is shared: one worker process checks, the
+        others reuse it.
+        """
+        with self._tree_lock:
+            if self._tree and time.time() - self._tree_checked < LISTING_TTL:
+                return self._tree['commit'], self._tree['countries']
+            with self._shared.lock:
+                # Another worker may have checked while this one waited for the lock
+                shared = self._shared.load()
+                if shared and time.time() - shared['checked'] < LISTING_TTL:
+                    self._tree, self._tree_checked = shared['tree'], shared['checked']
+                    return self._tree['commit'], self._tree['countries']
+                try:
+                    commit = self._head_commit()
+                    if commit and not (self._tree and self._tree['commit'] == commit):
+                        self._tree = {"commit": commit, "countries": self._fetch_tree(commit)}
+                    if commit:
+                        self._tree_checked = time.time()
+                        self._shared.save({"tree": self._tree, "checked": self._tree_checked})
+                except Exception:
+                    self._tree = None
+                return (self._tree['commit'], self._tree['countries']) if self._tree else (None, None)
+
+    def invalidate_listing(self):
+        with self._tree_lock:
+            self._tree_checked = 0
+            with self._shared.lock: self._shared.clear()
+
+    def _contents(self, folder):
+        """
+        Directory listing through the contents API, None if the folder does not
+        exist. Any other failure raises StorageError: an empty list would read
+        as an empty fleet.
+        """
+        try: r = GH.get(f"{API_BASE}/{folder}", conditional=True, timeout=10)
+        except requests.RequestException as e: raise StorageError(f"Listing {folder} failed: {scan_error(e)}")
+        if r.status_code == 404: return None
+        if r.status_code != 200: raise StorageError(f"Listing {folder} failed: {http_error(r)}", r.status_code)
+        return r.json()
+
+    def list_countries(self):
+        tree = self._listing()
+        if tree is not None: return sorted(tree)
+        return [i['name'] for i in self._contents("db") or [] if i['type'] == 'dir']
+
+    def list_files(self, country):
+        tree = self._listing()
+        if tree is not None: return [dict(f) for f in tree.get(country, [])]
+        items = self._contents(f"db/{country}") or []
+        sidecars = {i['path']: (i['sha'], i['download_url'], i['size']) for i in items if is_sidecar(i['name'])}
+        return attach_sidecars([dict(i) for i in items if i['name'].endswith('.sqlite')], sidecars)
+
+    def list_all(self):
+        """Every city file in every country, tagged with country_name."""
+        tree = self._listing()
+        if tree is not None:
+            return [dict(f) for c in sorted(tree) for f in tree[c]]
+        all_files = []
+        for c in self.list_countries():
+            for f in self.list_files(c):
+                f['country_name'] = c
+                all_files.append(f)
+        return all_files
+
+    def _download(self, url, gz=False):
+        """
+        Streams a blob straight into the cache (gunzipped on the way if `gz`),
+        so a large city never sits in memory. It is keyed by the SHA of what
+        actually arrived. Returns (path, sha, bytes on the wire).
+        """
+        r = GH.get(url, headers=RAW_HEADERS, timeout=20, stream=True)
+        with r:
+            if r.status_code != 200: raise StorageError(http_error(r), r.status_code)
+            received = 0
+
+            def write(f):
+                nonlocal received
+                unzip = zlib.decompressobj(wbits=31) if gz else None
+                for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                    received += len(chunk)
+                    f.write(unzip.decompress(chunk) if unzip else chunk)
+                if unzip: f.write(unzip.flush())
+            path, sha, _ = BLOB_CACHE.put_stream(write)
+        METRICS.observe("nexus_download_bytes", received)
+        return path, sha, received
+
+    def _snapshot_current(self, file_info):
+        """True if the city's .meta records its .sqlite.gz as a snapshot of this exact DB blob."""
+        if not file_info.get('snapshot_sha'): return False
+        try: snapshot = (self.read_meta(file_info) or {}).get("snapshot") or {}
+        except Exception: return False
+        return snapshot.get("db_sha") == file_info['sha'] and snapshot.get("sha") == file_info['snapshot_sha']
+
+    def _fetch(self, file_info):
+        """(path of the cached copy, bytes downloaded) - nothing is downloaded on a cache hit."""
+        path = BLOB_CACHE.get(file_info['sha'])
+        METRICS.inc("nexus_blob_cache_total", result="hit" if path else "miss")
+        if path: return path, 0
+
+        # A current compressed snapshot is the same DB in a fraction of the bytes
+        if self._snapshot_current(file_info):
+            try:
+                path, sha, received = self._download(file_info['snapshot_url'], gz=True)
+                if sha == file_info['sha']:
+                    METRICS.inc("nexus_snapshot_downloads_total", result="used")
+                    return path, received
+            except (StorageError, zlib.error, EOFError): pass
+            METRICS.inc("nexus_snapshot_downloads_total", result="rejected")
+
+        path, _, received = self._download(file_info['download_url'])
+        return path, received
+
+    def fetch_blob(self, file_info):
+        """Path of the cached copy of this file, downloading it only on a cache miss."""
+        return self._fetch(file_info)[0]
+
+    def prefetch(self, file_info):
+        """Makes sure the file is cached, returns the bytes downloaded."""
+        return self._fetch(file_info)[1]
+
+    def read_meta(self, file_info):
+        """Parsed .meta sidecar of a city (None if it has none), fetched once per blob SHA."""
+        sha = file_info.get('meta_sha')
+        if not sha: return None
+        if sha not in self._metas:
+            r = GH.get(file_info['meta_url'], headers=RAW_HEADERS, timeout=10)
+            if r.status_code != 200: raise StorageError(http_error(r), r.status_code)
+            if len(self._metas) > 10000: self._metas.clear()  # Old SHAs pile up as cities are saved
+            self._metas[sha] = parse_meta(r.content)
+        return self._metas[sha]
+
+    def find_file(self, country, filename):
+        for f in self.list_files(country):
+            if f['name'] == filename: return f
+        return None
+
+    @contextmanager
+    def open_db(self, file_info):
+        """Yields a read-only connection to the cached blob (StorageError if the download failed)."""
+        path = self.fetch_blob(file_info)
+
+        # Cached blobs are shared, never write to them
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro&immutable=1", uri=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _create_blob(self, path):
+        """Uploads a file as a git blob; the base64 body is encoded as it is sent."""
+        r = GH.post(f"{REPO_API}/git/blobs", data=Base64Body(path), timeout=60,
+                    headers={**HEADERS, "Content-Type": "application/json"})
+        if r.status_code != 201: raise StorageError(f"Blob upload failed: {http_error(r)}", r.status_code)
+        return r.json()['sha']
+
+    def commit_files(self, edits_by_file, message):
+        """
+        Applies {(country, filename): [(sql, params)]} and lands every changed
+        file in ONE commit through the git data API.
+        Returns (ok, message, {(country, filename): rows}, {(country, filename): error}).
+        """
+        return self._commit(list(edits_by_file), lambda key, conn: (apply_edits(conn, edits_by_file[key]), True), message)
+
+    def compact(self, keys):
+        """compact_db on every file plus a fresh snapshot of each, in ONE commit."""
+        return self._commit(keys, lambda key, conn: (compact_db(conn), True), f"Compact {len(keys)} DBs", snapshots=True)
+
+    def _commit(self, keys, edit, message, snapshots=False):
+        """
+        Runs edit(key, conn) -> (result, save) on a working copy of each file
+        and commits the saved ones that changed. Blobs are read from and
+        written to the cache on disk and uploaded as streams, never as one
+        inline payload. Each changed DB gets a new .meta in the same commit,
+        and a new .sqlite.gz snapshot if it had one (or `snapshots` is set).
+        If the branch moved in the meantime the ref update is rejected; the
+        edits are then replayed on the new head (rebase) and retried.
+        Files that are missing or fail are left out and reported per file.
+        Returns (ok, message, {key: result}, {key: error}).
+        """
+        for attempt in range(WRITE_MAX_RETRIES):
+            self.invalidate_listing()
+            head, tree = self._listing_at()
+            if head is None: return False, "Branch head lookup failed", {}, {}
+
+            # Without a tree (truncated), each country is listed once through the contents API
+            listed = {}
+            infos, errors = {}, {}
+            for country, filename in keys:
+                if country not in listed:
+                    listed[country] = tree.get(country, []) if tree is not None else self.list_files(country)
+                info = next((f for f in listed[country] if f['name'] == filename), None)
+                if info: infos[(country, filename)] = info
+                else: errors[(country, filename)] = "not found"
+
+            def apply_one(key):
+                info = infos[key]
+                snapshot = None
+                try:
+                    with WRITE_BUDGET.hold(working_copy_bytes(info.get('size', 0))), \
+                         working_copy(self.fetch_blob(info)) as (conn, dump):
+                        result, save = edit(key, conn)
+                        path, sha = dump() if save else (None, info['sha'])
+                        if sha == info['sha']: return key, None, result, None
+                        # Sidecars are rewritten in the same commit, so they always match the new blob
+                        snapshot_entry = None
+                        if snapshots or info.get('snapshot_sha'):
+                            fd, snapshot = tempfile.mkstemp(suffix=".sqlite" + SNAPSHOT_SUFFIX)
+                            os.close(fd)
+                            snapshot_entry = {"db_sha": sha, **write_snapshot(path, snapshot)}
+                        meta = write_meta(self.read_meta(info), db_summary(conn, sha), snapshot_entry)
+                except Exception as e:
+                    if snapshot: os.remove(snapshot)
+                    return key, scan_error(e), None, None
+                return key, None, result, (info['path'], path, meta, snapshot)
+
+            # Country / global batches touch many files: fetch and edit them in parallel.
+            # A broken file is reported and left out instead of sinking the whole batch.
+            results, updates = {}, []
+            with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+                for key, error, result, update in pool.map(apply_one, infos):
+                    if error: errors[key] = error
+                    else:
+                        results[key] = result
+                        if update: updates.append(update)
+
+            if not results: return False, format_errors(errors), results, errors
+            if not updates: return True, with_skipped("Nothing to change", errors), results, errors
+
+            try:
+                r = GH.get(f"{REPO_API}/git/commits/{head}", timeout=10)
+                if r.status_code != 200: return False, f"Commit lookup failed: {http_error(r)}", results, errors
+                base_tree = r.json()['tree']['sha']
+
+                # The edited blobs are already in the cache, so the next scan of them is a hit
+                blobs = [(p, local) for p, local, _, _ in updates]
+                blobs += [(p + SNAPSHOT_SUFFIX, snapshot) for p, _, _, snapshot in updates if snapshot]
+                with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+                    shas = list(pool.map(self._create_blob, [local for _, local in blobs]))
+                entries = [{"path": p, "mode": "100644", "type": "blob", "sha": s} for (p, _), s in zip(blobs, shas)]
+                # .meta sidecars are small JSON, sent inline with the tree
+                entries += [{"path": meta_name(p), "mode": "100644", "type": "blob", "content": m} for p, _, m, _ in updates]
+                r = GH.post(f"{REPO_API}/git/trees", json={"base_tree": base_tree, "tree": entries}, timeout=30)
+                if r.status_code != 201: return False, f"Tree failed: {http_error(r)}", results, errors
+                r = GH.post(f"{REPO_API}/git/commits", json={
+                    "message": message, "tree": r.json()['sha'], "parents": [head]
+                }, timeout=30)
+                if r.status_code != 201: return False, f"Commit failed: {http_error(r)}", results, errors
+
+                r = GH.patch(f"{REPO_API}/git/refs/heads/{GH_BRANCH}", json={"sha": r.json()['sha'], "force": False}, timeout=30)
+                if r.status_code == 200:
+                    self.invalidate_listing()
+                    return True, with_skipped("Saved", errors), results, errors
+                if r.status_code != 422: return False, f"Ref update failed: {http_error(r)}", results, errors
+                # 422 = not a fast-forward, someone else pushed: replay on the new head
+            finally:
+                for _, _, _, snapshot in updates:
+                    if snapshot: os.remove(snapshot)
+
+        return False, "Branch kept moving, gave up after retries", {}, {}
+
+class LocalStorage:
+    """
+    Opens db/<Country>/<City>.sqlite in place from a local checkout.
+    Scans use read-only connections, edits are serialised per file
+    (SQLite's own file lock covers other processes).
+    """
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._sha_memo = {}
+
+    def _path(self, country, filename=None):
+        if not safe_name(country) or (filename is not None and not safe_name(filename)):
+            return None
+        if filename is None: return os.path.join(self.root, country)
+        return os.path.join(self.root, country, filename)
+
+    def _lock(self, path):
+        with self._locks_guard:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def _sha(self, path):
+        """
+        Git blob SHA of the file. Commits a scraper made in WAL mode are not in
+        the main file until a checkpoint, so a non-empty -wal's size and mtime
+        are folded into the SHA: the city then counts as changed right away.
+        """
+        # Re-hash only when the file changed on disk
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        memo = self._sha_memo.get(path)
+        if memo and memo[0] == key: sha = memo[1]
+        else:
+            sha = git_blob_sha_file(path)
+            self._sha_memo[path] = (key, sha)
+        try: wal = os.stat(path + "-wal")
+        except OSError: return sha
+        if not wal.st_size: return sha
+        return hashlib.sha1(f"{sha}:{wal.st_size}:{wal.st_mtime_ns}".encode()).hexdigest()
+
+    def list_countries(self):
+        try:
+            return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+        except OSError as e: raise StorageError(f"Listing failed: {e}")
+
+    def list_files(self, country):
+        folder = self._path(country)
+        if not folder: return []
+        try: names = sorted(os.listdir(folder))
+        except FileNotFoundError: return []
+        except OSError as e: raise StorageError(f"Listing {country} failed: {e}")
+
+        files = []
+        for n in names:
+            if not n.endswith('.sqlite'): continue
+            path = os.path.join(folder, n)
+            files.append({
+                "name": n, "path": f"db/{country}/{n}",
+                "size": os.path.getsize(path), "sha": self._sha(path),
+                "local_path": path
+            })
+            if meta_name(n) in names: files[-1]['meta_path'] = meta_name(path)
+            if n + SNAPSHOT_SUFFIX in names: files[-1]['snapshot_size'] = os.path.getsize(path + SNAPSHOT_SUFFIX)
+        return files
+
+    def list_all(self):
+        all_files = []
+        for c in self.list_countries():
+            for f in self.list_files(c):
+                f['country_name'] = c
+                all_files.append(f)
+        return all_files
+
+    def commit_files(self, edits_by_file, message):
+        """Applies each file's edits in one transaction under its lock, files in parallel."""
+        paths, errors = {}, {}
+        for country, filename in edits_by_file:
+            path = self._path(country, filename)
+            if path and os.path.exists(path): paths[(country, filename)] = path
+            else: errors[(country, filename)] = "not found"
+
+        def apply_one(key):
+            with self._lock(paths[key]):
+                conn = sqlite3.connect(paths[key], timeout=30)
+                try: rows = apply_edits(conn, edits_by_file[key])
+                except Exception as e: return key, scan_error(e)
+                finally: conn.close()
+                if rows: self._update_meta(paths[key])
+                return key, rows
+
+        counts = {}
+        with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+            for key, rows in pool.map(apply_one, paths):
+                if isinstance(rows, str): errors[key] = rows
+                else: counts[key] = rows
+        if not counts: return False, format_errors(errors), counts, errors
+        return True, with_skipped("Saved", errors), counts, errors
+
+    def fetch_blob(self, file_info):
+        return file_info['local_path']
+
+    def read_meta(self, file_info):
+        if not file_info.get('meta_path'): return None
+        try:
+            with open(file_info['meta_path'], "rb") as f: return parse_meta(f.read())
+        except OSError: return None
+
+    def _update_meta(self, path, snapshot=False):
+        """
+        Rewrites the .meta next to a DB that was just saved, and its
+        .sqlite.gz if it has one (or `snapshot` is set). The caller holds its lock.
+        """
+        meta_path = meta_name(path)
+        try:
+            sha = self._sha(path)
+            # Read-write on purpose: a read-only connection leaves -wal / -shm files behind
+            conn = sqlite3.connect(path, timeout=30)
+            try: summary = db_summary(conn, sha)
+            finally: conn.close()
+
+            snapshot_entry = None
+            if snapshot or os.path.exists(path + SNAPSHOT_SUFFIX):
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+                os.close(fd)
+                snapshot_entry = {"db_sha": sha, **write_snapshot(path, tmp_path)}
+                replace_keeping_mode(tmp_path, path + SNAPSHOT_SUFFIX)
+
+            old = self.read_meta({'meta_path': meta_path}) if os.path.exists(meta_path) else None
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+            with os.fdopen(fd, "w", encoding="utf-8") as f: f.write(write_meta(old, summary, snapshot_entry))
+            replace_keeping_mode(tmp_path, meta_path)
+        except (OSError, sqlite3.Error): pass  # A missing summary only means the next scan opens the DB
+
+    def compact(self, keys):
+        """compact_db on every file in place, each followed by a fresh snapshot."""
+        def one(key):
+            path = self._path(*key)
+            if not path or not os.path.exists(path): return key, "not found"
+            with self._lock(path):
+                conn = sqlite3.connect(path, timeout=30)
+                try: compact_db(conn)
+                except Exception as e: return key, scan_error(e)
+                finally: conn.close()
+                self._update_meta(path, snapshot=True)
+            return key, None
+
+        done, errors = {}, {}
+        with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+            for key, error in pool.map(one, keys):
+                if error: errors[key] = error
+                else: done[key] = None
+        if not done: return False, format_errors(errors), done, errors
+        return True, with_skipped("Saved", errors), done, errors
+
+    def prefetch(self, file_info):
+        return 0  # Already on disk
+
+    def find_file(self, country, filename):
+        for f in self.list_files(country):
+            if f['name'] == filename: return f
+        return None
+
+    @contextmanager
+    def open_db(self, file_info):
+        """
+        Yields a read-only connection to the file in place. Opened read-write
+        with query_only, not mode=ro: only a writable last connection removes
+        a WAL-format DB's -wal / -shm files when it closes.
+        """
+        conn = sqlite3.connect(file_info['local_path'], timeout=30)
+        conn.execute("PRAGMA query_only=1")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+def make_storage():
+    if STORAGE_MODE == "local":
+        return LocalStorage(LOCAL_ROOT)
+    return GitHubStorage()
+
+STORAGE = make_storage()
+
+# ---------------------------------------------------------
+# ANALYTICS ENGINE (MULTI-THREADED)
+# ---------------------------------------------------------
+def get_folders():
+    return STORAGE.list_countries()
+
+def get_files_in_country(country):
+    return STORAGE.list_files(country)
+
+VELOCITY_WINDOWS = {"m1": 60, "m5": 300, "h1": 3600, "h24": 86400}
+
+def velocity(recent, now):
+    """Counts per velocity window from a sorted list of updated_at timestamps."""
+    return {k: len(recent) - bisect_left(recent, now - secs) for k, secs in VELOCITY_WINDOWS.items()}
+
+ATTEMPTS_CAP = 5  # Attempts histogram buckets: 0, 1, ..., 4, 5+
+
+def minute_series(times):
+    """Timestamps -> (end of each minute, running count up to it), what retry_backlog bisects."""
+    ends, running = [], []
+    for n, t in enumerate(sorted(times), 1):
+        end = t - t % 60 + 59
+        if ends and ends[-1] == end: running[-1] = n
+        else:
+            ends.append(end)
+            running.append(n)
+    return ends, running
+
+def retry_backlog(data, now):
+    """(due now, due within the next hour) for one scan result, re-evaluated at `now`."""
+    times, running = data["retry_times"], data["retry_cum"]
+    passed = lambda t: running[bisect_right(times, t) - 1] if times and times[0] <= t else 0
+    return data["retry_due"] + passed(now), passed(now + 3600) - passed(now)
+
+def empty_stats():
+    return {
+        "total": 0, "pending": 0, "success": 0, "failed": 0,
+        "m1": 0, "m5": 0, "h1": 0, "h24": 0, "country": "Unknown", "recent": [],
+        "retry_due": 0, "retry_times": [], "retry_cum": [], "attempts": {}, "niches": {},
+        "error": None, "timings": {}, "source": "scan"
+    }
+
+def extract_stats(conn, now=None):
+    """
+    Everything the dashboard knows about one DB, from a single pass over
+    `domains`: status counts, updated_at within 24h (velocity), the retry
+    queue, an attempts histogram and status counts per niche.
+    Retries that are not due yet are kept per minute, so an unchanged city
+    can be re-evaluated later without opening the DB again (see retry_backlog).
+    """
+    now = now or int(time.time())
+    stats = empty_stats()
+    recent, upcoming = [], []
+    rows = conn.execute("""
+        SELECT status, niche, min(coalesce(attempts, 0), ?), count(*),
+               sum(status != 'success' AND next_retry_at <= ?),
+               group_concat(CASE WHEN status != 'success' AND next_retry_at > ? THEN next_retry_at END),
+               group_concat(CASE WHEN updated_at >= ? THEN updated_at END)
+        FROM domains GROUP BY 1, 2, 3
+    """, (ATTEMPTS_CAP, now, now, now - 86400))
+    for status, niche, attempts, count, due, retry_at, updated in rows:
+        stats[status] = stats.get(status, 0) + count
+        stats["total"] += count
+        stats["retry_due"] += due or 0
+        bucket = f"{attempts}+" if attempts == ATTEMPTS_CAP else str(attempts)
+        stats["attempts"][bucket] = stats["attempts"].get(bucket, 0) + count
+        per_niche = stats["niches"].setdefault(niche or "(none)", {})
+        per_niche[status] = per_niche.get(status, 0) + count
+        if retry_at: upcoming += map(int, retry_at.split(","))
+        if updated: recent += map(int, updated.split(","))
+
+    # Keep the raw timestamps so a cached result can be re-bucketed later
+    stats["recent"] = sorted(recent)
+    stats.update(velocity(stats["recent"], now))
+    stats["retry_times"], stats["retry_cum"] = minute_series(upcoming)
+    return stats
+
+def scan_error(e):
+    """Short per-file label for why a scan failed."""
+    if isinstance(e, StorageError): return str(e)
+    if isinstance(e, requests.Timeout): return "timeout"
+    if isinstance(e, requests.RequestException): return f"network: {type(e).__name__}"
+    if isinstance(e, sqlite3.DatabaseError): return f"corrupt DB: {e}"
+    return str(e)
+
+def error_category(e):
+    """Coarse label for the scan error counters: http_<status>, rate_limited, timeout, network, corrupt_db or other."""
+    if isinstance(e, StorageError) and e.status:
+        return "rate_limited" if "rate limited" in str(e) else f"http_{e.status}"
+    if isinstance(e, requests.Timeout): return "timeout"
+    if isinstance(e, requests.RequestException): return "network"
+    if isinstance(e, sqlite3.DatabaseError): return "corrupt_db"
+    return "other"
+
+def failed_stats(e, timings=None):
+    """Zeroed stats for a city whose scan raised `e`, counted by error category."""
+    METRICS.inc("nexus_scan_errors_total", category=error_category(e))
+    stats = empty_stats()
+    stats["error"] = scan_error(e)
+    stats["timings"] = timings or {}
+    return stats
+
+SLOW_SCANS = deque(maxlen=SLOW_LOG_SIZE)
+
+def record_scan(file_info, data):
+    """Feeds one finished city into the scan histograms and the slow-scan log."""
+    t = data["timings"]
+    seconds = t.get("download", 0) + t.get("query", 0)
+    METRICS.observe("nexus_scan_city_seconds", seconds)
+    if seconds < SLOW_SCAN_SECONDS: return
+    METRICS.inc("nexus_scan_slow_total")
+    entry = {"at": time.time(), "file": f"{file_info['country_name']}/{file_info['name']}",
+             "size": file_info.get('size'), "error": data["error"], **t}
+    SLOW_SCANS.append(entry)
+    print(f"SLOW SCAN: {entry['file']} {seconds:.1f}s (download {t.get('download', 0):.1f}s, "
+          f"query {t.get('query', 0):.1f}s, {t.get('bytes', 0) / 1048576:.1f} MB)")
+
+def scan_single_db(file_info):
+    """
+    Opens a single DB through the storage backend, queries stats, and returns them.
+    Used by the scan pipeline once the file has been fetched.
+    """
+    started = time.monotonic()
+    
+    try:
+        with STORAGE.open_db(file_info) as conn:
+            stats = extract_stats(conn)
+        
+    # Report why a city shows zeros instead of hiding it
+    except Exception as e: stats = failed_stats(e)
+
+    stats["timings"]["query"] = time.monotonic() - started
+    METRICS.observe("nexus_scan_phase_seconds", stats["timings"]["query"], phase="query")
+    return stats
+
+# ---------------------------------------------------------
+# CITY SUMMARIES (.meta SIDECARS)
+# ---------------------------------------------------------
+# db/<Country>/<City>.meta sits next to the DB. The scrapers keep their own
+# counters there ({"succ": ..., "fail": ...}); the dashboard adds a "summary"
+# key tied to the DB's blob SHA and leaves everything else alone.
+META_VERSION = 2
+
+def parse_meta(content):
+    try: meta = json.loads(content)
+    except ValueError: return None
+    return meta if isinstance(meta, dict) else None
+
+def per_minute_counts(recent):
+    """Sorted updated_at timestamps -> [(minute, updates)], the compact form .meta and shared state keep."""
+    per_minute = {}
+    for t in recent: per_minute[t - t % 60] = per_minute.get(t - t % 60, 0) + 1
+    return sorted(per_minute.items())
+
+def recent_from_counts(per_minute):
+    # Each update counts as the end of its minute, so velocity is exact to the minute
+    return [m + 59 for m, n in per_minute for _ in range(n)]
+
+def db_summary(conn, db_sha, now=None):
+    """
+    What a .meta summary holds: extract_stats() in compact form - status
+    counts, per-minute updates over the last 24h, the retry queue, the
+    attempts histogram and the niche breakdown.
+    """
+    now = now or int(time.time())
+    stats = extract_stats(conn, now)
+    status = {}
+    for per_niche in stats["niches"].values():
+        for s, count in per_niche.items(): status[s] = status.get(s, 0) + count
+    return {
+        "version": META_VERSION, "db_sha": db_sha, "generated_at": now,
+        "rows": stats["total"], "status": status,
+        "velocity": {k: stats[k] for k in VELOCITY_WINDOWS},
+        "updated_per_minute": per_minute_counts(stats["recent"]),
+        "retry_due": stats["retry_due"], "retry_per_minute": list(zip(stats["retry_times"], stats["retry_cum"])),
+        "attempts": stats["attempts"], "niches": stats["niches"]
+    }
+
+def write_meta(old, summary, snapshot=None):
+    """Sidecar JSON with `summary` and `snapshot` swapped in and the scrapers' keys kept."""
+    meta = {k: v for k, v in (old or {}).items() if k != "snapshot"}
+    meta["summary"] = summary
+    if snapshot: meta["snapshot"] = snapshot
+    return json.dumps(meta)
+
+def stats_from_meta(meta, file_info):
+    """Scan-equivalent stats from a .meta summary, or None if it is missing or stale."""
+    summary = (meta or {}).get("summary")
+    if not isinstance(summary, dict) or summary.get("version") != META_VERSION: return None
+    if not file_info.get('sha') or summary.get("db_sha") != file_info['sha']: return None
+
+    stats = empty_stats()
+    for s, count in summary["status"].items():
+        stats[s] = count
+    stats["total"] = summary["rows"]
+    stats["recent"] = recent_from_counts(summary["updated_per_minute"])
+    stats.update(velocity(stats["recent"], int(time.time())))
+    stats["retry_due"] = summary["retry_due"]
+    stats["retry_times"] = [t for t, _ in summary["retry_per_minute"]]
+    stats["retry_cum"] = [n for _, n in summary["retry_per_minute"]]
+    stats["attempts"], stats["niches"] = summary["attempts"], summary["niches"]
+    stats["source"] = "meta"
+    return stats
+
+# ---------------------------------------------------------
+# ASYNC SCAN PIPELINE (ADAPTIVE CONCURRENCY)
+# ---------------------------------------------------------
+class AdaptiveLimiter:
+    """
+    AIMD window for concurrent downloads. Grows by one while downloads come
+    back under the target latency, halves on errors, slow responses or a
+    low rate-limit budget. Also caps the bytes in flight (one file is
+    always allowed, so a file larger than the budget still gets through).
+
+    Waiting downloads are admitted largest first; smaller ones fill in
+    whatever byte budget is left, so the long tail starts early and the
+    budget is never wasted behind one big file.
+    """
+
+    def __init__(self, start, lo, hi, target_latency, mem_budget):
+        self.limit = start
+        self.lo, self.hi = lo, hi
+        self.target_latency = target_latency
+        self.mem_budget = mem_budget
+        self.in_flight = 0
+        self.bytes_in_flight = 0
+        self._waiting = []  # (-size, seq, future), largest first
+        self._seq = itertools.count()
+
+    def _fits(self, size):
+        if self.in_flight == 0: return True
+        return self.in_flight < self.limit and self.bytes_in_flight + size <= self.mem_budget
+
+    def _admit(self):
+        waiting = []
+        for entry in self._waiting:
+            size, fut = -entry[0], entry[2]
+            if fut.done(): continue  # Cancelled while waiting
+            if self._fits(size):
+                self.in_flight += 1
+                self.bytes_in_flight += size
+                fut.set_result(None)
+            else:
+                waiting.append(entry)
+        self._waiting = waiting
+
+    async def acquire(self, size):
+        fut = asyncio.get_running_loop().create_future()
+        insort(self._waiting, (-size, next(self._seq), fut))
+        self._admit()
+        await fut
+
+    def release(self, size, latency, ok):
+        self.in_flight -= 1
+        self.bytes_in_flight -= size
+        remaining = GH.rate_limit_remaining if STORAGE.name == "github" else None
+        if not ok or latency > self.target_latency * 2 or (remaining is not None and remaining < SCAN_RATE_LIMIT_FLOOR):
+            self.limit = max(self.lo, self.limit // 2)
+        elif latency < self.target_latency:
+            self.limit = min(self.hi, self.limit + 1)
+        self._admit()
+
+async def scan_files_async(files, on_result):
+    """
+    Fetches and scans `files`, calling on_result(file_info, stats) as each
+    city finishes. Downloads run under the adaptive limiter on an I/O pool,
+    SQLite queries on a CPU-sized pool, so the two phases overlap.
+    """
+    loop = asyncio.get_running_loop()
+    limiter = AdaptiveLimiter(SCAN_CFG.get("START_WORKERS", 8), SCAN_CFG.get("MIN_WORKERS", 2),
+                              SCAN_MAX_WORKERS, SCAN_CFG.get("TARGET_LATENCY", 2.0),
+                              SCAN_CFG.get("MEMORY_MB", 256) * 1024 * 1024)
+
+    with ThreadPoolExecutor(max_workers=SCAN_MAX_WORKERS) as io_pool, \
+         ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as query_pool:
+
+        async def one(f):
+            # A current .meta summary answers for the city without downloading it
+            if f.get('meta_sha') or f.get('meta_path'):
+                started = time.monotonic()
+                try: data = stats_from_meta(await loop.run_in_executor(io_pool, STORAGE.read_meta, f), f)
+                except Exception: data = None  # Unreadable sidecar: scan the DB instead
+                METRICS.inc("nexus_meta_summaries_total", result="hit" if data else "miss")
+                if data:
+                    data["timings"]["meta"] = time.monotonic() - started
+                    on_result(f, data)
+                    return
+
+            size = f.get('size') or 0
+            await limiter.acquire(size)
+            started, error, downloaded = time.monotonic(), None, 0
+            try:
+                downloaded = await loop.run_in_executor(io_pool, STORAGE.prefetch, f)
+            except Exception as e:
+                error = e
+            finally:
+                latency = time.monotonic() - started
+                limiter.release(size, latency, error is None)
+            METRICS.observe("nexus_scan_phase_seconds", latency, phase="download")
+
+            timings = {"download": latency, "bytes": downloaded}
+            if error:
+                data = failed_stats(error, timings)
+            else:
+                data = await loop.run_in_executor(query_pool, scan_single_db, f)
+                data["timings"].update(timings)
+            record_scan(f, data)
+            on_result(f, data)
+
+        # Largest first: the biggest cities set the length of the run
+        await asyncio.gather(*(one(f) for f in sorted(files, key=lambda f: f.get('size') or 0, reverse=True)))
+
+def get_global_analytics(previous=None, on_progress=None):
+    """
+    Scans ALL databases in ALL countries through the async pipeline.
+    Files whose blob SHA matches an entry in `previous` are not scanned again;
+    changed ones keep their previous result until the new one arrives.
+    on_progress(per_file, done, total) is called as each city finishes.
+    Returns aggregated data for the Dashboard plus the per-file results.
+    """
+    previous = previous or {}
+
+    # 1. Collect all files first (one tree listing on GitHub)
+    with METRICS.timer("nexus_scan_phase_seconds", phase="listing"):
+        countries = get_folders()
+        all_files = STORAGE.list_all()
+
+    per_file = {}
+    changed = []
+    for f in all_files:
+        old = previous.get(f['path'])
+        if old: per_file[f['path']] = old
+        if not (old and f.get('sha') and old['sha'] == f['sha']): changed.append(f)
+
+    # 2. Parallel Scan, results streamed in as each city finishes
+    done = 0
+    def collect(f_info, data):
+        nonlocal done
+        done += 1
+        per_file[f_info['path']] = {
+            # No SHA on failure, so the next refresh retries this file
+            "sha": None if data["error"] else f_info.get('sha'),
+            "country": f_info['country_name'], "name": f_info['name'], "stats": data
+        }
+        if on_progress: on_progress(per_file, done, len(changed))
+
+    if changed: asyncio.run(scan_files_async(changed, collect))
+
+    global_stats, country_breakdown = aggregate(per_file)
+    return global_stats, countries, country_breakdown, per_file
+
+def aggregate(per_file, now=None):
+    """Rolls per-file scan results up into global and per-country totals."""
+    started = time.monotonic()
+    now = now or int(time.time())
+    global_stats = {
+        "total": 0, "pending": 0, "success": 0, "failed": 0,
+        "m1": 0, "m5": 0, "h1": 0, "h24": 0,
+        "retry_due": 0, "retry_next_hour": 0, "attempts": {}, "niches": {},
+        "cities_count": len(per_file), "errors": []
+    }
+    country_breakdown = {}
+
+    for path in sorted(per_file):
+        entry = per_file[path]
+        data = entry["stats"]
+        vel = velocity(data["recent"], now)
+        due, next_hour = retry_backlog(data, now)
+        if data["error"]:
+            global_stats["errors"].append((f"{entry['country']}/{entry['name']}", data["error"]))
+
+        # Aggregate Global
+        for k in ("total", "pending", "success", "failed"):
+            global_stats[k] += data[k]
+        for k in VELOCITY_WINDOWS:
+            global_stats[k] += vel[k]
+        global_stats["retry_due"] += due
+        global_stats["retry_next_hour"] += next_hour
+        for bucket, count in data["attempts"].items():
+            global_stats["attempts"][bucket] = global_stats["attempts"].get(bucket, 0) + count
+        for niche, per_status in data["niches"].items():
+            totals = global_stats["niches"].setdefault(niche, {})
+            for s, count in per_status.items(): totals[s] = totals.get(s, 0) + count
+
+        # Aggregate Country
+        c_name = entry["country"]
+        if c_name not in country_breakdown:
+            country_breakdown[c_name] = {"total": 0, "success": 0, "retry_due": 0}
+        country_breakdown[c_name]["total"] += data["total"]
+        country_breakdown[c_name]["success"] += data["success"]
+        country_breakdown[c_name]["retry_due"] += due
+
+    METRICS.observe("nexus_scan_phase_seconds", time.monotonic() - started, phase="aggregate")
+    return global_stats, country_breakdown
+
+# ---------------------------------------------------------
+# BACKGROUND AGGREGATION (STALE-WHILE-REVALIDATE)
+# ---------------------------------------------------------
+class AnalyticsEngine:
+    """
+    Keeps the latest dashboard snapshot in memory and refreshes it on a
+    background thread, rescanning only the cities whose SHA changed.
+    Page views read the snapshot and never start a scan themselves.
+
+    With several worker processes only the one holding the `shared` lock
+    (the leader) scans; it saves every snapshot to `shared` and the others
+    load it from there. If the leader exits, the next worker takes over.
+    """
+
+    SHARE_PARTIAL_SECONDS = 5
+    SHARE_FORMAT = 2  # Bumped when the shared state changes shape; older files are ignored
+
+    def __init__(self, interval, shared):
+        self.interval = interval
+        self.shared = shared
+        self._shared_at = 0
+        self._requests = SharedState(f"{shared.name}-requests")  # trigger() from any worker
+        self.leading = False
+        self.refresh_started = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self.refreshing = False
+        self.snapshot = None
+        self.per_file = {}
+        self.progress = None
+        self.last_error = None
+        self.listeners = []  # fn(all_files), run on the refresher thread after each refresh
+        self._changed = threading.Condition()
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._run, name="analytics-refresher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if self._lead():
+                self.refresh()
+                self._sleep(self.interval)
+            else:
+                self._follow()
+                self._sleep(1)
+
+    def _lead(self):
+        if not self.leading and self.shared.lock.acquire(blocking=False):
+            self.leading = True
+            self._follow()  # Carry on from the previous leader's results
+        return self.leading
+
+    def _follow(self):
+        """Adopts the leader's latest state, if it changed since the last look."""
+        state = self.shared.load(if_changed=True)
+        # Left by an older version (e.g. mid rolling restart): wait for the leader's next save
+        if not state or state.get("format") != self.SHARE_FORMAT: return
+        for entry in state["per_file"].values():
+            entry["stats"]["recent"] = recent_from_counts(entry["stats"].pop("updated_per_minute"))
+        self.per_file = state["per_file"]
+        self.refreshing, self.progress, self.last_error = state["refreshing"], state["progress"], state["last_error"]
+        if state["snapshot"]:
+            self.snapshot = state["snapshot"]
+            with self._changed: self._changed.notify_all()
+        if state["snapshot"] or not state["refreshing"]: self._ready.set()
+
+    def _share(self, partial=False):
+        """Saves the state for the other workers; partial results at most every SHARE_PARTIAL_SECONDS."""
+        if partial and time.monotonic() - self._shared_at < self.SHARE_PARTIAL_SECONDS: return
+        self._shared_at = time.monotonic()
+        # Raw updated_at lists are most of the size: shared as per-minute counts, like in .meta
+        per_file = {p: {**e, "stats": {**{k: v for k, v in e["stats"].items() if k != "recent"},
+                                       "updated_per_minute": per_minute_counts(e["stats"]["recent"])}}
+                    for p, e in self.per_file.items()}
+        try:
+            self.shared.save({
+                "format": self.SHARE_FORMAT, "snapshot": self.snapshot, "per_file": per_file, "refreshing": self.refreshing,
+                "progress": self.progress, "last_error": self.last_error
+            })
+        except OSError as e:
+            self.last_error = f"Shared snapshot not saved: {e}"
+
+    def _sleep(self, seconds):
+        """Waits up to `seconds`; trigger() cuts it short, in any worker while leading."""
+        deadline = time.monotonic() + seconds
+        while not self._wake.wait(min(1, max(0, deadline - time.monotonic()))):
+            if time.monotonic() >= deadline: break
+            if self.leading and self._requests.modified() > self.refresh_started: break
+        self._wake.clear()
+
+    def _publish(self, global_stats, countries, breakdown, progress=None):
+        version = (self.snapshot["version"] + 1) if self.snapshot else 1
+        # Swapped in one assignment, readers always see a complete snapshot
+        self.snapshot = {
+            "version": version, "refreshed_at": time.time(),
+            "global_stats": global_stats, "countries": countries,
+            "country_breakdown": breakdown, "progress": progress
+        }
+        self._share(partial=progress is not None)
+        self._ready.set()
+        with self._changed: self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        """Blocks until a snapshot newer than `version` is published (or timeout), returns the latest."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.snapshot and self.snapshot["version"] != version, timeout)
+        return self.snapshot
+
+    def refresh(self):
+        self.refresh_started = time.time()
+        self.refreshing = True
+        self.progress = None
+        last_publish = time.monotonic()
+        countries = []
+
+        def on_progress(per_file, done, total):
+            # Stream partial results, at most once a second
+            nonlocal last_publish
+            self.progress = (done, total)
+            if done < total and time.monotonic() - last_publish >= 1:
+                last_publish = time.monotonic()
+                self.per_file = dict(per_file)  # Live API / stream see partial results too
+                global_stats, breakdown = aggregate(self.per_file)
+                self._publish(global_stats, countries, breakdown, (done, total))
+
+        try:
+            # A failed listing raises: the previous snapshot stays up with last_error set
+            countries = get_folders()
+            global_stats, countries, breakdown, per_file = get_global_analytics(self.per_file, on_progress)
+            self.per_file = per_file
+            self._publish(global_stats, countries, breakdown)
+            self.last_error = None
+
+            # Derived stores catch up on the same (cached) listing
+            files = STORAGE.list_all()
+            for listener in self.listeners:
+                try: listener(files)
+                except Exception as e: self.last_error = f"{getattr(listener, '__qualname__', listener)}: {e}"
+        except Exception as e:
+            self.last_error = str(e)
+        finally:
+            self.refreshing = False
+            self.progress = None
+            self._share()
+            self._ready.set()
+
+    def trigger(self):
+        """Asks for a refresh without waiting for it."""
+        self.start()
+        self._wake.set()
+        if not self.leading: self._requests.save({"requested_at": time.time()})
+
+    def get_snapshot(self):
+        """Latest snapshot; only the very first call waits for a scan."""
+        self.start()
+        self._ready.wait()
+        return self.snapshot
+
+ANALYTICS = AnalyticsEngine(DASHBOARD_CFG.get("REFRESH_SECONDS", 60), SharedState("analytics"))
+
+def format_age(seconds):
+    seconds = int(seconds)
+    if seconds < 60: return f"{seconds}s"
+    if seconds < 3600: return f"{seconds // 60}m"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+# ---------------------------------------------------------
+# MERGED STORES (ALL CITIES IN ONE LOCAL SQLITE FILE)
+# ---------------------------------------------------------
+class MergedStore:
+    """
+    Base for local SQLite files that merge rows from every city DB, tagged
+    with country / city. sync() only re-reads files whose blob SHA changed
+    and drops files that disappeared. Subclasses define TABLE, COLUMNS
+    (read from `domains`), EXTRA_SCHEMA and optionally transform().
+    """
+
+    TABLE = None
+    COLUMNS = ()
+    EXTRA_SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        cols = ", ".join(self.COLUMNS)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")  # Readers never wait for a sync
+            conn.executescript(f"""
+                CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, country TEXT, city TEXT, sha TEXT, rows INTEGER, synced_at INTEGER);
+                CREATE TABLE IF NOT EXISTS {self.TABLE} ({cols}, path TEXT, country TEXT, city TEXT);
+                CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_path ON {self.TABLE}(path);
+            """ + self.EXTRA_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self, readonly=False):
+        if readonly:
+            conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro", uri=True, timeout=30)
+        else:
+            conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def transform(self, row):
+        return tuple(row)
+
+    def sync(self, files):
+        """
+        Re-merges files whose SHA changed and drops files that disappeared.
+        An empty listing leaves a populated store as it is.
+        """
+        cols = ", ".join(self.COLUMNS)
+        insert = f"INSERT INTO {self.TABLE} ({cols}, path, country, city) VALUES ({', '.join('?' * (len(self.COLUMNS) + 3))})"
+        with self._lock:
+            conn = self._connect()
+            try:
+                indexed = dict(conn.execute("SELECT path, sha FROM files").fetchall())
+                listed = {f['path']: f for f in files}
+                # Far likelier a listing that came back empty than a fleet deleted in one go
+                if indexed and not listed: return
+
+                for path in set(indexed) - set(listed):
+                    conn.execute(f"DELETE FROM {self.TABLE} WHERE path=?", (path,))
+                    conn.execute("DELETE FROM files WHERE path=?", (path,))
+                conn.commit()
+
+                for path, f in listed.items():
+                    if f.get('sha') and indexed.get(path) == f['sha']: continue
+                    try:
+                        with STORAGE.open_db(f) as src:
+                            rows = src.execute(f"SELECT {cols} FROM domains").fetchall()
+                    except Exception: continue  # Broken / missing file, retried on the next sync
+
+                    city = f['name'].replace(".sqlite", "")
+                    conn.execute(f"DELETE FROM {self.TABLE} WHERE path=?", (path,))
+                    conn.executemany(insert, [self.transform(r) + (path, f['country_name'], city) for r in rows])
+                    conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                 (path, f['country_name'], city, f['sha'], len(rows), int(time.time())))
+                    conn.commit()
+            finally:
+                conn.close()
+
+    def coverage(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT count(*) AS files, coalesce(sum(rows), 0) AS rows, max(synced_at) AS synced_at FROM files").fetchone()
+        finally:
+            conn.close()
+
+# ---------------------------------------------------------
+# CROSS-CITY SEARCH INDEX
+# ---------------------------------------------------------
+class SearchIndex(MergedStore):
+    """
+    Every city's domains in one lookup table. Lookups are prefix range scans
+    on B-tree indexes over the (lowercased) domain and the niche.
+    """
+
+    TABLE = "entries"
+    COLUMNS = ("id", "domain", "niche", "status")
+    EXTRA_SCHEMA = """
+        CREATE INDEX IF NOT EXISTS idx_entries_domain ON entries(domain);
+        CREATE INDEX IF NOT EXISTS idx_entries_niche ON entries(niche COLLATE NOCASE);
+    """
+
+    def transform(self, row):
+        i, d, n, s = row
+        return (i, d.lower(), n, s)
+
+    def search(self, q, limit=200):
+        """Domains starting with `q` (scheme / www. / path ignored), then niches starting with it."""
+        q = q.strip().lower()
+        for prefix in ("http://", "https://"):
+            if q.startswith(prefix): q = q[len(prefix):]
+        q = q.split("/")[0]
+        if q.startswith("www."): q = q[4:]
+        if not q: return []
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT * FROM entries WHERE domain >= ? AND domain < ? ORDER BY domain LIMIT ?",
+                (q, q + "\uffff", limit)
+            ).fetchall()
+            if len(rows) < limit:
+                rows += conn.execute(
+                    "SELECT * FROM entries WHERE niche >= ? COLLATE NOCASE AND niche < ? COLLATE NOCASE ORDER BY niche, domain LIMIT ?",
+                    (q, q + "\uffff", limit - len(rows))
+                ).fetchall()
+            return [dict(r) for r in rows]
+        finally:
+            conn.close()
+
+    def duplicates(self, limit=500):
+        """Domains that appear in more than one city DB."""
+        conn = self._connect()
+        try:
+            return [dict(r) for r in conn.execute("""
+                SELECT domain, count(DISTINCT path) AS cities, group_concat(country || '/' || city, ', ') AS locations
+                FROM entries GROUP BY domain HAVING cities > 1 ORDER BY cities DESC, domain LIMIT ?
+            """, (limit,))]
+        finally:
+            conn.close()
+
+SEARCH = SearchIndex(os.path.join(CACHE_ROOT, "search.sqlite"))
+ANALYTICS.listeners.append(SEARCH.sync)
+
+# ---------------------------------------------------------
+# CONSOLIDATED ANALYTICS STORE (CROSS-CITY SQL)
+# ---------------------------------------------------------
+class AnalyticsStore(MergedStore):
+    """
+    Full copy of every city's `domains` rows with country / city columns, so
+    cross-city rollups are one indexed SQL query instead of 137 downloads.
+    """
+
+    TABLE = "domains"
+    COLUMNS = ("id", "domain", "niche", "status", "progress", "attempts", "last_result",
+               "last_attempt_at", "next_retry_at", "updated_at")
+    EXTRA_SCHEMA = """
+        CREATE INDEX IF NOT EXISTS idx_domains_country_status ON domains(country, status);
+        CREATE INDEX IF NOT EXISTS idx_domains_niche_status ON domains(niche, status);
+        CREATE INDEX IF NOT EXISTS idx_domains_country_attempts ON domains(country, attempts);
+        CREATE INDEX IF NOT EXISTS idx_domains_updated ON domains(updated_at);
+    """
+
+    # Named rollups behind the /analytics panels
+    REPORTS = {
+        "niche_success": ("Success rate per niche", """
+            SELECT niche, count(*) AS total, sum(status = 'success') AS success,
+                   round(100.0 * sum(status = 'success') / count(*), 1) AS success_pct
+            FROM domains WHERE niche IS NOT NULL GROUP BY niche ORDER BY total DESC"""),
+        "country_status": ("Status per country", """
+            SELECT country, count(*) AS total, sum(status = 'pending') AS pending,
+                   sum(status = 'success') AS success, sum(status = 'failed') AS failed
+            FROM domains GROUP BY country ORDER BY total DESC"""),
+        "attempts_histogram": ("Attempts histogram per country", """
+            SELECT country, coalesce(attempts, 0) AS attempts, count(*) AS domains
+            FROM domains GROUP BY country, coalesce(attempts, 0) ORDER BY country, attempts"""),
+        "city_failure": ("Cities by failure rate", """
+            SELECT country, city, count(*) AS total, sum(status = 'failed') AS failed,
+                   round(100.0 * sum(status = 'failed') / count(*), 1) AS failed_pct
+            FROM domains GROUP BY country, city HAVING total > 0 ORDER BY failed_pct DESC, total DESC"""),
+    }
 
-    <!-- SIDEBAR -->
-    <div class="sidebar">
-        <div class="sidebar-header">
-            <i class="bi bi-hdd-network me-2 text-info"></i> NEXUS DB
-        </div>
-        
-        <div class="nav flex-column">
-            <a href="/" class="nav-link {{ 'active' if page == 'dashboard' }}">
-                <i class="bi bi-speedometer2"></i> Global Dashboard
-            </a>
-            <div class="mt-4 mb-2 px-3 text-uppercase text-white-50" style="font-size: 0.7rem; font-weight: 700;">Countries</div>
-            {% for c in countries %}
-            <a href="/country/{{ c }}" class="nav-link {{ 'active' if selected_country == c }}">
-                <i class="bi bi-geo-alt-fill"></i> {{ c }}
-            </a>
-            {% endfor %}
-        </div>
-    </div>
+    # Ad-hoc SQL comes from any visitor: plain reads only (no PRAGMA, ATTACH, writes)
+    READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
 
-    <!-- MAIN CONTENT -->
-    <div class="main-content">
-        
-        <div class="d-flex justify-content-between align-items-center mb-5">
-            <div>
-                <h2 class="fw-bold m-0 text-dark">{{ title }}</h2>
-                <p class="text-muted m-0">Live GitHub Connection • <span class="text-success fw-bold">● Online</span></p>
-            </div>
-            <a href="/" class="btn btn-primary shadow-sm"><i class="bi bi-arrow-clockwise me-2"></i> Refresh Data</a>
-        </div>
+    def query(self, sql, params=(), limit=1000, timeout=QUERY_SECONDS):
+        """Runs read-only SQL against the merged table -> (columns, rows), stopped after `timeout` seconds."""
+        conn = self._connect(readonly=True)
+        deadline = time.monotonic() + timeout
+        conn.set_authorizer(lambda action, *_: sqlite3.SQLITE_OK if action in self.READ_ACTIONS else sqlite3.SQLITE_DENY)
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)  # Non-zero aborts the statement
+        try:
+            cur = conn.execute(sql, params)
+            cols = [d[0] for d in cur.description or []]
+            return cols, [tuple(r) for r in cur.fetchmany(limit)]
+        except sqlite3.OperationalError as e:
+            if time.monotonic() > deadline: raise sqlite3.OperationalError(f"Query stopped after {timeout}s") from e
+            raise
+        finally:
+            conn.close()
 
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="alert alert-{{ category }} shadow-sm border-0 rounded-3 mb-4">
-                        <i class="bi bi-info-circle-fill me-2"></i> {{ message }}
-                    </div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
+    def report(self, name):
+        return self.query(self.REPORTS[name][1])
 
-        {{ CONTENT | safe }}
-        
-    </div>
+STORE = AnalyticsStore(os.path.join(CACHE_ROOT, "analytics.sqlite"))
+ANALYTICS.listeners.append(STORE.sync)
 
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>
-"""
+# ---------------------------------------------------------
+# HISTORY (ROLLUPS PER MINUTE / HOUR / DAY)
+# ---------------------------------------------------------
+class HistoryStore:
+    """
+    History of every city, recorded after each refresh: status counts
+    (latest sample per bucket, written to every resolution in HISTORY_TIERS)
+    and domains updated per minute, rebuilt for the last 24h each time and
+    summed up into the hour / day tiers. Each resolution has its own
+    retention, so a chart reads a few hundred buckets from one tier instead
+    of counting rows in every DB.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS samples (path TEXT, country TEXT, res INTEGER, bucket INTEGER,
+            total INTEGER, pending INTEGER, success INTEGER, failed INTEGER, retry_due INTEGER,
+            PRIMARY KEY (res, bucket, path));
+        CREATE TABLE IF NOT EXISTS updates (path TEXT, country TEXT, res INTEGER, bucket INTEGER, count INTEGER,
+            PRIMARY KEY (res, path, bucket));
+        CREATE INDEX IF NOT EXISTS idx_samples_country ON samples(country, res, bucket);
+        CREATE INDEX IF NOT EXISTS idx_updates_bucket ON updates(res, bucket);
+        CREATE INDEX IF NOT EXISTS idx_updates_country ON updates(country, res, bucket);
+    """
+    MAX_POINTS = 300  # Per chart; longer ranges are re-bucketed coarser
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._recounted = {}  # path -> blob SHA its minutes were last rebuilt from
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self, readonly=False):
+        if readonly:
+            return sqlite3.connect(f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro", uri=True, timeout=30)
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, per_file, at):
+        """
+        Adds one status sample per city and, for cities whose blob changed,
+        rebuilds the updates per minute over the 24h `recent` covers. A later
+        push can carry updated_at values older than the last record, so those
+        minutes are recounted rather than appended to. Their hour / day
+        buckets overlapping the window are then re-summed from the minute
+        tier, and buckets past their tier's retention are dropped.
+        """
+        at = int(at)
+        closed = at - at % 60           # Minutes before this one are complete
+        window = closed - 86400 + 60    # First whole minute `recent` covers
+        samples, minutes, recounted = [], [], []
+        for path, entry in per_file.items():
+            data = entry["stats"]
+            if data["error"]: continue  # Zeroed stats would chart as a drop to nothing
+            counts = (data["total"], data["pending"], data["success"], data["failed"], retry_backlog(data, at)[0])
+            samples += [(path, entry["country"], res, at - at % res, *counts) for res, _ in HISTORY_TIERS]
+            if entry["sha"] and self._recounted.get(path) == entry["sha"]: continue  # Same blob, same minutes
+            recent, per_minute = data["recent"], {}
+            for t in recent[bisect_left(recent, window):bisect_left(recent, closed)]:
+                per_minute[t - t % 60] = per_minute.get(t - t % 60, 0) + 1
+            minutes += [(path, entry["country"], 60, m, n) for m, n in per_minute.items()]
+            recounted.append((path, window))
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", samples)
+                conn.executemany("DELETE FROM updates WHERE res = 60 AND path = ? AND bucket >= ?", recounted)
+                conn.executemany("INSERT INTO updates VALUES (?, ?, ?, ?, ?)", minutes)
+                for res, _ in HISTORY_TIERS[1:]:
+                    # The minute tier keeps 2+ days, so every bucket touched by the window is still whole there
+                    since = [(path, window - window % res) for path, _ in recounted]
+                    conn.executemany("DELETE FROM updates WHERE res = ? AND path = ? AND bucket >= ?",
+                                     [(res, *p) for p in since])
+                    conn.executemany(f"""
+                        INSERT INTO updates SELECT path, country, {res}, bucket - bucket % {res} AS b, sum(count)
+                        FROM updates WHERE res = 60 AND path = ? AND bucket >= ? GROUP BY b
+                    """, since)
+                for res, days in HISTORY_TIERS:
+                    conn.execute("DELETE FROM samples WHERE res = ? AND bucket < ?", (res, at - days * 86400))
+                    conn.execute("DELETE FROM updates WHERE res = ? AND bucket < ?", (res, at - days * 86400))
+                conn.commit()
+            finally:
+                conn.close()
+            for path, _ in recounted: self._recounted[path] = per_file[path]["sha"]
+
+    def _tier(self, days):
+        """(tier, step) for `days` of history: the finest tier still covering them, at most MAX_POINTS steps."""
+        res = next((r for r, keep in HISTORY_TIERS if keep >= days), HISTORY_TIERS[-1][0])
+        return res, res * -(-days * 86400 // (res * self.MAX_POINTS))
+
+    def series(self, days, country=None):
+        """
+        Fleet-wide (or one country's) trend over the last `days`, one value per
+        step: {"step", "at", "updates", "total", "pending", "success", "failed",
+        "retry_due"}. Status values are None where nothing was sampled.
+        """
+        res, step = self._tier(days)
+        now = int(time.time())
+        since = now - days * 86400
+        since -= since % step
+        where, params = "res = ? AND bucket >= ?", [res, since]
+        if country:
+            where += " AND country = ?"
+            params.append(country)
+        conn = self._connect(readonly=True)
+        try:
+            updates = dict(conn.execute(f"""
+                SELECT bucket - bucket % {step} AS b, sum(count) FROM updates WHERE {where} GROUP BY b
+            """, params).fetchall())
+            # Latest sample of each city within a step, then summed over cities
+            samples = {r[0]: r[1:] for r in conn.execute(f"""
+                SELECT b, sum(total), sum(pending), sum(success), sum(failed), sum(retry_due) FROM (
+                    SELECT path, bucket - bucket % {step} AS b, max(bucket), total, pending, success, failed, retry_due
+                    FROM samples WHERE {where} GROUP BY path, b
+                ) GROUP BY b
+            """, params)}
+        finally:
+            conn.close()
+
+        at = list(range(since, now + 1, step))
+        out = {"step": step, "at": at, "updates": [updates.get(b, 0) for b in at]}
+        for i, k in enumerate(("total", "pending", "success", "failed", "retry_due")):
+            out[k] = [samples[b][i] if b in samples else None for b in at]
+        return out
+
+    def sparklines(self, country, hours=24):
+        """{path: domains updated per hour, oldest first} for each city of `country`, from the hourly tier."""
+        now = int(time.time())
+        start = now - now % 3600 - (hours - 1) * 3600
+        conn = self._connect(readonly=True)
+        try:
+            rows = conn.execute("SELECT path, bucket, count FROM updates WHERE country = ? AND res = 3600 AND bucket >= ?",
+                                (country, start)).fetchall()
+        finally:
+            conn.close()
+        out = {}
+        for path, bucket, n in rows:
+            out.setdefault(path, [0] * hours)[(bucket - start) // 3600] = n
+        return out
+
+HISTORY = HistoryStore(os.path.join(CACHE_ROOT, "history.sqlite"))
+
+def record_history(files):
+    HISTORY.record(ANALYTICS.per_file, ANALYTICS.refresh_started)
+
+ANALYTICS.listeners.append(record_history)
 
 # ---------------------------------------------------------
-# GITHUB & ANALYTICS ENGINE (MULTI-THREADED)
+# DOMAIN BROWSER (INDEXED COPIES, KEYSET PAGINATION)
 # ---------------------------------------------------------
-def get_folders():
-    try:
-        r = requests.get(f"{API_BASE}/db", headers=HEADERS, timeout=10)
-        if r.status_code == 200:
-            return [i['name'] for i in r.json() if i['type'] == 'dir']
-    except: pass
-    return []
+# Extra indexes for filtering / sorting; idx_status already ships with every DB.
+# SQLite appends the rowid (= id) to every index, so each one also serves
+# "... AND id < ? ORDER BY id DESC" keyset pages.
+BROWSE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_browse_niche ON domains(niche)",
+    "CREATE INDEX IF NOT EXISTS idx_browse_attempts ON domains(attempts)",
+    "CREATE INDEX IF NOT EXISTS idx_browse_last_attempt ON domains(last_attempt_at)",
+    "CREATE INDEX IF NOT EXISTS idx_browse_status_last_attempt ON domains(status, last_attempt_at)",
+]
+BROWSE_SORTS = {"id": "Newest first", "last_attempt": "Last attempt"}
+BROWSE_PAGE_SIZE = 100
 
-def get_files_in_country(country):
-    try:
-        r = requests.get(f"{API_BASE}/db/{country}", headers=HEADERS, timeout=10)
-        if r.status_code == 200:
-            return [i for i in r.json() if i['name'].endswith('.sqlite')]
-    except: pass
-    return []
+BROWSE_CACHE = BlobCache(os.path.join(CACHE_ROOT, "browse"), CACHE_MAX_MB * 1024 * 1024)
 
-def scan_single_db(file_info):
+@contextmanager
+def browse_db(country, filename):
     """
-    Downloads a single DB to RAM, queries stats, and returns them.
-    Used by ThreadPool for parallel scanning.
+    Read-only connection to an indexed copy of a city DB, built once per blob
+    SHA and kept on disk, so paging never downloads or copies the file again.
     """
-    stats = {
-        "total": 0, "pending": 0, "success": 0, "failed": 0,
-        "m1": 0, "m5": 0, "h1": 0, "h24": 0, "country": "Unknown"
-    }
-    
+    info = STORAGE.find_file(country, filename)
+    if not info: raise StorageError("Fetch Failed")
+
+    path = BROWSE_CACHE.get(info['sha'])
+    if not path:
+        # backup() reads through SQLite, so commits a scraper left in a live file's -wal are copied too
+        fd, tmp_path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        try:
+            copy = sqlite3.connect(tmp_path)
+            try:
+                with STORAGE.open_db(info) as src: src.backup(copy)
+                copy.execute("PRAGMA journal_mode=DELETE")  # Self-contained file, no -wal beside it
+                for sql in BROWSE_INDEXES: copy.execute(sql)
+                copy.commit()
+            finally:
+                copy.close()
+
+            def write(f):
+                with open(tmp_path, "rb") as src: shutil.copyfileobj(src, f, DOWNLOAD_CHUNK)
+            path, _, _ = BROWSE_CACHE.put_stream(write, info['sha'])
+        finally:
+            os.remove(tmp_path)
+
+    conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro&immutable=1", uri=True)
+    conn.row_factory = sqlite3.Row
     try:
-        # Download
-        r = requests.get(file_info['download_url'], timeout=20)
-        if r.status_code != 200: return stats
-        
-        # Temp File
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".sqlite") as tmp:
-            tmp.write(r.content)
-            tmp_path = tmp.name
-            
-        # Query
-        conn = sqlite3.connect(tmp_path)
-        c = conn.cursor()
-        
-        # 1. Totals
-        c.execute("SELECT status, count(*) FROM domains GROUP BY status")
-        for s, count in c.fetchall():
-            stats[s] = count
-            stats["total"] += count
-            
-        # 2. Velocity (Time based)
-        now = int(time.time())
-        c.execute("SELECT count(*) FROM domains WHERE updated_at >= ?", (now - 60,))
-        stats["m1"] = c.fetchone()[0]
-        
-        c.execute("SELECT count(*) FROM domains WHERE updated_at >= ?", (now - 300,))
-        stats["m5"] = c.fetchone()[0]
-        
-        c.execute("SELECT count(*) FROM domains WHERE updated_at >= ?", (now - 3600,))
-        stats["h1"] = c.fetchone()[0]
-        
-        c.execute("SELECT count(*) FROM domains WHERE updated_at >= ?", (now - 86400,))
-        stats["h24"] = c.fetchone()[0]
-        
+        yield conn
+    finally:
         conn.close()
-        os.remove(tmp_path)
-        
-    except Exception as e:
-        # print(f"Scan error: {e}")
-        pass
-        
-    return stats
 
-def get_global_analytics():
+def parse_cursor(raw):
+    """'<id>' or '<last_attempt_at>_<id>' -> (value, id), None if missing / malformed."""
+    try:
+        if "_" in raw:
+            val, last_id = raw.split("_", 1)
+            return int(val), int(last_id)
+        return None, int(raw)
+    except (TypeError, ValueError):
+        return None
+
+def browse_page(conn, status=None, niche=None, min_attempts=None, sort="id", after=None, limit=BROWSE_PAGE_SIZE):
+    """One page of domains plus the cursor for the next page (None on the last page)."""
+    where, params = [], []
+    if status: where.append("status = ?"); params.append(status)
+    if niche: where.append("niche = ?"); params.append(niche)
+    if min_attempts: where.append("attempts >= ?"); params.append(min_attempts)
+
+    if sort == "last_attempt":
+        # Never-attempted rows have no position in this order, leave them out
+        where.append("last_attempt_at IS NOT NULL")
+        if after and after[0] is not None:
+            where.append("(last_attempt_at, id) < (?, ?)"); params += list(after)
+        order = "last_attempt_at DESC, id DESC"
+    else:
+        if after: where.append("id < ?"); params.append(after[1])
+        order = "id DESC"
+
+    sql = "SELECT * FROM domains" + (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY {order} LIMIT ?"
+    rows = [dict(r) for r in conn.execute(sql, params + [limit + 1]).fetchall()]
+    if len(rows) <= limit: return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    cursor = f"{last['last_attempt_at']}_{last['id']}" if sort == "last_attempt" else str(last['id'])
+    return rows, cursor
+
+# ---------------------------------------------------------
+# WRITE-BEHIND QUEUE (COALESCED EDITS, ONE COMMIT PER BATCH)
+# ---------------------------------------------------------
+class WriteTicket:
+    """Handle for a submitted batch of edits; wait() blocks until it is committed."""
+
+    def __init__(self, files):
+        self.files = files
+        self.ok, self.msg, self.counts = None, "Queued", {}
+        self._done = threading.Event()
+
+    def finish(self, ok, msg, counts):
+        self.ok, self.msg = ok, msg
+        self.counts = {k: counts.get(k, 0) for k in self.files}
+        self._done.set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.ok
+
+class WriteQueue:
     """
-    Scans ALL databases in ALL countries using Threads.
-    Returns aggregated data for the Dashboard.
+    Collects edits for WINDOW seconds after the first one arrives. Edits to the
+    same file are applied together in one transaction, and every file touched
+    in the window is pushed as a single commit. Flushes never overlap, so two
+    quick clicks can no longer race each other on the file SHA.
     """
-    countries = get_folders()
-    all_files = []
-    
-    # 1. Collect all file URLs first
-    for c in countries:
-        files = get_files_in_country(c)
-        for f in files:
-            f['country_name'] = c # Tag with country
-            all_files.append(f)
-            
-    # 2. Parallel Scan (Limit 20 threads to be safe with API/Memory)
-    global_stats = {
-        "total": 0, "pending": 0, "success": 0, "failed": 0,
-        "m1": 0, "m5": 0, "h1": 0, "h24": 0,
-        "cities_count": len(all_files)
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}   # (country, filename) -> [(sql, params)]
+        self._tickets = []
+        self._messages = []
+        self._timer = None
+        self._failures = {}  # (country, filename) -> (time, error) of its last failed flush
+
+    def submit(self, edits_by_file, message):
+        ticket = WriteTicket(list(edits_by_file))
+        with self._lock:
+            for key, edits in edits_by_file.items():
+                self._pending.setdefault(key, []).extend(edits)
+            self._tickets.append(ticket)
+            self._messages.append(message)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return ticket
+
+    def pending_edits(self, country, filename):
+        with self._lock: return len(self._pending.get((country, filename), []))
+
+    def last_failure(self, country, filename):
+        """(time, error) if the last flush touching this file did not save it, else None."""
+        with self._lock: return self._failures.get((country, filename))
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, tickets, messages = self._pending, self._tickets, self._messages
+                self._pending, self._tickets, self._messages = {}, [], []
+                if self._timer: self._timer.cancel()
+                self._timer = None
+            if not batch: return
+
+            message = messages[0] if len(messages) == 1 else f"Batch update: {len(messages)} edits across {len(batch)} files\n\n" + "\n".join(messages)
+            try:
+                ok, msg, counts, errors = STORAGE.commit_files(batch, message)
+            except Exception as e:
+                ok, msg, counts, errors = False, str(e), {}, {}
+            with self._lock:
+                # Nobody waits on a click's ticket, so failures are kept for the manage page
+                for key in batch:
+                    if ok and key in counts: self._failures.pop(key, None)
+                    else: self._failures[key] = (time.time(), errors.get(key, msg))
+            for t in tickets: t.finish(ok, msg, counts)
+            if ok: ANALYTICS.trigger()
+
+WRITES = WriteQueue(WRITES_CFG.get("WINDOW_SECONDS", 2))
+
+# ---------------------------------------------------------
+# COMPACTION (MAINTENANCE JOB)
+# ---------------------------------------------------------
+# Deleted and rewritten rows leave free pages behind. Scrapers pick work by
+# next_retry_at and velocity filters on updated_at, neither ships indexed.
+TIME_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_updated_at ON domains(updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_next_retry_at ON domains(next_retry_at)",
+]
+
+def compact_db(conn):
+    """Adds the time-column indexes, then VACUUMs away free pages."""
+    for sql in TIME_INDEXES: conn.execute(sql)
+    conn.commit()
+    conn.execute("VACUUM")
+
+def compact_fleet(country=None):
+    """
+    Compacts every DB (or one country's) and publishes a .sqlite.gz snapshot
+    next to each. Returns (ok, message, [{"file", "before", "after", "snapshot"}])
+    with sizes in bytes taken from the listings before and after.
+    """
+    before = {(f['country_name'], f['name']): f for f in STORAGE.list_all() if country in (None, f['country_name'])}
+    if not before: return False, "No databases found", []
+    ok, msg, _, _ = STORAGE.compact(sorted(before))
+    after = {(f['country_name'], f['name']): f for f in STORAGE.list_all()}
+    report = [{"file": f"{c}/{n}", "before": f['size'], "after": after.get((c, n), f)['size'],
+               "snapshot": after.get((c, n), {}).get('snapshot_size')} for (c, n), f in sorted(before.items())]
+    if ok: ANALYTICS.trigger()
+    return ok, msg, report
+
+def compaction_summary(report):
+    before, after = sum(r['before'] for r in report), sum(r['after'] for r in report)
+    wire = sum(r['snapshot'] or r['after'] for r in report)
+    mb = lambda n: f"{n / 1048576:.1f} MB"
+    return (f"{len(report)} DBs: {mb(before)} -> {mb(after)} after VACUUM, "
+            f"{mb(wire)} over the wire with snapshots ({round(wire / (before or 1) * 100)}% of before)")
+
+# ---------------------------------------------------------
+# JSON API & LIVE STREAM
+# ---------------------------------------------------------
+LIVE_KEYS = ("total", "pending", "success", "failed", "m1", "m5", "h1", "h24", "retry_due", "retry_next_hour")
+
+def city_stats(entry, now):
+    data = entry["stats"]
+    out = {k: data[k] for k in ("total", "pending", "success", "failed")}
+    out.update(velocity(data["recent"], now))
+    out["retry_due"], out["retry_next_hour"] = retry_backlog(data, now)
+    out.update({"attempts": data["attempts"], "niches": data["niches"]})
+    out.update({"country": entry["country"], "city": entry["name"].replace(".sqlite", ""),
+                "sha": entry["sha"], "error": data["error"], "timings": data.get("timings", {}),
+                "source": data.get("source", "scan")})
+    return out
+
+def snapshot_meta(snap):
+    return {
+        "version": snap["version"], "refreshed_at": snap["refreshed_at"],
+        "age_seconds": round(time.time() - snap["refreshed_at"], 1),
+        "refreshing": ANALYTICS.refreshing, "progress": ANALYTICS.progress, "last_error": ANALYTICS.last_error
     }
-    
-    country_breakdown = {}
-    
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = {executor.submit(scan_single_db, f): f for f in all_files}
-        
-        for future in as_completed(futures):
-            f_info = futures[future]
-            data = future.result()
-            c_name = f_info['country_name']
-            
-            # Aggregate Global
-            global_stats["total"] += data["total"]
-            global_stats["pending"] += data["pending"]
-            global_stats["success"] += data["success"]
-            global_stats["failed"] += data["failed"]
-            global_stats["m1"] += data["m1"]
-            global_stats["m5"] += data["m5"]
-            global_stats["h1"] += data["h1"]
-            global_stats["h24"] += data["h24"]
-            
-            # Aggregate Country
-            if c_name not in country_breakdown:
-                country_breakdown[c_name] = {"total": 0, "success": 0}
-            country_breakdown[c_name]["total"] += data["total"]
-            country_breakdown[c_name]["success"] += data["success"]
-            
-    return global_stats, countries, country_breakdown
+
+@app.route('/api/stats')
+def api_stats():
+    snap = ANALYTICS.get_snapshot()
+    if not snap: return jsonify({"error": ANALYTICS.last_error}), 503
+    # Velocity is re-bucketed against "now" on every call, not frozen at refresh time
+    global_stats, breakdown = aggregate(ANALYTICS.per_file)
+    global_stats["errors"] = [{"file": p, "error": e} for p, e in global_stats["errors"]]
+    return jsonify({**snapshot_meta(snap), "global": global_stats, "countries": breakdown})
+
+@app.route('/api/stats/<country>')
+def api_country_stats(country):
+    snap = ANALYTICS.get_snapshot()
+    if not snap: return jsonify({"error": ANALYTICS.last_error}), 503
+    entries = {p: e for p, e in ANALYTICS.per_file.items() if e["country"] == country}
+    if not entries: return jsonify({"error": f"Unknown country {country}"}), 404
+    now = int(time.time())
+    totals, _ = aggregate(entries, now)
+    totals.pop("errors")
+    cities = [city_stats(entries[p], now) for p in sorted(entries)]
+    return jsonify({**snapshot_meta(snap), "country": country, "totals": totals, "cities": cities})
+
+@app.route('/api/stats/<country>/<city>')
+def api_city_stats(country, city):
+    snap = ANALYTICS.get_snapshot()
+    if not snap: return jsonify({"error": ANALYTICS.last_error}), 503
+    name = city if city.endswith(".sqlite") else f"{city}.sqlite"
+    entry = next((e for e in ANALYTICS.per_file.values() if e["country"] == country and e["name"] == name), None)
+    if not entry: return jsonify({"error": f"Unknown city {country}/{city}"}), 404
+    return jsonify({**snapshot_meta(snap), **city_stats(entry, int(time.time()))})
+
+@app.route('/api/history')
+def api_history():
+    days = max(1, request.args.get('days', 7, type=int))
+    return jsonify(HISTORY.series(days, request.args.get('country') or None))
+
+@app.route('/api/slow_scans')
+def api_slow_scans():
+    return jsonify({"threshold_seconds": SLOW_SCAN_SECONDS, "scans": list(reversed(SLOW_SCANS))})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint; never waits for the first scan."""
+    snap = ANALYTICS.snapshot
+    if snap:
+        METRICS.set("nexus_snapshot_age_seconds", round(time.time() - snap["refreshed_at"], 3))
+        METRICS.set("nexus_snapshot_version", snap["version"])
+    METRICS.set("nexus_refresh_in_progress", int(ANALYTICS.refreshing))
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/stream')
+def api_stream():
+    """
+    Server-sent events: a `stats` event with the live numbers and the delta
+    since the previous event, whenever a snapshot lands or velocity windows
+    move (checked every STREAM_SECONDS). Comment lines keep idle streams open.
+    """
+    ANALYTICS.start()  # The stream may be this worker's first request
+
+    def events():
+        last, version = None, None
+        while True:
+            snap = ANALYTICS.wait_for_change(version, STREAM_SECONDS)
+            if not snap:
+                yield ": waiting for first scan\n\n"
+                continue
+            version = snap["version"]
+            global_stats, _ = aggregate(ANALYTICS.per_file)
+            stats = {k: global_stats[k] for k in LIVE_KEYS}
+            if stats == last:
+                yield ": keep-alive\n\n"
+                continue
+            delta = {k: v - (last or {}).get(k, 0) for k, v in stats.items() if not last or v != last[k]}
+            payload = {"version": version, "age": format_age(time.time() - snap["refreshed_at"]), "stats": stats, "delta": delta}
+            last = stats
+            yield f"event: stats\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ---------------------------------------------------------
 # ROUTES
 # ---------------------------------------------------------
+def bulk_form(action_url, heading, confirm=None):
+    onsubmit = f' onsubmit="return confirm(\'{confirm}\')"' if confirm else ''
+    return f"""
+    <div class="card p-4 border-0 shadow-sm mb-4">
+        <h6 class="fw-bold mb-3">{heading}</h6>
+        <form action="{action_url}" method="POST" class="row g-2"{onsubmit}>
+            <div class="col-md-4"><select name="target" class="form-select"><option value="failed">Failed Domains</option><option value="pending">Pending</option></select></div>
+            <div class="col-md-4"><select name="action" class="form-select"><option value="pending">Reset Status</option><option value="delete">Delete</option></select></div>
+            <div class="col-md-4"><button class="btn btn-dark w-100">Execute</button></div>
+        </form>
+    </div>
+    """
+
+HISTORY_RANGES = {1: "24h", 7: "7d", 30: "30d", 90: "90d", 365: "1y"}
+
+def trend_panel(country=None):
+    """Updates and status trend charts from HISTORY, range picked with ?days=."""
+    days = request.args.get('days', 7, type=int)
+    if days not in HISTORY_RANGES: days = 7
+    h = HISTORY.series(days, country)
+    step = h['step']
+    per = f"{step // 60} min" if step < 3600 else (f"{step // 3600} h" if step < 86400 else f"{step // 86400} d")
+    labels = [time.strftime('%m-%d %H:%M' if step < 86400 else '%Y-%m-%d', time.localtime(t)) for t in h['at']]
+    picker = "".join(f'<a href="?days={d}" class="btn btn-sm {"btn-primary" if d == days else "btn-outline-secondary"}">{label}</a>'
+                     for d, label in HISTORY_RANGES.items())
+    return f"""
+    <div class="stat-card mb-5">
+        <div class="d-flex justify-content-between align-items-center mb-4">
+            <h6 class="fw-bold m-0">Trends <span class="text-muted small fw-normal">per {per}</span></h6>
+            <div class="btn-group">{picker}</div>
+        </div>
+        <div class="row g-4">
+            <div class="col-md-6"><canvas id="updatesTrend"></canvas></div>
+            <div class="col-md-6"><canvas id="statusTrend"></canvas></div>
+        </div>
+    </div>
+    <script>
+        new Chart(document.getElementById('updatesTrend'), {{
+            type: 'bar',
+            data: {{ labels: {json.dumps(labels)}, datasets: [{{ label: 'Domains updated', data: {json.dumps(h['updates'])}, backgroundColor: '#4f46e5' }}] }},
+            options: {{ responsive: true, plugins: {{ legend: {{ display: false }} }}, scales: {{ x: {{ ticks: {{ maxTicksLimit: 8 }} }} }} }}
+        }});
+        new Chart(document.getElementById('statusTrend'), {{
+            type: 'line',
+            data: {{
+                labels: {json.dumps(labels)},
+                datasets: [
+                    {{ label: 'Success', data: {json.dumps(h['success'])}, borderColor: '#10b981' }},
+                    {{ label: 'Pending', data: {json.dumps(h['pending'])}, borderColor: '#3b82f6' }},
+                    {{ label: 'Failed', data: {json.dumps(h['failed'])}, borderColor: '#ef4444' }}
+                ]
+            }},
+            options: {{ responsive: true, spanGaps: true, elements: {{ point: {{ radius: 0 }} }}, scales: {{ x: {{ ticks: {{ maxTicksLimit: 8 }} }} }} }}
+        }});
+    </script>
+    """
+
+def sparkline(values, width=120, height=28):
+    """Inline SVG line for a short series, e.g. a city's updates per hour."""
+    top = max(values) or 1
+    step = width / max(len(values) - 1, 1)
+    points = " ".join(f"{i * step:.1f},{height - 2 - v / top * (height - 4):.1f}" for i, v in enumerate(values))
+    return f'<svg width="{width}" height="{height}"><polyline points="{points}" fill="none" stroke="#4f46e5" stroke-width="1.5"/></svg>'
+
+@app.errorhandler(StorageError)
+def storage_error(e):
+    # The sidebar is a listing too, so it stays empty until storage answers again
+    content = f"<p class='p-4'>Storage unavailable: {escape(str(e))}</p>"
+    return render_template_string(HTML_TEMPLATE, CONTENT=content, countries=[], page='', title="Storage Unavailable", selected_country=""), 503
+
 @app.route('/')
 def home():
-    # Heavy operation - Scans everything
-    stats, countries_list, c_breakdown = get_global_analytics()
+    # Served from the background snapshot, never scans on the request thread
+    snap = ANALYTICS.get_snapshot()
+    if not snap:
+        return render_template_string(HTML_TEMPLATE, CONTENT=f"<p class='p-4'>Scan failed: {escape(str(ANALYTICS.last_error))}</p>", countries=get_folders(), page='dashboard', title="Global Command Center", selected_country="")
+    stats, countries_list, c_breakdown = snap['global_stats'], snap['countries'], snap['country_breakdown']
+    age = format_age(time.time() - snap['refreshed_at'])
+    progress = ANALYTICS.progress
+    refreshing = f'<span class="badge bg-pending ms-2">Refreshing... {progress[0]}/{progress[1]} cities</span>' if progress else ('<span class="badge bg-pending ms-2">Refreshing...</span>' if ANALYTICS.refreshing else '')
+    budget = f" • API budget {GH.rate_limit_remaining}" if STORAGE.name == "github" and GH.rate_limit_remaining is not None else ""
+    errors = ""
+    if ANALYTICS.last_error and not ANALYTICS.refreshing:
+        errors += f"""<div class="alert alert-danger shadow-sm border-0 rounded-3 mb-4"><i class="bi bi-x-octagon-fill me-2"></i> Last refresh reported an error (data as of {age} ago): {escape(ANALYTICS.last_error)}</div>"""
+    if stats['errors']:
+        items = "".join(f"<li><b>{escape(p)}</b>: {escape(str(e))}</li>" for p, e in stats['errors'])
+        errors += f"""<div class="alert alert-warning shadow-sm border-0 rounded-3 mb-4"><i class="bi bi-exclamation-triangle-fill me-2"></i> {len(stats['errors'])} of {stats['cities_count']} cities could not be scanned (shown as 0, retried on next refresh):<ul class="mb-0 mt-2 small">{items}</ul></div>"""
     
     # Generate Chart Data string
     chart_labels = list(c_breakdown.keys())
     chart_data = [v['total'] for v in c_breakdown.values()]
+
+    # Retry backlog panels: attempts histogram in bucket order, biggest niches first
+    attempt_labels = sorted(stats['attempts'], key=lambda b: int(b.rstrip('+')))
+    attempt_counts = [stats['attempts'][b] for b in attempt_labels]
+    niche_rows = ""
+    for niche, per_status in sorted(stats['niches'].items(), key=lambda kv: -sum(kv[1].values()))[:10]:
+        total = sum(per_status.values())
+        niche_rows += f"""<tr><td class="fw-bold">{escape(niche)}</td><td>{total:,}</td><td>{per_status.get('failed', 0):,}</td>
+            <td><span class="badge bg-success">{round(per_status.get('success', 0) / (total or 1) * 100)}%</span></td></tr>"""
     
     content = f"""
+    <p class="text-muted small mb-3"><i class="bi bi-clock-history me-1"></i> Last refreshed <span id="live-age">{age}</span> ago (snapshot v{snap['version']}){budget}{refreshing}</p>
+    {errors}
+
     <!-- VELOCITY SECTION -->
     <div class="row g-4 mb-5">
         <div class="col-12">
@@ -325,22 +2652,22 @@ def home():
                 <div class="row align-items-center">
                     <div class="col-md-3 border-end border-white border-opacity-25 text-center">
                         <div class="text-white-50 text-uppercase small fw-bold">Last 1 Minute</div>
-                        <div class="display-4 fw-bold">{stats['m1']}</div>
+                        <div class="display-4 fw-bold" id="live-m1">{stats['m1']}</div>
                         <div class="small">New Domains</div>
                     </div>
                     <div class="col-md-3 border-end border-white border-opacity-25 text-center">
                         <div class="text-white-50 text-uppercase small fw-bold">Last 5 Minutes</div>
-                        <div class="display-4 fw-bold">{stats['m5']}</div>
+                        <div class="display-4 fw-bold" id="live-m5">{stats['m5']}</div>
                         <div class="small">New Domains</div>
                     </div>
                     <div class="col-md-3 border-end border-white border-opacity-25 text-center">
                         <div class="text-white-50 text-uppercase small fw-bold">Last 1 Hour</div>
-                        <div class="display-4 fw-bold">{stats['h1']}</div>
+                        <div class="display-4 fw-bold" id="live-h1">{stats['h1']}</div>
                         <div class="small">New Domains</div>
                     </div>
                     <div class="col-md-3 text-center">
                         <div class="text-white-50 text-uppercase small fw-bold">Last 24 Hours</div>
-                        <div class="display-4 fw-bold">{stats['h24']}</div>
+                        <div class="display-4 fw-bold" id="live-h24">{stats['h24']}</div>
                         <div class="small">New Domains</div>
                     </div>
                 </div>
@@ -353,25 +2680,56 @@ def home():
         <div class="col-md-3">
             <div class="stat-card">
                 <div class="stat-label">Total Extracted</div>
-                <div class="stat-val">{stats['total']:,}</div>
+                <div class="stat-val" id="live-total">{stats['total']:,}</div>
             </div>
         </div>
         <div class="col-md-3">
             <div class="stat-card pending">
                 <div class="stat-label text-primary">Pending</div>
-                <div class="stat-val text-primary">{stats['pending']:,}</div>
+                <div class="stat-val text-primary" id="live-pending">{stats['pending']:,}</div>
             </div>
         </div>
         <div class="col-md-3">
             <div class="stat-card success">
                 <div class="stat-label text-success">Success</div>
-                <div class="stat-val text-success">{stats['success']:,}</div>
+                <div class="stat-val text-success" id="live-success">{stats['success']:,}</div>
             </div>
         </div>
         <div class="col-md-3">
             <div class="stat-card failed">
                 <div class="stat-label text-danger">Failed</div>
-                <div class="stat-val text-danger">{stats['failed']:,}</div>
+                <div class="stat-val text-danger" id="live-failed">{stats['failed']:,}</div>
+            </div>
+        </div>
+    </div>
+
+    {trend_panel()}
+
+    <!-- RETRY BACKLOG -->
+    <div class="row g-4 mb-5">
+        <div class="col-md-3">
+            <div class="stat-card failed mb-4">
+                <div class="stat-label text-danger">Retries Due Now</div>
+                <div class="stat-val text-danger" id="live-retry_due">{stats['retry_due']:,}</div>
+            </div>
+            <div class="stat-card pending">
+                <div class="stat-label text-primary">Due Within 1 Hour</div>
+                <div class="stat-val text-primary" id="live-retry_next_hour">{stats['retry_next_hour']:,}</div>
+            </div>
+        </div>
+        <div class="col-md-4">
+            <div class="stat-card h-100">
+                <h6 class="fw-bold mb-4">Attempts per Domain</h6>
+                <canvas id="attemptsChart"></canvas>
+            </div>
+        </div>
+        <div class="col-md-5">
+            <div class="table-card h-100">
+                <div class="p-4 border-bottom bg-white"><h6 class="fw-bold m-0 text-dark">Top Niches</h6></div>
+                <table class="table mb-0">
+                    <thead><tr><th>Niche</th><th>Domains</th><th>Failed</th><th>Success Rate</th></tr></thead>
+                    <tbody>{niche_rows}</tbody>
+                </table>
             </div>
         </div>
     </div>
@@ -406,9 +2764,17 @@ def home():
         </div>
     </div>
 
+    <div class="mt-5">
+        {bulk_form("/bulk_action", f"GLOBAL BULK ACTIONS - ALL {stats['cities_count']} DATABASES", "Run on every database in every country?")}
+    </div>
+
+    <form action="/compact" method="POST" class="mt-3 text-end" onsubmit="return confirm('VACUUM every database and publish compressed snapshots? This makes one commit.')">
+        <button class="btn btn-outline-secondary btn-sm"><i class="bi bi-archive me-1"></i> Compact &amp; publish snapshots</button>
+    </form>
+
     <script>
         const ctx = document.getElementById('statusChart');
-        new Chart(ctx, {{
+        const statusChart = new Chart(ctx, {{
             type: 'doughnut',
             data: {{
                 labels: ['Success', 'Pending', 'Failed'],
@@ -420,10 +2786,114 @@ def home():
             }},
             options: {{ responsive: true, cutout: '70%' }}
         }});
+
+        new Chart(document.getElementById('attemptsChart'), {{
+            type: 'bar',
+            data: {{
+                labels: {json.dumps(attempt_labels)},
+                datasets: [{{ label: 'Domains', data: {json.dumps(attempt_counts)}, backgroundColor: '#4f46e5', borderRadius: 6 }}]
+            }},
+            options: {{ responsive: true, plugins: {{ legend: {{ display: false }} }} }}
+        }});
+
+        // Live updates: the server pushes fresh numbers, no reload / rescan needed
+        const stream = new EventSource('/api/stream');
+        stream.addEventListener('stats', (e) => {{
+            const d = JSON.parse(e.data);
+            for (const [k, v] of Object.entries(d.stats)) {{
+                const el = document.getElementById('live-' + k);
+                if (el) el.textContent = v.toLocaleString();
+            }}
+            document.getElementById('live-age').textContent = d.age;
+            statusChart.data.datasets[0].data = [d.stats.success, d.stats.pending, d.stats.failed];
+            statusChart.update('none');
+        }});
     </script>
     """
     return render_template_string(HTML_TEMPLATE, CONTENT=content, countries=countries_list, page='dashboard', title="Global Command Center", selected_country="")
 
+@app.route('/refresh')
+def refresh():
+    ANALYTICS.trigger()
+    flash("Refresh started - the dashboard updates once the changed cities are rescanned.", "info")
+    return redirect(url_for('home'))
+
+def result_table(cols, rows):
+    head = "".join(f"<th>{escape(str(c))}</th>" for c in cols)
+    body = "".join("<tr>" + "".join(f"<td>{escape('' if v is None else str(v))}</td>" for v in r) + "</tr>" for r in rows)
+    return f"<div class='table-card mb-4' style='max-height: 420px; overflow-y: auto;'><table class='table mb-0'><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table></div>"
+
+@app.route('/analytics', methods=['GET', 'POST'])
+def analytics():
+    cov = STORE.coverage()
+    sql = request.form.get('sql', '').strip()
+
+    panels = ""
+    if sql:
+        try:
+            cols, rows = STORE.query(sql)
+            panels += f"<h6 class='fw-bold mb-3'>Query Result ({len(rows)} rows)</h6>" + result_table(cols, rows)
+        except sqlite3.Error as e:
+            panels += f"<div class='alert alert-danger border-0 rounded-3 mb-4'>{escape(str(e))}</div>"
+    for name, (label, _) in AnalyticsStore.REPORTS.items():
+        cols, rows = STORE.report(name)
+        panels += f"<h6 class='fw-bold mb-3'>{label}</h6>" + result_table(cols, rows)
+
+    synced = format_age(time.time() - cov['synced_at']) + " ago" if cov['synced_at'] else "not yet"
+    content = f"""
+    <div class="card p-4 border-0 shadow-sm mb-4">
+        <h6 class="fw-bold mb-3">CROSS-CITY SQL <span class="text-muted small fw-normal">(read-only, table <code>domains</code> with country / city columns)</span></h6>
+        <form method="POST" class="row g-2">
+            <div class="col-md-10"><textarea name="sql" rows="3" class="form-control font-monospace" placeholder="SELECT country, niche, count(*) FROM domains GROUP BY 1, 2">{escape(sql)}</textarea></div>
+            <div class="col-md-2"><button class="btn btn-dark w-100 h-100">Run</button></div>
+        </form>
+        <p class="text-muted small mt-3 mb-0">Store holds {cov['rows']:,} domains from {cov['files']} databases, last synced {synced}.</p>
+    </div>
+    {panels}
+    """
+    return render_template_string(HTML_TEMPLATE, CONTENT=content, countries=get_folders(), page='analytics', title="Cross-City Analytics", selected_country="")
+
+@app.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    show_dupes = request.args.get('duplicates') == '1'
+    cov = SEARCH.coverage()
+
+    rows_html = ""
+    if show_dupes:
+        results = SEARCH.duplicates()
+        head = "<tr><th>Domain</th><th>Cities</th><th>Found In</th></tr>"
+        for r in results:
+            rows_html += f"<tr><td class='fw-bold'>{escape(r['domain'])}</td><td>{r['cities']}</td><td class='small'>{escape(r['locations'])}</td></tr>"
+        summary = f"{len(results)} domains appear in more than one city."
+    else:
+        results = SEARCH.search(q) if q else []
+        head = "<tr><th>Domain</th><th>Niche</th><th>Status</th><th>Location</th></tr>"
+        for r in results:
+            st_cls = "bg-success" if r['status']=='success' else ("bg-danger" if r['status']=='failed' else "bg-pending")
+            rows_html += f"""
+            <tr>
+                <td class="fw-bold">{escape(r['domain'])}</td>
+                <td class="text-muted small">{escape(r['niche'] or '-')}</td>
+                <td><span class="badge {st_cls}">{escape(r['status'])}</span></td>
+                <td><a href="/manage/{escape(r['country'])}/{escape(r['city'])}.sqlite" class="text-decoration-none">{escape(r['country'])} / {escape(r['city'])}</a></td>
+            </tr>"""
+        summary = f"{len(results)} matches for '{escape(q)}'." if q else "Search by domain or niche prefix."
+
+    synced = format_age(time.time() - cov['synced_at']) + " ago" if cov['synced_at'] else "not yet"
+    content = f"""
+    <div class="card p-4 border-0 shadow-sm mb-4">
+        <form method="GET" action="/search" class="row g-2">
+            <div class="col-md-8"><input name="q" value="{escape(q)}" class="form-control" placeholder="example.com or niche..." autofocus></div>
+            <div class="col-md-2"><button class="btn btn-dark w-100">Search</button></div>
+            <div class="col-md-2"><a href="/search?duplicates=1" class="btn btn-outline-secondary w-100">Duplicates</a></div>
+        </form>
+        <p class="text-muted small mt-3 mb-0">Index covers {cov['rows']:,} domains in {cov['files']} databases, last synced {synced}. {summary}</p>
+    </div>
+    <div class="table-card"><table class="table mb-0"><thead>{head}</thead><tbody>{rows_html}</tbody></table></div>
+    """
+    return render_template_string(HTML_TEMPLATE, CONTENT=content, countries=get_folders(), page='search', title="Domain Search", selected_country="")
+
 @app.route('/country/<country>')
 def view_country(country):
     countries = get_folders()
@@ -431,53 +2901,85 @@ def view_country(country):
     
     cards = ""
     if not cities: cards = "<p class='p-4'>No data found.</p>"
+    trends = HISTORY.sparklines(country) if cities else {}
     
     for c in cities:
         name = c['name'].replace(".sqlite", "")
+        hourly = trends.get(c['path'], [0] * 24)
+        # Busy earlier today but nothing in the last two hours
+        stalled = ' <span class="badge badge-soft bg-failed">Stalled</span>' if any(hourly) and not any(hourly[-2:]) else ''
         cards += f"""
         <div class="col-md-4 mb-4">
             <div class="stat-card border h-100 d-flex flex-column justify-content-between">
                 <div>
-                    <h5 class="fw-bold text-dark">{name}</h5>
-                    <p class="text-muted small">Database File</p>
+                    <h5 class="fw-bold text-dark">{name}{stalled}</h5>
+                    <p class="text-muted small mb-1">{sum(hourly):,} updates in 24h</p>
+                    {sparkline(hourly)}
                 </div>
                 <a href="/manage/{country}/{c['name']}" class="btn btn-primary w-100 mt-3">Manage Database</a>
             </div>
         </div>
         """
     content = f"<div class='row'>{cards}</div>"
+    if cities:
+        content = trend_panel(country) + content
+        content = bulk_form(f"/bulk_action/{country}", f"BULK ACTIONS - ALL {len(cities)} {country.upper()} DATABASES",
+                            f"Run on all {len(cities)} databases in {country}?") + content
     return render_template_string(HTML_TEMPLATE, CONTENT=content, countries=countries, page='country', title=country, selected_country=country)
 
 @app.route('/manage/<country>/<filename>')
 def manage_db(country, filename):
-    def get_data(conn):
-        c = conn.cursor()
-        c.execute("SELECT status, count(*) FROM domains GROUP BY status")
-        stats = {"total":0, "pending":0, "success":0, "failed":0}
-        for s, count in c.fetchall(): stats[s] = count
-        stats["total"] = sum(stats.values())
-        c.execute("SELECT * FROM domains ORDER BY id DESC LIMIT 100")
-        return {"stats": stats, "rows": [dict(r) for r in c.fetchall()]}
-
-    res, msg = fetch_and_edit_db(country, filename, get_data)
-    if not res: return f"Error: {msg}"
+    status = request.args.get('status') or None
+    niche = request.args.get('niche') or None
+    min_attempts = request.args.get('min_attempts', type=int)
+    sort = request.args.get('sort') if request.args.get('sort') in BROWSE_SORTS else "id"
+    after = parse_cursor(request.args.get('after'))
+
+    try:
+        with browse_db(country, filename) as conn:
+            c = conn.cursor()
+            c.execute("SELECT status, count(*) FROM domains GROUP BY status")
+            stats = {"total":0, "pending":0, "success":0, "failed":0}
+            for s, count in c.fetchall(): stats[s] = count
+            stats["total"] = sum(v for k, v in stats.items() if k != "total")
+            niches = [r[0] for r in c.execute("SELECT DISTINCT niche FROM domains WHERE niche IS NOT NULL ORDER BY niche LIMIT 200")]
+            rows, next_cursor = browse_page(conn, status, niche, min_attempts, sort, after)
+    except Exception as e: return f"Error: {scan_error(e)}"
     
-    stats = res['stats']
+    queued = WRITES.pending_edits(country, filename)
+    pending_note = f"<div class='alert alert-info shadow-sm border-0 rounded-3 mb-4'><i class='bi bi-hourglass-split me-2'></i> {queued} edit(s) queued for the next commit - refresh in a moment to see them.</div>" if queued else ""
+    failure = WRITES.last_failure(country, filename)
+    if failure:
+        pending_note += f"<div class='alert alert-danger shadow-sm border-0 rounded-3 mb-4'><i class='bi bi-exclamation-octagon-fill me-2'></i> Edits to this file {format_age(time.time() - failure[0])} ago were not saved: {escape(failure[1])}</div>"
     rows_html = ""
-    for r in res['rows']:
+    for r in rows:
         st_cls = "bg-success" if r['status']=='success' else ("bg-danger" if r['status']=='failed' else "bg-pending")
+        last_attempt = time.strftime('%Y-%m-%d %H:%M', time.localtime(r['last_attempt_at'])) if r['last_attempt_at'] else "-"
         rows_html += f"""
         <tr>
             <td>#{r['id']}</td>
             <td><a href="http://{r['domain']}" target="_blank" class="fw-bold text-decoration-none">{r['domain']}</a></td>
+            <td class="text-muted small">{escape(r['niche'] or '-')}</td>
             <td><span class="badge {st_cls}">{r['status']}</span></td>
+            <td>{r['attempts'] or 0}</td>
+            <td class="text-muted small">{last_attempt}</td>
             <td>
                 <a href="/update/{country}/{filename}/{r['id']}/success" class="btn btn-sm btn-outline-success"><i class="bi bi-check"></i></a>
                 <a href="/update/{country}/{filename}/{r['id']}/failed" class="btn btn-sm btn-outline-danger"><i class="bi bi-x"></i></a>
             </td>
         </tr>"""
+    if not rows_html: rows_html = "<tr><td colspan='7' class='text-center text-muted p-4'>No domains match these filters.</td></tr>"
+
+    filters = {"status": status, "niche": niche, "min_attempts": min_attempts, "sort": sort}
+    filters = {k: v for k, v in filters.items() if v}
+    first_link = url_for('manage_db', country=country, filename=filename, **filters)
+    next_link = url_for('manage_db', country=country, filename=filename, after=next_cursor, **filters) if next_cursor else None
+    status_opts = "".join(f'<option value="{s}" {"selected" if s == status else ""}>{s.title()}</option>' for s in ("pending", "success", "failed"))
+    niche_opts = "".join(f'<option value="{escape(n)}" {"selected" if n == niche else ""}>{escape(n)}</option>' for n in niches)
+    sort_opts = "".join(f'<option value="{k}" {"selected" if k == sort else ""}>{v}</option>' for k, v in BROWSE_SORTS.items())
 
     content = f"""
+    {pending_note}
     <div class="row g-4 mb-4">
         <div class="col-md-3"><div class="stat-card"><div class="stat-label">Total</div><div class="stat-val">{stats['total']}</div></div></div>
         <div class="col-md-3"><div class="stat-card pending"><div class="stat-label text-primary">Pending</div><div class="stat-val text-primary">{stats['pending']}</div></div></div>
@@ -485,71 +2987,119 @@ def manage_db(country, filename):
         <div class="col-md-3"><div class="stat-card failed"><div class="stat-label text-danger">Failed</div><div class="stat-val text-danger">{stats['failed']}</div></div></div>
     </div>
     
+    {bulk_form(f"/bulk_action/{country}/{filename}", "BULK ACTIONS")}
+
     <div class="card p-4 border-0 shadow-sm mb-4">
-        <h6 class="fw-bold mb-3">BULK ACTIONS</h6>
-        <form action="/bulk_action/{country}/{filename}" method="POST" class="row g-2">
-            <div class="col-md-4"><select name="target" class="form-select"><option value="failed">Failed Domains</option><option value="pending">Pending</option></select></div>
-            <div class="col-md-4"><select name="action" class="form-select"><option value="pending">Reset Status</option><option value="delete">Delete</option></select></div>
-            <div class="col-md-4"><button class="btn btn-dark w-100">Execute</button></div>
+        <h6 class="fw-bold mb-3">FILTER DOMAINS</h6>
+        <form method="GET" class="row g-2">
+            <div class="col-md-3"><select name="status" class="form-select"><option value="">Any Status</option>{status_opts}</select></div>
+            <div class="col-md-3"><select name="niche" class="form-select"><option value="">Any Niche</option>{niche_opts}</select></div>
+            <div class="col-md-2"><input type="number" min="0" name="min_attempts" value="{min_attempts or ''}" placeholder="Min attempts" class="form-control"></div>
+            <div class="col-md-2"><select name="sort" class="form-select">{sort_opts}</select></div>
+            <div class="col-md-2"><button class="btn btn-dark w-100">Apply</button></div>
         </form>
     </div>
 
-    <div class="table-card"><table class="table mb-0"><thead><tr><th>ID</th><th>Domain</th><th>Status</th><th>Edit</th></tr></thead><tbody>{rows_html}</tbody></table></div>
+    <div class="table-card"><table class="table mb-0"><thead><tr><th>ID</th><th>Domain</th><th>Niche</th><th>Status</th><th>Attempts</th><th>Last Attempt</th><th>Edit</th></tr></thead><tbody>{rows_html}</tbody></table></div>
+    <div class="d-flex justify-content-between mt-3">
+        <a href="{first_link}" class="btn btn-outline-secondary {'disabled' if not after else ''}"><i class="bi bi-chevron-double-left"></i> First Page</a>
+        <a href="{next_link or '#'}" class="btn btn-outline-primary {'disabled' if not next_link else ''}">Next Page <i class="bi bi-chevron-right"></i></a>
+    </div>
     """
     return render_template_string(HTML_TEMPLATE, CONTENT=content, countries=get_folders(), page='manage', title=filename, selected_country=country)
 
-# DB Helper
-def fetch_and_edit_db(country, filename, callback):
-    url = f"{API_BASE}/db/{country}/{filename}"
-    r = requests.get(url, headers=HEADERS)
-    if r.status_code != 200: return None, "Fetch Failed"
-    data = r.json()
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".sqlite") as tmp:
-        tmp.write(base64.b64decode(data['content']))
-        tmp_path = tmp.name
-        
-    try:
-        conn = sqlite3.connect(tmp_path)
-        conn.row_factory = sqlite3.Row
-        res = callback(conn)
-        
-        if res == "SAVE":
-            conn.close()
-            with open(tmp_path, "rb") as f: content = f.read()
-            push = {
-                "message": f"Update {filename}",
-                "content": base64.b64encode(content).decode('utf-8'),
-                "sha": data['sha'], "branch": GH_BRANCH
-            }
-            p = requests.put(url, headers=HEADERS, json=push)
-            return (p.status_code in [200, 201]), "Saved"
-            
-        conn.close()
-        return res, "OK"
-    except Exception as e: return None, str(e)
-    finally:
-        if os.path.exists(tmp_path): os.remove(tmp_path)
-
 @app.route('/update/<c>/<f>/<id>/<st>')
 def update(c, f, id, st):
-    def act(conn):
-        conn.execute("UPDATE domains SET status=?, updated_at=? WHERE id=?", (st, int(time.time()), id))
-        conn.commit()
-        return "SAVE"
-    fetch_and_edit_db(c, f, act)
+    # Write-behind: quick clicks on the same file end up in one commit
+    WRITES.submit({(c, f): [("UPDATE domains SET status=?, updated_at=? WHERE id=?", (st, int(time.time()), id))]},
+                  f"Update {f}: #{id} -> {st}")
+    flash(f"#{id} marked {st} - queued for the next commit.", "info")
     return redirect(url_for('manage_db', country=c, filename=f))
 
+BULK_TARGETS = ("failed", "pending", "success")
+BULK_ACTIONS = ("pending", "delete")
+
+def bulk_edit(target, action):
+    if action == 'delete': return ("DELETE FROM domains WHERE status=?", (target,))
+    return ("UPDATE domains SET status=? WHERE status=?", (action, target))
+
+def run_bulk(files, target, action, scope):
+    """
+    Runs one bulk action over [(country, filename)] as a single batch (one
+    commit) and flashes the per-file row counts.
+    """
+    if target not in BULK_TARGETS or action not in BULK_ACTIONS:
+        flash("Unknown bulk action.", "danger")
+        return
+    if not files:
+        flash(f"No databases found for {scope}.", "warning")
+        return
+
+    edit = bulk_edit(target, action)
+    ticket = WRITES.submit({key: [edit] for key in files}, f"Bulk {action} {target} in {scope} ({len(files)} files)")
+    ok = ticket.wait(timeout=300)
+    if ok is None:
+        flash(f"Bulk action on {len(files)} files is still running - it will be committed when done, refresh in a while.", "info")
+        return
+    if not ok:
+        flash(f"Bulk action failed: {ticket.msg}", "danger")
+        return
+
+    touched = sorted(((k, n) for k, n in ticket.counts.items() if n), key=lambda kv: -kv[1])
+    total = sum(n for _, n in touched)
+    detail = ", ".join(f"{c}/{f.replace('.sqlite', '')}: {n:,}" for (c, f), n in touched)
+    flash(f"{action.title()} applied to {total:,} {target} domains in {len(touched)} of {len(files)} files. {detail}", "success")
+    if ticket.msg.startswith("Saved (skipped") or ticket.msg.startswith("Nothing to change (skipped"):
+        flash(ticket.msg, "warning")
+
 @app.route('/bulk_action/<c>/<f>', methods=['POST'])
 def bulk(c, f):
-    t, a = request.form.get('target'), request.form.get('action')
-    def act(conn):
-        if a == 'delete': conn.execute("DELETE FROM domains WHERE status=?", (t,))
-        else: conn.execute("UPDATE domains SET status=? WHERE status=?", (a, t))
-        conn.commit()
-        return "SAVE"
-    fetch_and_edit_db(c, f, act)
+    run_bulk([(c, f)], request.form.get('target'), request.form.get('action'), f)
     return redirect(url_for('manage_db', country=c, filename=f))
 
+@app.route('/bulk_action/<c>', methods=['POST'])
+def bulk_country(c):
+    files = [(c, i['name']) for i in get_files_in_country(c)]
+    run_bulk(files, request.form.get('target'), request.form.get('action'), c)
+    return redirect(url_for('view_country', country=c))
+
+@app.route('/bulk_action', methods=['POST'])
+def bulk_global():
+    files = [(i['country_name'], i['name']) for i in STORAGE.list_all()]
+    run_bulk(files, request.form.get('target'), request.form.get('action'), "all countries")
+    return redirect(url_for('home'))
+
+@app.route('/compact', methods=['POST'])
+def compact():
+    ok, msg, report = compact_fleet(request.form.get('country') or None)
+    if not ok: flash(f"Compaction failed: {msg}", "danger")
+    else:
+        flash(f"Compacted {compaction_summary(report)}.", "success")
+        if "(skipped" in msg: flash(msg, "warning")
+    return redirect(url_for('home'))
+
+# ---------------------------------------------------------
+# ENTRY POINTS
+# ---------------------------------------------------------
+def create_app():
+    """
+    Application factory for production WSGI servers (see USAGE). Workers
+    start serving at once: one of them scans, the rest load its snapshot
+    and listing from CACHE_ROOT/shared, and all share the blob cache.
+    """
+    if not os.path.exists(CONFIG_PATH): raise RuntimeError(f"{CONFIG_PATH} not found (set NEXUS_CONFIG)")
+    app.secret_key = CFG.get("SECRET_KEY", app.secret_key)  # Must be the same in every worker
+    return app
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if not os.path.exists(CONFIG_PATH):
+        print(f"CRITICAL: {CONFIG_PATH} not found!")
+        sys.exit(1)
+    if sys.argv[1:2] == ["compact"]:
+        ok, msg, report = compact_fleet(sys.argv[2] if len(sys.argv) > 2 else None)
+        for r in report:
+            print(f"{r['file']:<40} {r['before']:>12,} -> {r['after']:>12,}  gz {r['snapshot'] or 0:>12,}")
+        print(compaction_summary(report) if ok else f"FAILED: {msg}")
+        if ok and "(skipped" in msg: print(msg)
+    else:
+        create_app().run(host='0.0.0.0', port=5000, debug=True)
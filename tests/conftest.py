@@ -0,0 +1,57 @@
+# Tests run cloud_admin in local mode against a throwaway fleet; nothing touches GitHub.
+# cloud_admin reads its config at import time, so it is written before any test module imports it.
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark import SCHEMA, FakeGitHub, generate_fleet
+
+WORK = tempfile.mkdtemp(prefix="nexus_test_")
+FLEET = os.path.join(WORK, "db")
+os.makedirs(FLEET)
+with open(os.path.join(WORK, "config.json"), "w", encoding="utf-8") as f:
+    json.dump({"STORAGE": {"MODE": "local", "ROOT": FLEET}, "CACHE": {"ROOT": os.path.join(WORK, "cache")},
+               "WRITES": {"WINDOW_SECONDS": 60}}, f)
+os.environ["NEXUS_CONFIG"] = os.path.join(WORK, "config.json")
+
+def pytest_unconfigure(config):
+    shutil.rmtree(WORK, ignore_errors=True)
+
+def make_domains(conn, rows):
+    """rows: [(status, niche, attempts, last_attempt_at, next_retry_at, updated_at)]"""
+    conn.executescript(SCHEMA)
+    conn.executemany("""INSERT INTO domains (domain, status, niche, attempts, last_attempt_at, next_retry_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""", [(f"site{i}.com", *r) for i, r in enumerate(rows)])
+    conn.commit()
+    return conn
+
+@pytest.fixture
+def fleet():
+    """Fresh db/<Country>/<City>.sqlite tree: Denmark/Aarhus and Denmark/Odense, 5 pending rows each."""
+    shutil.rmtree(FLEET)
+    os.makedirs(os.path.join(FLEET, "Denmark"))
+    for city in ("Aarhus", "Odense"):
+        conn = sqlite3.connect(os.path.join(FLEET, "Denmark", f"{city}.sqlite"))
+        make_domains(conn, [("pending", "Plumber", 0, None, None, None)] * 5).close()
+    return FLEET
+
+@pytest.fixture
+def github(monkeypatch, tmp_path):
+    """GitHubStorage as STORAGE, served by benchmark's FakeGitHub: 2 countries x 2 cities, no retry waits."""
+    import cloud_admin as ca
+    generate_fleet(str(tmp_path / "fleet"), 2, 2, 50)
+    fake = FakeGitHub(str(tmp_path / "fleet")).start()
+    monkeypatch.setattr(ca, "REPO_API", f"{fake.url}/repos/o/r")
+    monkeypatch.setattr(ca, "API_BASE", f"{fake.url}/repos/o/r/contents")
+    monkeypatch.setattr(ca, "GH", ca.GitHubClient(8, 2, max_wait=0))
+    monkeypatch.setattr(ca, "STORAGE", ca.GitHubStorage())
+    ca.STORAGE.invalidate_listing()  # The shared listing outlives the test
+    yield fake
+    fake.stop()
+    ca.STORAGE.invalidate_listing()
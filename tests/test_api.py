@@ -0,0 +1,34 @@
+# JSON API and live stream, served from an engine of their own over the local test fleet
+import json
+
+import pytest
+
+import cloud_admin as ca
+
+@pytest.fixture
+def engine(fleet, monkeypatch, request):
+    engine = ca.AnalyticsEngine(60, ca.SharedState(f"test-{request.node.name}"))
+    monkeypatch.setattr(ca, "ANALYTICS", engine)
+    return engine
+
+def test_stream_starts_the_engine(engine, monkeypatch):
+    # No /, /api/stats or trigger() first: the stream alone must get a scan going
+    monkeypatch.setattr(ca, "STREAM_SECONDS", 0.1)
+    r = ca.app.test_client().get("/api/stream", buffered=False)
+    try:
+        for _, chunk in zip(range(50), r.response):
+            if chunk.startswith(b"event: stats"): break
+        assert chunk.startswith(b"event: stats"), chunk
+        payload = json.loads(chunk.decode().split("data: ", 1)[1])
+    finally:
+        r.close()
+    assert payload["stats"]["total"] == 10 and payload["delta"]["total"] == 10
+    assert engine.leading
+
+def test_stats_endpoints(engine):
+    client = ca.app.test_client()
+    body = client.get("/api/stats").get_json()
+    assert body["global"]["total"] == 10 and body["last_error"] is None
+    city = client.get("/api/stats/Denmark/Aarhus").get_json()
+    assert (city["total"], city["pending"], city["source"]) == (5, 5, "scan")
+    assert client.get("/api/stats/Nowhere").status_code == 404
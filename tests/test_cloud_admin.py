@@ -0,0 +1,173 @@
+import sqlite3
+
+import pytest
+
+import cloud_admin as ca
+from conftest import make_domains
+
+NOW = 1_000_000
+
+@pytest.fixture(autouse=True)
+def no_refresh(monkeypatch):
+    # Saved edits would otherwise start a background scan
+    monkeypatch.setattr(ca.ANALYTICS, "trigger", lambda: None)
+
+def sample_db(now=NOW):
+    return make_domains(sqlite3.connect(":memory:"), [
+        ("success", "Plumber", 1, now - 100, None, now - 30),
+        ("failed", "Plumber", 2, now - 200, now - 10, now - 200),
+        ("failed", "Law Firm", 7, now - 300, now + 600, now - 7200),
+        ("failed", "Law Firm", 3, now - 300, now + 7200, now - 90000),
+        ("pending", None, 0, None, None, None),
+    ])
+
+# --- scan stats ------------------------------------------------------------
+def test_extract_stats_counts():
+    stats = ca.extract_stats(sample_db(), NOW)
+    assert (stats["total"], stats["success"], stats["failed"], stats["pending"]) == (5, 1, 3, 1)
+    assert (stats["m1"], stats["m5"], stats["h1"], stats["h24"]) == (1, 2, 2, 3)
+    assert stats["retry_due"] == 1
+    assert stats["attempts"] == {"0": 1, "1": 1, "2": 1, "3": 1, "5+": 1}
+    assert stats["niches"] == {"Plumber": {"success": 1, "failed": 1}, "Law Firm": {"failed": 2}, "(none)": {"pending": 1}}
+
+def test_retry_backlog_reevaluated_later():
+    stats = ca.extract_stats(sample_db(), NOW)
+    assert ca.retry_backlog(stats, NOW) == (1, 1)
+    assert ca.retry_backlog(stats, NOW + 900) == (2, 0)
+    # Retries are kept per minute: one counts as due once its minute has ended
+    assert ca.retry_backlog(stats, NOW + 7200) == (2, 1)
+    assert ca.retry_backlog(stats, NOW + 7260) == (3, 0)
+
+# --- .meta summaries -------------------------------------------------------
+def test_stats_from_meta_matches_scan():
+    now = int(ca.time.time())
+    conn = sample_db(now)
+    meta = ca.parse_meta(ca.write_meta({"succ": 4}, ca.db_summary(conn, "abc", now)))
+    assert meta["succ"] == 4  # The scrapers' own keys are kept
+
+    stats, scanned = ca.stats_from_meta(meta, {"sha": "abc"}), ca.extract_stats(conn, now)
+    assert stats["source"] == "meta"
+    for k in ("total", "success", "failed", "pending", "m5", "h1", "h24", "retry_due", "attempts", "niches"):
+        assert stats[k] == scanned[k], k
+    assert ca.retry_backlog(stats, now + 900) == ca.retry_backlog(scanned, now + 900)
+
+def test_stats_from_meta_rejects_stale():
+    summary = ca.db_summary(sample_db(), "abc", NOW)
+    assert ca.stats_from_meta(ca.parse_meta(ca.write_meta(None, summary)), {"sha": "def"}) is None
+    assert ca.stats_from_meta(ca.parse_meta(ca.write_meta(None, {**summary, "version": 1})), {"sha": "abc"}) is None
+    assert ca.stats_from_meta({"succ": 1}, {"sha": "abc"}) is None
+    assert ca.stats_from_meta(None, {"sha": "abc"}) is None
+    assert ca.parse_meta(b"not json") is None
+
+# --- manage_db paging ------------------------------------------------------
+def browse_db():
+    # Every other row shares last_attempt_at, every fifth was never attempted
+    conn = make_domains(sqlite3.connect(":memory:"), [
+        ("failed", "Plumber", 1, None if i % 5 == 0 else 1000 + i // 2, None, None) for i in range(25)])
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def all_pages(conn, **kw):
+    pages, cursor = [], None
+    while True:
+        rows, raw = ca.browse_page(conn, after=cursor, limit=7, **kw)
+        pages.append([r["id"] for r in rows])
+        if raw is None: return pages
+        cursor = ca.parse_cursor(raw)
+
+def test_browse_page_by_id():
+    pages = all_pages(browse_db())
+    assert [len(p) for p in pages] == [7, 7, 7, 4]
+    assert sum(pages, []) == list(range(25, 0, -1))
+
+def test_browse_page_by_last_attempt_with_ties():
+    conn = browse_db()
+    expected = [r[0] for r in conn.execute(
+        "SELECT id FROM domains WHERE last_attempt_at IS NOT NULL ORDER BY last_attempt_at DESC, id DESC")]
+    assert sum(all_pages(conn, sort="last_attempt"), []) == expected
+    assert len(expected) == 20
+
+def test_browse_page_filters_and_bad_cursor():
+    rows, cursor = ca.browse_page(browse_db(), status="pending")
+    assert (rows, cursor) == ([], None)
+    assert ca.parse_cursor("x_1") is None and ca.parse_cursor(None) is None
+
+# --- write-behind queue ----------------------------------------------------
+def count(country, city, status):
+    conn = sqlite3.connect(ca.STORAGE._path(country, city))
+    try: return conn.execute("SELECT count(*) FROM domains WHERE status = ?", (status,)).fetchone()[0]
+    finally: conn.close()
+
+def test_write_queue_coalesces_into_one_commit(fleet, monkeypatch):
+    calls = []
+    commit_files = ca.STORAGE.commit_files
+    monkeypatch.setattr(ca.STORAGE, "commit_files", lambda batch, msg: calls.append(batch) or commit_files(batch, msg))
+    queue = ca.WriteQueue(60)
+    first = queue.submit({("Denmark", "Aarhus.sqlite"): [("UPDATE domains SET status = 'success' WHERE id = 1", ())]}, "one")
+    second = queue.submit({("Denmark", "Aarhus.sqlite"): [("UPDATE domains SET status = 'success' WHERE id = 2", ())],
+                           ("Denmark", "Odense.sqlite"): [("UPDATE domains SET status = 'failed' WHERE id < 4", ())]}, "two")
+    assert queue.pending_edits("Denmark", "Aarhus.sqlite") == 2
+    queue.flush()
+
+    assert len(calls) == 1 and len(calls[0]) == 2
+    assert first.wait(0) and second.wait(0)
+    assert first.counts == {("Denmark", "Aarhus.sqlite"): 2}
+    assert second.counts == {("Denmark", "Aarhus.sqlite"): 2, ("Denmark", "Odense.sqlite"): 3}
+    assert (count("Denmark", "Aarhus.sqlite", "success"), count("Denmark", "Odense.sqlite", "failed")) == (2, 3)
+    assert queue.pending_edits("Denmark", "Aarhus.sqlite") == 0
+
+def test_write_queue_reports_failures_per_file(fleet):
+    queue = ca.WriteQueue(60)
+    ticket = queue.submit({("Denmark", "Aarhus.sqlite"): [("UPDATE domains SET status = 'success' WHERE id = 1", ())],
+                           ("Denmark", "Gone.sqlite"): [("UPDATE domains SET status = 'success'", ())],
+                           ("Denmark", "Odense.sqlite"): [("UPDATE nope SET x = 1", ())]}, "mixed")
+    queue.flush()
+
+    # One broken file does not sink the others
+    assert ticket.wait(0) and "Gone.sqlite: not found" in ticket.msg
+    assert count("Denmark", "Aarhus.sqlite", "success") == 1
+    assert queue.last_failure("Denmark", "Aarhus.sqlite") is None
+    assert queue.last_failure("Denmark", "Gone.sqlite")[1] == "not found"
+    assert "no such table" in queue.last_failure("Denmark", "Odense.sqlite")[1]
+
+    # The next save of that file clears its failure
+    queue.submit({("Denmark", "Odense.sqlite"): [("UPDATE domains SET status = 'failed' WHERE id = 1", ())]}, "retry")
+    queue.flush()
+    assert queue.last_failure("Denmark", "Odense.sqlite") is None
+
+# --- history ---------------------------------------------------------------
+AT = 1_700_000_000 - 1_700_000_000 % 3600 + 1800
+
+def entry(sha, recent, error=None):
+    stats = ca.empty_stats()
+    stats.update(total=len(recent), success=len(recent), recent=sorted(recent), error=error)
+    return {"stats": stats, "country": "Denmark", "sha": sha}
+
+def tier_totals(store):
+    conn = sqlite3.connect(store.path)
+    try: return dict(conn.execute("SELECT res, sum(count) FROM updates GROUP BY res").fetchall())
+    finally: conn.close()
+
+def test_history_record_is_idempotent(tmp_path):
+    store = ca.HistoryStore(str(tmp_path / "history.sqlite"))
+    recent = [AT - 3630, AT - 3620, AT - 120]
+    store.record({"Denmark/Aarhus.sqlite": entry("a", recent)}, AT)
+    store.record({"Denmark/Aarhus.sqlite": entry("a", recent)}, AT + 60)
+    assert tier_totals(store) == {60: 3, 3600: 3, 86400: 3}
+
+    # A later push backfills an older update: recounted, not added on top
+    store.record({"Denmark/Aarhus.sqlite": entry("b", recent + [AT - 7200])}, AT + 120)
+    assert tier_totals(store) == {60: 4, 3600: 4, 86400: 4}
+
+    conn = sqlite3.connect(store.path)
+    try:
+        assert conn.execute("SELECT count(*), max(total) FROM samples WHERE res = 60").fetchone() == (3, 4)
+        assert conn.execute("SELECT bucket, count FROM updates WHERE res = 3600 ORDER BY bucket").fetchall() == [
+            (AT - 1800 - 7200, 1), (AT - 1800 - 3600, 2), (AT - 1800, 1)]
+    finally:
+        conn.close()
+
+def test_history_record_skips_failed_scans(tmp_path):
+    store = ca.HistoryStore(str(tmp_path / "history.sqlite"))
+    store.record({"Denmark/Aarhus.sqlite": entry("a", [AT - 120], error="timeout")}, AT)
+    assert tier_totals(store) == {}
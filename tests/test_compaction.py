@@ -0,0 +1,62 @@
+# Compaction job and .sqlite.gz snapshots (local fleet and FakeGitHub)
+import gzip
+import os
+import sqlite3
+import stat
+
+import pytest
+
+import cloud_admin as ca
+
+@pytest.fixture(autouse=True)
+def no_refresh(monkeypatch):
+    monkeypatch.setattr(ca.ANALYTICS, "trigger", lambda: None)
+
+def test_snapshots_are_deterministic(tmp_path, fleet):
+    src = ca.STORAGE._path("Denmark", "Aarhus.sqlite")
+    first = ca.write_snapshot(src, str(tmp_path / "a.gz"))
+    second = ca.write_snapshot(src, str(tmp_path / "b.gz"))
+    assert first == second and first["size"] == os.path.getsize(src)
+    with gzip.open(tmp_path / "a.gz") as f, open(src, "rb") as g: assert f.read() == g.read()
+
+def test_local_compaction_publishes_matching_snapshots(fleet):
+    ok, msg, report = ca.compact_fleet("Denmark")
+    assert ok and [r["file"] for r in report] == ["Denmark/Aarhus.sqlite", "Denmark/Odense.sqlite"]
+    for f in ca.STORAGE.list_all():
+        path = f["local_path"]
+        snapshot = ca.STORAGE.read_meta(f)["snapshot"]
+        assert snapshot["db_sha"] == f["sha"] and f["snapshot_size"] == snapshot["compressed_size"]
+        with gzip.open(path + ca.SNAPSHOT_SUFFIX) as g, open(path, "rb") as d: assert g.read() == d.read()
+        assert stat.S_IMODE(os.stat(path + ca.SNAPSHOT_SUFFIX).st_mode) == 0o666 & ~ca.UMASK
+        conn = sqlite3.connect(path)
+        try: assert {r[1] for r in conn.execute("PRAGMA index_list(domains)")} >= {"idx_updated_at", "idx_next_retry_at"}
+        finally: conn.close()
+    assert ca.compaction_summary(report).startswith("2 DBs: ")
+
+def test_github_scans_download_current_snapshots_only(github, monkeypatch):
+    urls, download = [], ca.STORAGE._download
+    monkeypatch.setattr(ca.STORAGE, "_download", lambda url, **kw: urls.append(url) or download(url, **kw))
+    ok, _, report = ca.compact_fleet("Country00")
+    assert ok and all(r["snapshot"] for r in report)
+
+    def cold_fetch(name):
+        ca.BLOB_CACHE.max_bytes, max_bytes = 0, ca.BLOB_CACHE.max_bytes
+        ca.BLOB_CACHE.evict()
+        ca.BLOB_CACHE.max_bytes = max_bytes
+        urls.clear()
+        info = ca.STORAGE.find_file("Country00", name)
+        return info, ca.STORAGE.prefetch(info)
+
+    info, received = cold_fetch("City000.sqlite")
+    assert urls == [info["snapshot_url"]] and received == info["snapshot_size"] < info["size"]
+    assert ca.git_blob_sha_file(ca.STORAGE.fetch_blob(info)) == info["sha"]
+
+    # Someone pushes the DB without a new snapshot: the stale .gz must not be used
+    conn = sqlite3.connect(os.path.join(github.root, "Country00", "City001.sqlite"))
+    conn.execute("DELETE FROM domains WHERE id = 1")
+    conn.commit()
+    conn.close()
+    ca.STORAGE.invalidate_listing()
+    info, received = cold_fetch("City001.sqlite")
+    assert urls == [info["download_url"]] and received == info["size"]
+    assert ca.git_blob_sha_file(ca.STORAGE.fetch_blob(info)) == info["sha"]
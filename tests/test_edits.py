@@ -0,0 +1,55 @@
+# Working copies and streamed uploads used to edit DBs (in memory or through a temp file)
+import base64
+import json
+import os
+import sqlite3
+
+import pytest
+
+import cloud_admin as ca
+from conftest import make_domains
+
+@pytest.fixture(params=[True, False], ids=["in-memory", "temp-file"])
+def copy_mode(request, monkeypatch):
+    monkeypatch.setattr(ca, "IN_MEMORY_DB", request.param and ca.IN_MEMORY_DB)
+    return request.param
+
+def wal_db(path):
+    conn = make_domains(sqlite3.connect(path), [("pending", "Plumber", 0, None, None, None)] * 3)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()  # Checkpointed; the file keeps its WAL-format header
+    return path
+
+def test_working_copy_edits_and_keeps_the_original(tmp_path, copy_mode):
+    path = wal_db(str(tmp_path / "city.sqlite"))
+    before = ca.git_blob_sha_file(path)
+    cache = ca.BlobCache(str(tmp_path / "cache"), 10 ** 9)
+    with ca.working_copy(path, cache) as (conn, dump):
+        conn.execute("UPDATE domains SET status = 'success' WHERE id = 1")
+        conn.commit()
+        out, sha = dump()
+    assert ca.git_blob_sha_file(path) == before  # Only the copy was edited
+    assert sha == ca.git_blob_sha_file(out)
+    with open(out, "rb") as f: assert f.read(20)[18:20] == b"\x02\x02"  # Still WAL-format for the scrapers
+    conn = sqlite3.connect(out)
+    try: assert conn.execute("SELECT count(*) FROM domains WHERE status = 'success'").fetchone()[0] == 1
+    finally: conn.close()
+
+def test_base64_body_streams_valid_json(tmp_path):
+    path = tmp_path / "blob"
+    data = os.urandom(ca.Base64Body.CHUNK * 2 + 5)
+    path.write_bytes(data)
+    body = ca.Base64Body(str(path))
+    raw = b"".join(body)
+    assert len(raw) == len(body) and raw == b"".join(body)  # Length is exact, and it can be re-sent
+    assert base64.b64decode(json.loads(raw)["content"]) == data
+
+def test_large_db_edit_lands_through_the_git_data_api(github, monkeypatch, copy_mode):
+    if not copy_mode: monkeypatch.setattr(ca, "IN_MEMORY_MAX_MB", 0)  # Every file counts as large
+    ok, msg, counts, _ = ca.STORAGE.commit_files(
+        {("Country00", "City001.sqlite"): [("UPDATE domains SET status = 'failed'", ())]}, "big")
+    assert ok and counts[("Country00", "City001.sqlite")] > 0
+    assert github.routes["POST git/blobs"] == 1 and github.routes["PUT contents/db"] == 0
+    conn = sqlite3.connect(os.path.join(github.root, "Country00", "City001.sqlite"))
+    try: assert conn.execute("SELECT count(*) FROM domains WHERE status != 'failed'").fetchone()[0] == 0
+    finally: conn.close()
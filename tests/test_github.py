@@ -0,0 +1,152 @@
+# GitHub paths, served by benchmark's FakeGitHub (see the `github` fixture)
+import os
+import socket
+import sqlite3
+
+import pytest
+import requests
+
+import cloud_admin as ca
+
+def closed_port_url():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+def response(status, **headers):
+    r = requests.Response()
+    r.status_code, r.headers = status, requests.structures.CaseInsensitiveDict(headers)
+    return r
+
+# --- client ----------------------------------------------------------------
+def test_client_retries_server_errors(github):
+    github.faults = [502, 503]
+    r = ca.GH.get(f"{ca.API_BASE}/db")
+    assert r.status_code == 200 and github.stats["requests"] == 3
+
+def test_client_gives_up_after_max_retries(github):
+    github.faults = [502] * 5
+    assert ca.GH.get(f"{ca.API_BASE}/db").status_code == 502
+    assert github.stats["requests"] == 3  # First try + MAX_RETRIES
+
+def test_client_conditional_get_reuses_etag(github):
+    first = ca.GH.get(f"{ca.API_BASE}/db", conditional=True)
+    second = ca.GH.get(f"{ca.API_BASE}/db", conditional=True)
+    assert github.stats["not_modified"] == 1
+    assert second.status_code == 200 and second.json() == first.json()
+
+def test_retry_delay_honours_headers():
+    client = ca.GitHubClient(1, 3, max_wait=60)
+    assert client._retry_delay(response(404), 0) is None
+    assert client._retry_delay(response(403), 0) is None  # Forbidden, not rate limited
+    assert client._retry_delay(response(429, **{"Retry-After": "7"}), 0) == 7
+    reset = str(int(ca.time.time()) + 30)
+    assert 28 <= client._retry_delay(response(403, **{"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": reset}), 0) <= 30
+    assert client._retry_delay(response(502), 10) == 60  # Backoff is capped at max_wait
+
+# --- listing failures ------------------------------------------------------
+def test_listing_failure_raises(github, monkeypatch):
+    assert len(ca.STORAGE.list_all()) == 4
+    down = closed_port_url()
+    monkeypatch.setattr(ca, "REPO_API", f"{down}/repos/o/r")
+    monkeypatch.setattr(ca, "API_BASE", f"{down}/repos/o/r/contents")
+    ca.STORAGE.invalidate_listing()
+    with pytest.raises(ca.StorageError):
+        ca.STORAGE.list_all()
+
+def test_listing_server_error_raises(github):
+    github.faults = [500] * 6  # Head lookup and the contents fallback, with their retries
+    with pytest.raises(ca.StorageError, match="HTTP 500"):
+        ca.STORAGE.list_countries()
+
+def test_refresh_keeps_snapshot_when_listing_fails(github, monkeypatch):
+    engine = ca.AnalyticsEngine(60, ca.SharedState("test-analytics"))
+    heard = []
+    engine.listeners.append(heard.append)
+    engine.refresh()
+    snap, total = engine.snapshot, engine.snapshot["global_stats"]["total"]
+    assert total > 0 and engine.last_error is None and len(heard) == 1
+
+    monkeypatch.setattr(ca, "API_BASE", f"{closed_port_url()}/repos/o/r/contents")
+    monkeypatch.setattr(ca.STORAGE, "_listing_at", lambda: (None, None))
+    engine.refresh()
+    assert engine.snapshot is snap and engine.snapshot["global_stats"]["total"] == total
+    assert engine.last_error and "failed" in engine.last_error
+    assert len(heard) == 1  # Derived stores are not synced against a failed listing
+
+# --- tree listing ----------------------------------------------------------
+def fleet_rows(fake, country, city, where="1"):
+    conn = sqlite3.connect(os.path.join(fake.root, country, city))
+    try: return conn.execute(f"SELECT count(*) FROM domains WHERE {where}").fetchone()[0]
+    finally: conn.close()
+
+def test_tree_listing_is_cached_by_head(github):
+    files = ca.STORAGE.list_all()
+    assert [(f["country_name"], f["name"]) for f in files][:2] == [("Country00", "City000.sqlite"), ("Country00", "City001.sqlite")]
+    assert ca.STORAGE.list_files("Country01") and ca.STORAGE.list_countries() == ["Country00", "Country01"]
+    assert github.routes["GET git/trees"] == 1 and github.routes["GET contents/db"] == 0
+
+    ca.STORAGE.invalidate_listing()  # Head re-checked, unchanged: the tree is not fetched again
+    ca.STORAGE.list_all()
+    assert github.routes["GET git/ref"] == 2 and github.routes["GET git/trees"] == 1
+
+def test_truncated_tree_uses_contents_and_is_remembered(github):
+    github.truncated = True
+    for _ in range(3):
+        assert len(ca.STORAGE.list_all()) == 4
+        ca.STORAGE.list_files("Country00")
+    assert github.routes["GET git/trees"] == 1
+    assert github.routes["GET contents/db"] > 0
+
+def test_truncated_tree_edits_still_commit(github):
+    github.truncated = True
+    ok, msg, counts, errors = ca.STORAGE.commit_files(
+        {("Country00", "City000.sqlite"): [("UPDATE domains SET status = 'success'", ())]}, "edit")
+    assert ok and msg == "Saved" and counts[("Country00", "City000.sqlite")] > 0
+    assert fleet_rows(github, "Country00", "City000.sqlite", "status != 'success'") == 0
+    assert github.routes["PATCH git/refs"] == 1
+
+# --- batched commits -------------------------------------------------------
+def push_elsewhere(fake, domain):
+    """Someone else's commit: changes a file the batch does not touch, so the branch head moves."""
+    conn = sqlite3.connect(os.path.join(fake.root, "Country01", "City001.sqlite"))
+    conn.execute("INSERT INTO domains (domain) VALUES (?)", (domain,))
+    conn.commit()
+    conn.close()
+
+def test_commit_batches_files_into_one_commit(github):
+    ok, msg, counts, errors = ca.STORAGE.commit_files({
+        ("Country00", "City000.sqlite"): [("UPDATE domains SET status = 'failed' WHERE id <= 3", ())],
+        ("Country01", "City000.sqlite"): [("DELETE FROM domains WHERE id = 1", ())],
+        ("Country01", "Gone.sqlite"): [("DELETE FROM domains", ())],
+    }, "batch")
+    assert ok and msg == "Saved (skipped Country01/Gone.sqlite: not found)"
+    assert counts == {("Country00", "City000.sqlite"): 3, ("Country01", "City000.sqlite"): 1}
+    assert errors == {("Country01", "Gone.sqlite"): "not found"}
+    assert github.routes["POST git/commits"] == 1 and github.routes["PATCH git/refs"] == 1
+    assert fleet_rows(github, "Country01", "City000.sqlite", "id = 1") == 0
+    # Each changed DB got a fresh .meta summary in the same commit
+    meta = ca.STORAGE.read_meta(ca.STORAGE.find_file("Country00", "City000.sqlite"))
+    assert meta["summary"]["db_sha"] == ca.STORAGE.find_file("Country00", "City000.sqlite")["sha"]
+
+def test_commit_rebases_when_the_branch_moves(github):
+    calls = []
+    def edit(key, conn):
+        calls.append(key)
+        if len(calls) == 1: push_elsewhere(github, "theirs.com")
+        return ca.apply_edits(conn, [("UPDATE domains SET status = 'success' WHERE id = 1", ())]), True
+
+    ok, msg, counts, _ = ca.STORAGE._commit([("Country00", "City000.sqlite")], edit, "mine")
+    assert ok and len(calls) == 2  # Replayed once on the new head
+    assert github.routes["PATCH git/refs"] == 2
+    assert fleet_rows(github, "Country00", "City000.sqlite", "id = 1 AND status = 'success'") == 1
+    assert fleet_rows(github, "Country01", "City001.sqlite", "domain = 'theirs.com'") == 1
+
+def test_commit_gives_up_when_the_branch_keeps_moving(github):
+    def edit(key, conn):
+        push_elsewhere(github, f"theirs{github.routes['PATCH git/refs']}.com")
+        return ca.apply_edits(conn, [("UPDATE domains SET status = 'success' WHERE id = 1", ())]), True
+
+    ok, msg, _, _ = ca.STORAGE._commit([("Country00", "City000.sqlite")], edit, "mine")
+    assert not ok and msg == "Branch kept moving, gave up after retries"
+    assert github.routes["PATCH git/refs"] == ca.WRITE_MAX_RETRIES
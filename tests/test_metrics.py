@@ -0,0 +1,37 @@
+import cloud_admin as ca
+
+def metrics():
+    m = ca.Metrics()
+    m.declare("requests_total", "counter", "Requests.")
+    m.declare("latency_seconds", "histogram", "Latency.", (0.1, 1))
+    return m
+
+def test_render_mixed_label_types():
+    m = metrics()
+    m.inc("requests_total", method="GET", status=200)
+    m.inc("requests_total", method="GET", status="ConnectionError")
+    m.inc("requests_total", method="GET", status=200)
+    m.inc("requests_total", method="GET", status="200")  # Same series as the int
+    lines = m.render().splitlines()
+    assert 'requests_total{method="GET",status="200"} 3' in lines
+    assert 'requests_total{method="GET",status="ConnectionError"} 1' in lines
+
+def test_render_histogram_is_cumulative():
+    m = metrics()
+    for v in (0.05, 0.5, 0.5, 3):
+        m.observe("latency_seconds", v, phase="query")
+    out = m.render()
+    assert '# TYPE latency_seconds histogram' in out
+    for line in ('latency_seconds_bucket{phase="query",le="0.1"} 1', 'latency_seconds_bucket{phase="query",le="1"} 3',
+                 'latency_seconds_bucket{phase="query",le="+Inf"} 4', 'latency_seconds_count{phase="query"} 4',
+                 'latency_seconds_sum{phase="query"} 4.05'):
+        assert line in out.splitlines()
+
+def test_metrics_endpoint_after_connection_error(github, monkeypatch):
+    monkeypatch.setattr(ca.GH, "max_retries", 0)
+    ca.GH.get(f"{ca.API_BASE}/db")
+    monkeypatch.setattr(ca, "API_BASE", "http://127.0.0.1:9/repos/o/r/contents")  # Discard port, refused
+    try: ca.GH.get(f"{ca.API_BASE}/db")
+    except ca.requests.ConnectionError: pass
+    r = ca.app.test_client().get("/metrics")
+    assert r.status_code == 200 and 'status="ConnectionError"' in r.get_data(as_text=True)
@@ -0,0 +1,97 @@
+# Scan pipeline: the adaptive download limiter and scan_files_async over the local test fleet
+import asyncio
+
+import cloud_admin as ca
+
+def limiter(start=2, lo=1, hi=4, budget=10 ** 9):
+    return ca.AdaptiveLimiter(start, lo, hi, target_latency=1.0, mem_budget=budget)
+
+async def admitted(lim, sizes):
+    """Queues an acquire per size; returns the tasks and the sizes admitted straight away."""
+    tasks = [asyncio.create_task(lim.acquire(s)) for s in sizes]
+    await asyncio.sleep(0)
+    return tasks, sorted(s for s, t in zip(sizes, tasks) if t.done())
+
+def test_limiter_grows_on_fast_and_halves_on_trouble():
+    async def run():
+        lim = limiter(start=2, lo=1, hi=4)
+        for _ in range(5):
+            await lim.acquire(0)
+            lim.release(0, 0.1, True)
+        assert lim.limit == 4  # +1 per fast download, capped at hi
+        await lim.acquire(0)
+        lim.release(0, 0.1, False)
+        assert lim.limit == 2  # Halved on an error
+        await lim.acquire(0)
+        lim.release(0, 5.0, True)
+        assert lim.limit == 1  # Halved when slower than twice the target
+        await lim.acquire(0)
+        lim.release(0, 5.0, True)
+        assert lim.limit == 1  # Never below lo
+    asyncio.run(run())
+
+def test_limiter_backs_off_near_the_rate_limit(github, monkeypatch):
+    monkeypatch.setattr(ca.GH, "rate_limit_remaining", ca.SCAN_RATE_LIMIT_FLOOR - 1)
+    async def run():
+        lim = limiter(start=4)
+        await lim.acquire(0)
+        lim.release(0, 0.1, True)  # Fast, but the API budget is nearly spent
+        assert lim.limit == 2
+    asyncio.run(run())
+
+def test_limiter_caps_concurrency():
+    async def run():
+        lim = limiter(start=2)
+        tasks, now = await admitted(lim, [1, 1, 1])
+        assert len(now) == 2 and lim.in_flight == 2
+        lim.release(1, 1.5, True)  # Between target and 2x target: limit unchanged
+        await asyncio.sleep(0)
+        assert all(t.done() for t in tasks) and lim.in_flight == 2
+    asyncio.run(run())
+
+def test_scan_files_async_reports_every_city(fleet):
+    results = {}
+    asyncio.run(ca.scan_files_async(ca.STORAGE.list_all(), lambda f, data: results.setdefault(f["name"], data)))
+    assert sorted(results) == ["Aarhus.sqlite", "Odense.sqlite"]
+    assert all(d["total"] == 5 and d["error"] is None for d in results.values())
+
+def test_scan_reports_broken_files(fleet):
+    with open(ca.STORAGE._path("Denmark", "Odense.sqlite"), "wb") as f: f.write(b"not a database" * 100)
+    results = {}
+    asyncio.run(ca.scan_files_async(ca.STORAGE.list_all(), lambda f, data: results.setdefault(f["name"], data)))
+    assert results["Aarhus.sqlite"]["error"] is None
+    assert results["Odense.sqlite"]["error"].startswith("corrupt DB") and results["Odense.sqlite"]["total"] == 0
+
+def test_limiter_admits_largest_first_within_the_byte_budget():
+    async def run():
+        lim = limiter(start=10, hi=10, budget=100)
+        await lim.acquire(100)  # Budget full: everything below queues
+        tasks, now = await admitted(lim, [30, 80, 50, 10])
+        assert now == []
+        lim.release(100, 0.1, True)
+        await asyncio.sleep(0)
+        assert sorted(s for s, t in zip([30, 80, 50, 10], tasks) if t.done()) == [10, 80]  # 80 first, then what fits
+        lim.release(80, 0.1, True)
+        await asyncio.sleep(0)
+        assert all(t.done() for t in tasks) and lim.bytes_in_flight == 90
+    asyncio.run(run())
+
+def test_limiter_lets_an_oversized_file_through_alone():
+    async def run():
+        lim = limiter(start=10, hi=10, budget=10)
+        tasks, now = await admitted(lim, [50, 1])
+        assert now == [50]
+        lim.release(50, 0.1, True)
+        await asyncio.sleep(0)
+        assert tasks[1].done()
+    asyncio.run(run())
+
+def test_downloads_stream_into_the_blob_cache(github):
+    info = ca.STORAGE.find_file("Country00", "City000.sqlite")
+    ca.BLOB_CACHE.max_bytes, max_bytes = 0, ca.BLOB_CACHE.max_bytes
+    ca.BLOB_CACHE.evict()
+    ca.BLOB_CACHE.max_bytes = max_bytes
+    assert ca.STORAGE.prefetch(info) == info["size"]
+    path = ca.STORAGE.fetch_blob(info)
+    assert ca.git_blob_sha_file(path) == info["sha"] and ca.STORAGE.prefetch(info) == 0
+    assert github.routes["GET git/blobs"] == 1
@@ -0,0 +1,75 @@
+# State shared between worker processes: one leader scans, the others adopt its snapshot
+import sqlite3
+import time
+
+import pytest
+
+import cloud_admin as ca
+
+@pytest.fixture
+def engines(fleet, request):
+    """Two engines sharing one state file, as two worker processes would."""
+    name = f"test-{request.node.name}"
+    leader, follower = ca.AnalyticsEngine(60, ca.SharedState(name)), ca.AnalyticsEngine(60, ca.SharedState(name))
+    leader.shared.clear()
+    yield leader, follower
+    for engine in (leader, follower):
+        if engine.leading: engine.shared.lock.release()
+
+def test_shared_state_round_trip():
+    state = ca.SharedState("test-round-trip")
+    state.clear()
+    assert state.load() is None and state.modified() == 0
+    state.save({"a": [1, 2]})
+    assert state.load(if_changed=True) == {"a": [1, 2]}
+    assert state.load(if_changed=True) is None  # Not rewritten since
+    state.save({"a": [3]})
+    assert state.load(if_changed=True) == {"a": [3]}
+    state.clear()
+
+def test_follower_adopts_the_leaders_snapshot(engines):
+    leader, follower = engines
+    now = int(time.time())
+    conn = sqlite3.connect(ca.STORAGE._path("Denmark", "Aarhus.sqlite"))
+    conn.execute("UPDATE domains SET status = 'success', updated_at = ? WHERE id <= 3", (now - 90,))
+    conn.commit()
+    conn.close()
+
+    assert leader._lead() and not follower._lead()
+    leader.refresh()
+    follower._follow()
+    assert follower.snapshot == leader.snapshot and follower.snapshot["global_stats"]["success"] == 3
+    assert set(follower.per_file) == set(leader.per_file)
+    for path, entry in leader.per_file.items():
+        # Shared as per-minute counts: the same minutes, each update at the end of its minute
+        assert ca.per_minute_counts(follower.per_file[path]["stats"]["recent"]) == \
+               ca.per_minute_counts(entry["stats"]["recent"])
+    assert (follower.refreshing, follower.last_error) == (False, None)
+
+    # The leader goes away: the next worker takes over from its results
+    leader.shared.lock.release()
+    leader.leading = False
+    assert follower._lead() and follower.snapshot["version"] == leader.snapshot["version"]
+
+def test_follower_ignores_other_share_formats(engines):
+    leader, follower = engines
+    leader.shared.save({"format": ca.AnalyticsEngine.SHARE_FORMAT - 1, "snapshot": {"version": 9}})
+    follower._follow()
+    assert follower.snapshot is None and not follower._ready.is_set()
+
+def test_follower_trigger_wakes_the_leader(engines, monkeypatch):
+    leader, follower = engines
+    assert leader._lead() and not follower._lead()
+    leader.refresh_started = time.time() - 1
+    monkeypatch.setattr(follower, "start", lambda: None)
+    follower.trigger()
+    started = time.monotonic()
+    leader._sleep(30)
+    assert time.monotonic() - started < 5
+
+def test_github_listing_is_shared_between_workers(github):
+    ca.STORAGE.list_all()
+    assert github.routes["GET git/trees"] == 1
+    other = ca.GitHubStorage()  # A second worker process
+    assert [f["path"] for f in other.list_all()] == [f["path"] for f in ca.STORAGE.list_all()]
+    assert github.routes["GET git/trees"] == 1 and github.routes["GET git/ref"] == 1
@@ -0,0 +1,36 @@
+# LocalStorage over the test fleet (GitHub storage is covered in test_github.py)
+import os
+import sqlite3
+
+import cloud_admin as ca
+
+def test_local_listing(fleet):
+    open(os.path.join(fleet, "Denmark", "notes.txt"), "w").close()
+    files = ca.STORAGE.list_all()
+    assert [(f["country_name"], f["name"]) for f in files] == [("Denmark", "Aarhus.sqlite"), ("Denmark", "Odense.sqlite")]
+    assert files[0]["path"] == "db/Denmark/Aarhus.sqlite"
+    assert files[0]["sha"] == ca.git_blob_sha_file(files[0]["local_path"])
+    assert ca.STORAGE.list_countries() == ["Denmark"] and ca.STORAGE.list_files("Nowhere") == []
+
+def test_local_paths_stay_inside_root(fleet):
+    assert ca.STORAGE.list_files("..") == []
+    assert ca.STORAGE.find_file("Denmark", "../Denmark/Aarhus.sqlite") is None
+    assert ca.STORAGE._path("Denmark", "a/b.sqlite") is None
+
+def test_local_wal_commits_change_the_sha_and_are_read(fleet):
+    info = ca.STORAGE.find_file("Denmark", "Aarhus.sqlite")
+    writer = sqlite3.connect(info["local_path"])
+    try:
+        writer.execute("PRAGMA journal_mode=WAL")
+        writer.execute("PRAGMA wal_autocheckpoint=0")
+        writer.execute("INSERT INTO domains (domain) VALUES ('wal.com')")
+        writer.commit()
+        changed = ca.STORAGE.find_file("Denmark", "Aarhus.sqlite")
+        assert changed["sha"] != info["sha"]
+        with ca.STORAGE.open_db(changed) as conn:
+            assert conn.execute("SELECT count(*) FROM domains").fetchone()[0] == 6
+    finally:
+        writer.close()
+    # The last connection checkpoints and removes the WAL files; scans must not leave new ones
+    with ca.STORAGE.open_db(changed) as conn: conn.execute("SELECT 1").fetchone()
+    assert not [n for n in os.listdir(os.path.join(fleet, "Denmark")) if n.endswith(("-wal", "-shm"))]
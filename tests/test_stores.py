@@ -0,0 +1,87 @@
+# Merged stores (search index, analytics store), synced from the local test fleet
+import os
+import sqlite3
+
+import pytest
+
+import cloud_admin as ca
+from conftest import make_domains
+
+@pytest.fixture
+def index(fleet, tmp_path):
+    # Aarhus and Odense share site0..site4.com (see the fleet fixture); add a city with its own domains
+    conn = sqlite3.connect(os.path.join(fleet, "Denmark", "Vejle.sqlite"))
+    make_domains(conn, [("success", "Dental Clinic", 1, None, None, None)] * 2)
+    conn.execute("UPDATE domains SET domain = 'Vejle-' || id || '.dk'")
+    conn.commit()
+    conn.close()
+    store = ca.SearchIndex(str(tmp_path / "search.sqlite"))
+    store.sync(ca.STORAGE.list_all())
+    return store
+
+def test_search_prefix_on_domain_then_niche(index):
+    assert [r["domain"] for r in index.search("https://www.VEJLE-1.dk/contact")] == ["vejle-1.dk"]
+    assert {r["city"] for r in index.search("site3")} == {"Aarhus", "Odense"}
+    assert [r["domain"] for r in index.search("dental")] == ["vejle-1.dk", "vejle-2.dk"]
+    assert index.search("zzz") == [] and index.search("www.") == []
+
+def test_duplicates_across_cities(index):
+    dupes = index.duplicates()
+    assert [d["domain"] for d in dupes] == [f"site{i}.com" for i in range(5)]
+    assert dupes[0]["cities"] == 2 and set(dupes[0]["locations"].split(", ")) == {"Denmark/Aarhus", "Denmark/Odense"}
+
+def test_sync_only_rereads_changed_files(index, monkeypatch):
+    opened = []
+    open_db = ca.STORAGE.open_db
+    monkeypatch.setattr(ca.STORAGE, "open_db", lambda f: opened.append(f["name"]) or open_db(f))
+    index.sync(ca.STORAGE.list_all())
+    assert opened == []
+
+    conn = sqlite3.connect(ca.STORAGE._path("Denmark", "Vejle.sqlite"))
+    conn.execute("INSERT INTO domains (domain, status) VALUES ('vejle-new.dk', 'pending')")
+    conn.commit()
+    conn.close()
+    index.sync(ca.STORAGE.list_all())
+    assert opened == ["Vejle.sqlite"] and index.search("vejle-new")
+
+def test_sync_drops_removed_files_but_not_on_empty_listing(index):
+    assert index.coverage()["files"] == 3
+    index.sync([])  # A failed / empty listing must not empty the store
+    assert tuple(index.coverage())[:2] == (3, 12)
+
+    os.remove(ca.STORAGE._path("Denmark", "Vejle.sqlite"))
+    index.sync(ca.STORAGE.list_all())
+    assert tuple(index.coverage())[:2] == (2, 10)
+    assert index.search("vejle") == [] and index.duplicates()
+
+# --- analytics store -------------------------------------------------------
+@pytest.fixture
+def store(fleet, tmp_path):
+    store = ca.AnalyticsStore(str(tmp_path / "analytics.sqlite"))
+    store.sync(ca.STORAGE.list_all())
+    return store
+
+def test_reports_roll_up_every_city(store):
+    cols, rows = store.report("country_status")
+    assert cols == ["country", "total", "pending", "success", "failed"] and rows == [("Denmark", 10, 10, 0, 0)]
+    cols, rows = store.query("SELECT city, count(*) FROM domains WHERE domain LIKE ? GROUP BY city", ("site1%",))
+    assert rows == [("Aarhus", 1), ("Odense", 1)]
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM domains",
+    "UPDATE domains SET status = 'x'",
+    "PRAGMA journal_mode",
+    "ATTACH DATABASE ':memory:' AS other",
+    "CREATE TABLE t (x)",
+])
+def test_query_allows_reads_only(store, sql):
+    with pytest.raises(sqlite3.DatabaseError, match="not authorized|readonly"):
+        store.query(sql)
+    assert store.query("SELECT count(*) FROM domains")[1] == [(10,)]
+
+def test_query_is_stopped_after_the_time_limit(store):
+    runaway = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    started = ca.time.monotonic()
+    with pytest.raises(sqlite3.OperationalError, match="Query stopped after 0.2s"):
+        store.query(runaway, timeout=0.2)
+    assert ca.time.monotonic() - started < 5
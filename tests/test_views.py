@@ -0,0 +1,66 @@
+# Rendered pages in local mode; DB values and exception text are escaped before CONTENT | safe
+import re
+import sqlite3
+
+import pytest
+
+import cloud_admin as ca
+
+EVIL = "<script>alert(1)</script>"
+
+@pytest.fixture
+def client(fleet, monkeypatch):
+    monkeypatch.setattr(ca.ANALYTICS, "trigger", lambda: None)
+    return ca.app.test_client()
+
+def snapshot(per_file):
+    global_stats, breakdown = ca.aggregate(per_file)
+    return {"version": 1, "refreshed_at": ca.time.time(), "global_stats": global_stats,
+            "countries": ["Denmark"], "country_breakdown": breakdown, "progress": None}
+
+def test_home_escapes_scan_errors(client, monkeypatch):
+    failed = {"sha": None, "country": "Denmark", "name": "Aarhus.sqlite", "stats": ca.failed_stats(ca.StorageError(EVIL))}
+    monkeypatch.setattr(ca.ANALYTICS, "get_snapshot", lambda: snapshot({"db/Denmark/Aarhus.sqlite": failed}))
+    monkeypatch.setattr(ca.ANALYTICS, "last_error", EVIL)
+    page = client.get("/").get_data(as_text=True)
+    assert EVIL not in page and page.count("&lt;script&gt;") == 2
+
+def test_search_escapes_result_cells(client, monkeypatch):
+    row = {"domain": "a.com", "niche": None, "status": EVIL, "country": EVIL, "city": "Aarhus"}
+    monkeypatch.setattr(ca.SEARCH, "search", lambda q: [row])
+    page = client.get("/search?q=a").get_data(as_text=True)
+    assert EVIL not in page and "&lt;script&gt;" in page
+
+def test_manage_sees_uncheckpointed_wal_rows(client):
+    # A scraper's commits sit in -wal until a checkpoint; the page must still show them
+    writer = sqlite3.connect(ca.STORAGE._path("Denmark", "Aarhus.sqlite"))
+    try:
+        writer.execute("PRAGMA journal_mode=WAL")
+        writer.execute("PRAGMA wal_autocheckpoint=0")
+        writer.execute("INSERT INTO domains (domain, status) VALUES ('new-in-wal.com', 'failed')")
+        writer.commit()
+        page = client.get("/manage/Denmark/Aarhus.sqlite").get_data(as_text=True)
+        assert "new-in-wal.com" in page
+        assert re.findall(r'stat-val[^>]*>(\d+)<', page) == ["6", "5", "0", "1"]
+
+        # The next commit changes the folded SHA, so the indexed copy is rebuilt
+        writer.execute("INSERT INTO domains (domain, status) VALUES ('newer-in-wal.com', 'pending')")
+        writer.commit()
+        assert "newer-in-wal.com" in client.get("/manage/Denmark/Aarhus.sqlite").get_data(as_text=True)
+    finally:
+        writer.close()
+
+def test_manage_pages_and_filters(client):
+    page = client.get("/manage/Denmark/Odense.sqlite?status=pending&sort=last_attempt").get_data(as_text=True)
+    assert "No domains match these filters." in page  # Never-attempted rows have no last_attempt order
+    page = client.get("/manage/Denmark/Odense.sqlite?status=pending").get_data(as_text=True)
+    assert page.count("/update/Denmark/Odense.sqlite/") == 10  # 5 rows x (success, failed)
+
+def test_analytics_refuses_writes(client, monkeypatch, tmp_path):
+    store = ca.AnalyticsStore(str(tmp_path / "analytics.sqlite"))
+    store.sync(ca.STORAGE.list_all())
+    monkeypatch.setattr(ca, "STORE", store)
+    page = client.post("/analytics", data={"sql": "DELETE FROM domains"}).get_data(as_text=True)
+    assert "not authorized" in page
+    page = client.post("/analytics", data={"sql": "SELECT count(*) AS n FROM domains"}).get_data(as_text=True)
+    assert "Query Result (1 rows)" in page and ">10<" in page